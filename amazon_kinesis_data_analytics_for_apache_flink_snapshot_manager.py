@@ -2,74 +2,869 @@
 # SPDX-License-Identifier: MIT-0
 
 import os
+import math
 import time
 import json
-import boto3
+import heapq
+import bisect
+import hashlib
+import itertools
+import random
+import concurrent.futures
 import logging
 import datetime
-import botocore
+import threading
+import botocore.exceptions
 
 # setup logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# AWS clients are cached at module level, keyed by (service, region), so that warm invocations reuse them together
+# with their HTTP connection pools. Use register_client to inject stub clients, e.g. for tests. boto3 is imported on
+# the first client creation, which keeps it out of the module import, and the time taken to create each client is
+# kept in _client_setup_ms.
+_clients = {}
+_clients_lock = threading.Lock()
+_client_setup_ms = {}
+_cold_start = True
+
+# Token buckets of the Kinesis Data Analytics APIs, keyed by API name. They live as long as the execution environment,
+# so the rate learnt from throttling carries over to warm invocations, and all threads of a run draw from them.
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+_rate_limit_settings = {"requests_per_second": 10.0, "max_attempts": 6}
+_run_metrics_lock = threading.Lock()
+
+# Latency samples kept per API and run, and upper bounds of the latency histogram buckets
+MAX_LATENCY_SAMPLES_PER_API = 1000
+LATENCY_HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Deleted and not deleted snapshots stored per audit item, the rest goes to overflow items
+AUDIT_MAX_SNAPSHOTS_PER_ITEM = 1000
+
+# Global secondary index of the audit table on run time: partition key run_date, sort key snapshot_manager_run_id
+RUN_TIME_INDEX_NAME = 'runs_by_time'
+RUN_TIME_INDEX_ATTRIBUTES = ('run_outcome', 'new_snapshot_name', 'flink_app_version_id', 'num_of_snapshots_deleted',
+                             'num_of_snapshots_failed_to_be_deleted')
+
+# SQS accepts message delays of up to 15 minutes and up to 10 messages per SendMessageBatch call
+MAX_SQS_DELAY_SECONDS = 900
+SQS_BATCH_SIZE = 10
+
+# Per-application control records share the audit table and use non-positive sort keys, runs use positive ones
+LATEST_SNAPSHOT_SORT_KEY = 0
+RUN_CHECKPOINT_SORT_KEY = -1
+RUN_LOCK_SORT_KEY = -2
+TTR_HISTORY_SORT_KEY = -3
+
+# A run lock lease is renewed by the deletions once it expires within this time
+RUN_LOCK_RENEWAL_SECONDS = 60
+
+# The time to ready history of an application keeps its last TTR_HISTORY_MAX_SAMPLES snapshots. From
+# TTR_HISTORY_MIN_SAMPLES on, the poll timing of a run follows it: first check at half the p50 time to ready. From
+# CADENCE_MIN_SAMPLES snapshots which were not delayed on, a new snapshot is taken no sooner than CADENCE_TTR_FACTOR
+# times their p95 time to ready, or MIN_RECOMMENDED_INTERVAL_SECONDS, after the last one; the nearest-rank p95 of
+# fewer samples is their maximum.
+TTR_HISTORY_MAX_SAMPLES = 50
+TTR_HISTORY_MIN_SAMPLES = 5
+CADENCE_MIN_SAMPLES = 20
+CADENCE_TTR_FACTOR = 2
+MIN_RECOMMENDED_INTERVAL_SECONDS = 60
+MIN_FIRST_PROBE_SECONDS = 0.1
+
+# Points of each shard on the consistent hash ring of the fleet orchestrator, more points even out the shard sizes
+SHARD_RING_VIRTUAL_NODES = 160
+# Time kept by the fleet orchestrator after the last shard worker is done, to merge the shard responses
+ORCHESTRATOR_MARGIN_SECONDS = 2
+# Invocations of shard workers and sends of deletion jobs are attempted at most this many times when throttled
+DISPATCH_MAX_ATTEMPTS = 5
+
+# Inline deletions are checkpointed once per chunk of snapshots, and a checkpoint lists at most
+# RUN_CHECKPOINT_MAX_SNAPSHOTS deleted and not deleted snapshots, which keeps it far below the item size limit
+RUN_CHECKPOINT_INTERVAL = 100
+RUN_CHECKPOINT_MAX_SNAPSHOTS = 2000
+
+# Audit items are written with BatchWriteItem, which takes at most 25 items per call
+AUDIT_BATCH_SIZE = 25
+AUDIT_MAX_ATTEMPTS = 8
+# app_name dimension value of the metrics of the audit writes, which are shared by all applications of a run
+AUDIT_METRICS_APP_NAME = 'all_apps'
+
+# Kinesis Data Analytics calls rejected with these error codes are retried, any other error fails fast. Throttling
+# error codes also cut the rate of the API's token bucket by 30%, which then grows back by 1/20 of its maximum per
+# success.
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'LimitExceededException', 'TooManyRequestsException')
+RETRYABLE_API_ERROR_CODES = THROTTLING_ERROR_CODES + ('ConcurrentModificationException',)
+MIN_API_REQUESTS_PER_SECOND = 0.5
+MAX_API_BACKOFF_SECONDS = 8
+
+# Kinesis Data Analytics APIs, used to report the number of control-plane calls of each run
+KDA_API_NAMES = ('describe_application', 'create_application_snapshot', 'describe_application_snapshot',
+                 'list_application_snapshots', 'delete_application_snapshot')
+
 
 def lambda_handler(event, context):
     """
     AWS Lambda function's handler function. It takes a snapshot of a Kinesis Data Analytics Flink application,
     retains the most recent X number of snapshots, and deletes the rest. For X, see parameter
-    'num_of_older_snapshots_to_retain'. :param event: :param context: :return:
+    'num_of_older_snapshots_to_retain'. When a list of applications is passed through the event key 'app_names' or
+    the environment variable 'app_names', it runs in fleet mode and manages all of them concurrently. With
+    fleet_num_of_shards above 1, the fleet is split into shards instead, each one managed by a worker invocation, see
+    orchestrate_fleet.
+    :param event: :param context: :return:
     """
+    global _cold_start
     print('Running Snapshot Manager. Input event:', json.dumps(event, indent=4))
-    # read environment variables
-    region = os.environ['aws_region']
-    flink_app_name = os.environ['app_name']
-    ddb_table_name = os.environ['snapshot_manager_ddb_table_name']
-    primary_partition_key_name = os.environ['primary_partition_key_name']
-    primary_sort_key_name = os.environ['primary_sort_key_name']
-    sns_topic_arn = os.environ['sns_topic_arn']
-    num_of_older_snapshots_to_retain = int(os.environ['number_of_older_snapshots_to_retain'])
-    snapshot_creation_wait_time_seconds = int(os.environ['snapshot_creation_wait_time_seconds'])
-
-    # setup clients
-    sns = boto3.client('sns', region)
-    dynamodb = boto3.client('dynamodb', region)
-    kinesis_analytics = boto3.client('kinesisanalyticsv2', region)
+    if is_sqs_event(event):
+        if json.loads(event['Records'][0]['body']).get('job_type') == 'snapshot_deletion':
+            return snapshot_deletion_handler(event, context)
+        return snapshot_completion_handler(event, context)
+    config = read_config()
+    # shard workers share the run id of the orchestrator and end before it does
+    fleet_shard = event.get('fleet_shard') if isinstance(event, dict) else None
+    config['run_budget'] = new_run_budget(context, config['deadline_safety_margin_seconds'],
+                                          fleet_shard.get('max_run_seconds') if fleet_shard else None)
+    configure_api_rate_limits(config['kda_api_requests_per_second'], config['kda_api_max_attempts'])
+    flink_app_names = get_flink_app_names(event)
+    cold_start, _cold_start = _cold_start, False
+    # clients reused from a previous invocation are not reported in client_setup_ms
+    known_client_setup_ms = dict(_client_setup_ms)
 
-    # initialize variables
-    deleted_snapshots = []
-    not_deleted_snapshots = []
-    snapshot_deletion_status = {
-        "deleted_snapshots":  deleted_snapshots,
-        "not_deleted_snapshots": not_deleted_snapshots
+    # setup clients, each one is created when it is first used, e.g. no SNS client is created for a run that only
+    # describes a healthy application. With run locks, checkpoints or time to ready history, every run reads its
+    # control records from DynamoDB before the first describe_application, see manage_flink_app_snapshots
+    sns = LazyClient('sns', config['region'])
+    dynamodb = LazyClient('dynamodb', config['region'])
+    kinesis_analytics = LazyClient('kinesisanalyticsv2', config['region'])
+
+    snapshot_manager_run_id = (fleet_shard['snapshot_manager_run_id'] if fleet_shard
+                               else int(round(time.time() * 1000)))
+    print('Snapshot Manager Execution Status. Run Id: {0}'.format(snapshot_manager_run_id))
+
+    if flink_app_names and fleet_shard is None and config['fleet_num_of_shards'] > 1:
+        response_body = orchestrate_fleet(LazyClient('lambda', config['region']), config, flink_app_names,
+                                          snapshot_manager_run_id)
+        response_body['cold_start'] = cold_start
+        response_body['client_setup_ms'] = get_client_setup_ms(known_client_setup_ms)
+        return {'statusCode': 200, 'body': json.dumps(response_body)}
+
+    # audit records of all applications are buffered and written in batches at the end of the run, followed by the
+    # deletion jobs, so that the deletion workers find the audit records they update
+    audit_records = []
+    deletion_jobs = []
+    if flink_app_names is None:
+        start_delay_seconds = get_start_delay_seconds(config, os.environ['app_name'])
+        if start_delay_seconds > 0:
+            print('Starting in {0:.3f} seconds'.format(start_delay_seconds))
+            time.sleep(start_delay_seconds)
+        response_body = manage_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config,
+                                                   os.environ['app_name'], snapshot_manager_run_id, audit_records,
+                                                   deletion_jobs)
+    else:
+        response_body = manage_fleet_snapshots(sns, dynamodb, kinesis_analytics, config, flink_app_names,
+                                               snapshot_manager_run_id, audit_records, deletion_jobs)
+    audit_metrics = new_run_metrics()
+    audit_start_time = time.perf_counter()
+    response_body['audit_status'] = flush_audit_records(dynamodb, config['ddb_table_name'], audit_records,
+                                                        audit_metrics)
+    if response_body['audit_status']['num_of_audit_records_not_written'] == 0:
+        clear_run_checkpoints(dynamodb, config, list(response_body['apps'].values()) if flink_app_names is not None
+                              else [response_body], audit_metrics)
+    release_run_locks(dynamodb, config, list(response_body['apps'].values()) if flink_app_names is not None
+                      else [response_body], audit_metrics)
+    if deletion_jobs:
+        response_body['deletion_queue_status'] = send_deletion_jobs(config, deletion_jobs, audit_metrics)
+    record_phase(audit_metrics, 'audit', get_remaining_budget_seconds(config['run_budget'], True),
+                 time.perf_counter() - audit_start_time)
+    emit_metrics(config['metrics_namespace'], AUDIT_METRICS_APP_NAME, audit_metrics, config['per_app_api_metrics'])
+    response_body['run_budget'] = summarize_run_budget(config['run_budget'], audit_metrics)
+    response_body['cold_start'] = cold_start
+    response_body['client_setup_ms'] = get_client_setup_ms(known_client_setup_ms)
+
+    return_response = {'statusCode': 200, 'body': json.dumps(response_body)}
+    return return_response
+
+
+def snapshot_completion_handler(event, context):
+    """
+    AWS Lambda function's handler function of the deferred completion mode. It is triggered by the delayed SQS
+    messages of the snapshots initiated by lambda_handler. Each message checks one snapshot once: a snapshot which is
+    READY or FAILED completes its run (notification, retention, audit), a snapshot still in progress is checked again
+    with a new delayed message until snapshot_completion_deadline_seconds have passed since it was initiated.
+    Messages which could not be processed are returned as batch item failures, so that only they are retried.
+    :param event: :param context: :return:
+    """
+    config = read_config()
+    config['run_budget'] = new_run_budget(context, config['deadline_safety_margin_seconds'])
+    configure_api_rate_limits(config['kda_api_requests_per_second'], config['kda_api_max_attempts'])
+    sns = LazyClient('sns', config['region'])
+    dynamodb = LazyClient('dynamodb', config['region'])
+    kinesis_analytics = LazyClient('kinesisanalyticsv2', config['region'])
+
+    audit_records = []
+    deletion_jobs = []
+    response_body = {"apps": [], "batchItemFailures": []}
+    records = event.get('Records', [])
+    max_workers = max(1, min(config['fleet_max_workers'], len(records)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(complete_flink_app_snapshot, sns, dynamodb, kinesis_analytics, config,
+                            json.loads(record['body']), audit_records, deletion_jobs): record
+            for record in records
+        }
+        for future in concurrent.futures.as_completed(futures):
+            record = futures[future]
+            try:
+                app_response_body = future.result()
+                if app_response_body is not None:
+                    response_body['apps'].append(app_response_body)
+            except Exception:
+                logger.exception('Snapshot completion failed for message {0}'.format(record['messageId']))
+                response_body['batchItemFailures'].append({"itemIdentifier": record['messageId']})
+    audit_metrics = new_run_metrics()
+    audit_start_time = time.perf_counter()
+    response_body['audit_status'] = flush_audit_records(dynamodb, config['ddb_table_name'], audit_records,
+                                                        audit_metrics)
+    if response_body['audit_status']['num_of_audit_records_not_written'] == 0:
+        clear_run_checkpoints(dynamodb, config, response_body['apps'], audit_metrics)
+    release_run_locks(dynamodb, config, response_body['apps'], audit_metrics)
+    if deletion_jobs:
+        response_body['deletion_queue_status'] = send_deletion_jobs(config, deletion_jobs, audit_metrics)
+    record_phase(audit_metrics, 'audit', get_remaining_budget_seconds(config['run_budget'], True),
+                 time.perf_counter() - audit_start_time)
+    emit_metrics(config['metrics_namespace'], AUDIT_METRICS_APP_NAME, audit_metrics, config['per_app_api_metrics'])
+    response_body['run_budget'] = summarize_run_budget(config['run_budget'], audit_metrics)
+
+    return {'statusCode': 200, 'body': json.dumps(response_body),
+            'batchItemFailures': response_body['batchItemFailures']}
+
+
+def snapshot_deletion_handler(event, context):
+    """
+    AWS Lambda function's handler function of the queued deletion mode. It is triggered by the deletion jobs sent by
+    send_deletion_jobs, each one holding up to snapshot_deletion_job_size expired snapshots of one application, and
+    deletes their snapshots. Deleting a snapshot which is already gone counts as a success, so a job can be retried
+    as a whole. A job with snapshots not deleted because of throttling is returned as a batch item failure and
+    retried by SQS, until it goes to the dead-letter queue. Once a job is done, its counts are added to the audit
+    record of its run. A job which does not fit in the time left before the function timeout is split, see
+    split_deletion_job: the snapshots which fit are deleted and the rest is sent to the queue as a new, smaller job.
+    A job of which not even one snapshot fits is returned as a batch item failure, so that the redrive policy of the
+    queue applies to it.
+    :param event: :param context: :return:
+    """
+    config = read_config()
+    config['run_budget'] = new_run_budget(context, config['deadline_safety_margin_seconds'])
+    configure_api_rate_limits(config['kda_api_requests_per_second'], config['kda_api_max_attempts'])
+    dynamodb = LazyClient('dynamodb', config['region'])
+    kinesis_analytics = LazyClient('kinesisanalyticsv2', config['region'])
+
+    response_body = {"jobs": [], "batchItemFailures": [], "num_of_jobs_postponed": 0, "num_of_jobs_split": 0}
+    for record in event.get('Records', []):
+        try:
+            deletion_job = json.loads(record['body'])
+            num_of_snapshots_to_delete = len(deletion_job['snapshots']['L'])
+            remaining_seconds = get_remaining_budget_seconds(config['run_budget'])
+            if remaining_seconds is not None:
+                num_of_snapshots_to_delete = min(
+                    num_of_snapshots_to_delete, int(remaining_seconds * config['kda_api_requests_per_second']))
+            if num_of_snapshots_to_delete < 1:
+                response_body['batchItemFailures'].append({"itemIdentifier": record['messageId']})
+                response_body['num_of_jobs_postponed'] += 1
+                continue
+            deletion_job, remaining_job = split_deletion_job(deletion_job, num_of_snapshots_to_delete)
+            job_status = run_deletion_job(dynamodb, kinesis_analytics, config, deletion_job)
+            response_body['jobs'].append(job_status)
+            if job_status['retry']:
+                # the whole message is retried, the snapshots of the remaining job included
+                response_body['batchItemFailures'].append({"itemIdentifier": record['messageId']})
+            elif remaining_job is not None:
+                response_body['num_of_jobs_split'] += 1
+                if send_deletion_jobs(config, [remaining_job])['num_of_deletion_jobs_not_sent'] > 0:
+                    response_body['batchItemFailures'].append({"itemIdentifier": record['messageId']})
+        except Exception:
+            logger.exception('Snapshot deletion failed for message {0}'.format(record['messageId']))
+            response_body['batchItemFailures'].append({"itemIdentifier": record['messageId']})
+
+    return {'statusCode': 200, 'body': json.dumps(response_body),
+            'batchItemFailures': response_body['batchItemFailures']}
+
+
+def is_sqs_event(event):
+    """
+    This function tells whether an invocation event is a batch of SQS messages
+    :param event:
+    :return:
+    """
+    records = event.get('Records') if isinstance(event, dict) else None
+    return bool(records) and records[0].get('eventSource') == 'aws:sqs'
+
+
+def read_config():
+    """
+    This function reads the Snapshot Manager settings from the environment variables
+    :return:
+    """
+    return {
+        "region": os.environ['aws_region'],
+        "ddb_table_name": os.environ['snapshot_manager_ddb_table_name'],
+        "primary_partition_key_name": os.environ['primary_partition_key_name'],
+        "primary_sort_key_name": os.environ['primary_sort_key_name'],
+        "sns_topic_arn": os.environ['sns_topic_arn'],
+        "num_of_older_snapshots_to_retain": int(os.environ['number_of_older_snapshots_to_retain']),
+        "snapshot_creation_wait_time_seconds": int(os.environ['snapshot_creation_wait_time_seconds']),
+        "snapshot_first_probe_seconds": float(os.environ.get('snapshot_first_probe_seconds', 1)),
+        "snapshot_completion_deadline_seconds": float(os.environ.get(
+            'snapshot_completion_deadline_seconds', 4 * int(os.environ['snapshot_creation_wait_time_seconds']))),
+        "fleet_max_workers": int(os.environ.get('fleet_max_workers', 10)),
+        # fleet split into shards managed by worker invocations of fleet_shard_function_name, see orchestrate_fleet
+        "fleet_num_of_shards": int(os.environ.get('fleet_num_of_shards', 1)),
+        "fleet_shard_function_name": os.environ.get('fleet_shard_function_name',
+                                                    os.environ.get('AWS_LAMBDA_FUNCTION_NAME', '')),
+        "fleet_shard_max_workers": int(os.environ.get('fleet_shard_max_workers', 50)),
+        # runs start at an offset derived from the application name within stagger_window_seconds, plus a random
+        # jitter, see get_start_delay_seconds
+        "stagger_window_seconds": float(os.environ.get('stagger_window_seconds', 0)),
+        "stagger_jitter_seconds": float(os.environ.get('stagger_jitter_seconds', 0)),
+        "retention_policy": read_retention_policy(),
+        "metrics_namespace": os.environ.get('metrics_namespace', 'SnapshotManager'),
+        # per API and per phase metrics also have the app_name dimension, i.e. some 40 custom metrics per application
+        "per_app_api_metrics": os.environ.get('per_app_api_metrics', 'false').lower() == 'true',
+        # metrics are returned in the response body of local runs, i.e. outside of AWS Lambda
+        "include_metrics_in_response": os.environ.get(
+            'include_metrics_in_response', str('AWS_LAMBDA_FUNCTION_NAME' not in os.environ)).lower() == 'true',
+        "snapshot_deletion_max_workers": int(os.environ.get('snapshot_deletion_max_workers', 5)),
+        # inline: wait for the new snapshot in the same invocation, deferred: check it from a delayed queue message
+        "completion_mode": os.environ.get('completion_mode', 'inline').lower(),
+        "snapshot_completion_queue_url": os.environ.get('snapshot_completion_queue_url', ''),
+        "snapshot_completion_delay_seconds": int(os.environ.get(
+            'snapshot_completion_delay_seconds', os.environ['snapshot_creation_wait_time_seconds'])),
+        # inline: delete expired snapshots in the run, queued: send them as deletion jobs to a queue drained by
+        # snapshot_deletion_handler
+        "deletion_mode": os.environ.get('deletion_mode', 'inline').lower(),
+        "snapshot_deletion_queue_url": os.environ.get('snapshot_deletion_queue_url', ''),
+        "snapshot_deletion_job_size": int(os.environ.get('snapshot_deletion_job_size', 100)),
+        # progress of inline runs is checkpointed, so that the next run resumes a run that timed out
+        "run_checkpoints": os.environ.get('run_checkpoints', 'true').lower() == 'true',
+        "run_checkpoint_max_age_seconds": int(os.environ.get('run_checkpoint_max_age_seconds', 3600)),
+        # time to ready of the last snapshots of each application, and the poll timing and cadence derived from it,
+        # see summarize_ttr_history
+        "ttr_history": os.environ.get('ttr_history', 'true').lower() == 'true',
+        "adaptive_cadence": os.environ.get('adaptive_cadence', 'true').lower() == 'true',
+        # only one run of an application at a time, see acquire_run_lock
+        "run_locks": os.environ.get('run_locks', 'true').lower() == 'true',
+        "run_lock_lease_seconds": int(os.environ.get('run_lock_lease_seconds', 900)),
+        # time kept free before the function timeout for the audit writes, see new_run_budget
+        "deadline_safety_margin_seconds": float(os.environ.get('deadline_safety_margin_seconds', 5)),
+        # set by the handlers from the Lambda context
+        "run_budget": None,
+        "kda_api_requests_per_second": float(os.environ.get('kda_api_requests_per_second', 10)),
+        # snapshot_deletion_max_attempts is the former name of the setting, when deletions were the only retried calls
+        "kda_api_max_attempts": int(os.environ.get('kda_api_max_attempts',
+                                                   os.environ.get('snapshot_deletion_max_attempts', 6)))
     }
-    snapshot_manager_run_id = int(round(time.time() * 1000))
-    snapshot_name = 'custom_' + str(snapshot_manager_run_id)
-    response_body = {
-        "app_name": flink_app_name,
-        "app_version": "",
+
+
+def read_retention_policy():
+    """
+    This function reads the snapshot retention policy from the environment variables. Only the number of most recent
+    snapshots to retain is required; the hourly, daily and weekly tiers and the pinned snapshots are optional.
+    :return:
+    """
+    pinned_snapshot_names = os.environ.get('pinned_snapshot_names', '')
+    return {
+        "num_of_recent_snapshots": int(os.environ['number_of_older_snapshots_to_retain']),
+        "num_of_hourly_snapshots": int(os.environ.get('number_of_hourly_snapshots_to_retain', 0)),
+        "num_of_daily_snapshots": int(os.environ.get('number_of_daily_snapshots_to_retain', 0)),
+        "num_of_weekly_snapshots": int(os.environ.get('number_of_weekly_snapshots_to_retain', 0)),
+        "pinned_snapshot_names": frozenset(name.strip() for name in pinned_snapshot_names.split(',') if name.strip())
+    }
+
+
+def get_client(service_name, region):
+    """
+    This function returns a cached AWS client for the given service and region. The client is created on first use
+    with a connection pool large enough for fleet mode and TCP keep-alive enabled.
+    :param service_name:
+    :param region:
+    :return:
+    """
+    key = (service_name, region)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client_setup_start = time.perf_counter()
+                import boto3
+                import botocore.config
+                # Kinesis Data Analytics calls are retried by call_aws_api, in step with the rate limiter
+                # shard worker invocations are not retried, and can take up to the 15 minutes Lambda timeout
+                client_config = botocore.config.Config(
+                    max_pool_connections=int(os.environ.get('client_max_pool_connections', 50)),
+                    tcp_keepalive=True,
+                    read_timeout=900 if service_name == 'lambda' else 60,
+                    retries={'mode': 'standard',
+                             'max_attempts': 1 if service_name in ('kinesisanalyticsv2', 'lambda') else 3}
+                )
+                client = boto3.client(service_name, region, config=client_config)
+                _clients[key] = client
+                _client_setup_ms[service_name] = round((time.perf_counter() - client_setup_start) * 1000, 3)
+    return client
+
+
+def get_client_setup_ms(known_client_setup_ms):
+    """
+    This function returns the time taken to create each client, in milliseconds, for the clients created since
+    known_client_setup_ms was copied from _client_setup_ms, e.g. at the start of an invocation
+    :param known_client_setup_ms:
+    :return:
+    """
+    return {service_name: setup_ms for service_name, setup_ms in _client_setup_ms.items()
+            if known_client_setup_ms.get(service_name) != setup_ms}
+
+
+class LazyClient:
+    """
+    Stands in for the AWS client of a service and region and gets it from get_client when one of its methods is
+    first used
+    """
+
+    def __init__(self, service_name, region):
+        self.service_name = service_name
+        self.region = region
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client = get_client(self.service_name, self.region)
+        return getattr(self._client, name)
+
+
+def register_client(service_name, region, client):
+    """
+    This function registers a client for the given service and region, e.g. a stub client for tests. Passing None
+    removes the cached client so that a new one is created on next use.
+    :param service_name:
+    :param region:
+    :param client:
+    :return:
+    """
+    with _clients_lock:
+        if client is None:
+            _clients.pop((service_name, region), None)
+        else:
+            _clients[(service_name, region)] = client
+
+
+def get_flink_app_names(event):
+    """
+    This function returns the list of applications to be managed in fleet mode. The list is read from the event key
+    'app_names' first and then from the comma separated environment variable 'app_names'. It returns None when
+    neither is set, i.e. when a single application is managed through the environment variable 'app_name'.
+    :param event:
+    :return:
+    """
+    app_names = None
+    if isinstance(event, dict) and event.get('app_names'):
+        app_names = event['app_names']
+        if isinstance(app_names, str):
+            app_names = app_names.split(',')
+    elif os.environ.get('app_names'):
+        app_names = os.environ['app_names'].split(',')
+    if app_names is None:
+        return None
+    # remove blanks and duplicates while keeping the order
+    return list(dict.fromkeys(app_name.strip() for app_name in app_names if app_name.strip()))
+
+
+def manage_fleet_snapshots(sns, dynamodb, kin_analytics, config, flink_app_names, snapshot_manager_run_id,
+                           audit_records, deletion_jobs=None):
+    """
+    This function manages the snapshots of a fleet of Flink applications concurrently using a bounded worker pool.
+    Each application gets its own section in the response body and its own audit record. Applications are handed
+    to the pool at their start delays, see get_start_delay_seconds, so that a waiting application holds no worker.
+    :param sns:
+    :param dynamodb:
+    :param kin_analytics:
+    :param config:
+    :param flink_app_names:
+    :param snapshot_manager_run_id:
+    :param audit_records:
+    :param deletion_jobs:
+    :return:
+    """
+    fleet_response_body = {
         "snapshot_manager_run_id": snapshot_manager_run_id,
-        "new_snapshot_name": snapshot_name,
-        "app_is_running": True,
-        "app_is_healthy": True,
-        "new_snapshot_initiated": False,
-        "new_snapshot_completed": False,
-        "new_snapshot_creation_delayed": False,
-        "old_snapshots_to_be_deleted": False,
-        "num_of_snapshot_deleted": 0,
-        "num_of_snapshot_not_deleted": 0
+        "num_of_apps": len(flink_app_names),
+        "num_of_apps_failed": 0,
+        "kda_api_calls": 0,
+        "apps": {}
     }
-    print('Snapshot Manager Execution Status. Run Id: {0}'.format(snapshot_manager_run_id))
+    if not flink_app_names:
+        logger.info('No applications to manage.')
+        return fleet_response_body
+
+    start_delays = {flink_app_name: get_start_delay_seconds(config, flink_app_name)
+                    for flink_app_name in flink_app_names}
+    max_workers = max(1, min(config['fleet_max_workers'], len(flink_app_names)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        fleet_start_time = time.monotonic()
+        for flink_app_name in sorted(flink_app_names, key=start_delays.get):
+            wait_seconds = fleet_start_time + start_delays[flink_app_name] - time.monotonic()
+            if wait_seconds > 0:
+                time.sleep(wait_seconds)
+            futures[executor.submit(manage_flink_app_snapshots, sns, dynamodb, kin_analytics, config, flink_app_name,
+                                    snapshot_manager_run_id, audit_records, deletion_jobs)] = flink_app_name
+        for future in concurrent.futures.as_completed(futures):
+            flink_app_name = futures[future]
+            try:
+                fleet_response_body['apps'][flink_app_name] = future.result()
+            except Exception as error:
+                # one failing application must not stop the rest of the fleet
+                logger.exception('Snapshot Manager failed for application {0}'.format(flink_app_name))
+                fleet_response_body['num_of_apps_failed'] += 1
+                fleet_response_body['apps'][flink_app_name] = {
+                    "app_name": flink_app_name,
+                    "snapshot_manager_run_id": snapshot_manager_run_id,
+                    "error_message": str(error)
+                }
+                audit_records.append({
+                    config['primary_partition_key_name']: {'S': flink_app_name},
+                    config['primary_sort_key_name']: {'N': str(snapshot_manager_run_id)},
+                    'run_outcome': {'S': 'error'},
+                    'run_date': {'S': get_run_date(snapshot_manager_run_id)},
+                    'error_message': {'S': str(error)}
+                })
+    # keep the response in the same order as the input list
+    fleet_response_body['apps'] = {name: fleet_response_body['apps'][name] for name in flink_app_names}
+    fleet_response_body['kda_api_calls'] = sum(app_response_body.get('kda_api_calls', 0)
+                                               for app_response_body in fleet_response_body['apps'].values())
+    return fleet_response_body
+
+
+def get_app_schedule_offset(flink_app_name, interval_seconds):
+    """
+    This function returns the phase offset of an application within a schedule interval, in seconds. It is derived
+    from the application name, so an application always gets the same offset, and the offsets of a fleet are spread
+    evenly over the interval. The offset within a minute long interval is the remainder of the offset within any
+    interval of whole minutes, which lets a cron rule at the minute of the offset leave the seconds to the function.
+    :param flink_app_name:
+    :param interval_seconds:
+    :return:
+    """
+    interval_ms = int(interval_seconds * 1000)
+    if interval_ms <= 0:
+        return 0.0
+    return get_ring_hash(flink_app_name) % interval_ms / 1000
+
+
+def get_start_delay_seconds(config, flink_app_name):
+    """
+    This function returns the time a run waits before it starts managing an application: the offset of the
+    application within stagger_window_seconds, see get_app_schedule_offset, plus a random jitter of up to
+    stagger_jitter_seconds. Runs started by one schedule then reach the Kinesis Data Analytics control plane spread
+    over the window instead of all at once. The delay never takes more than half of the run budget left.
+    :param config:
+    :param flink_app_name:
+    :return:
+    """
+    start_delay_seconds = get_app_schedule_offset(flink_app_name, config['stagger_window_seconds'])
+    if config['stagger_jitter_seconds'] > 0:
+        start_delay_seconds += random.uniform(0, config['stagger_jitter_seconds'])
+    remaining_seconds = get_remaining_budget_seconds(config['run_budget'])
+    if remaining_seconds is not None:
+        start_delay_seconds = min(start_delay_seconds, remaining_seconds / 2)
+    return start_delay_seconds
+
+
+def build_shard_ring(num_of_shards, virtual_nodes=SHARD_RING_VIRTUAL_NODES):
+    """
+    This function builds the consistent hash ring of the fleet shards: virtual_nodes points per shard, sorted by
+    hash. An application belongs to the shard of the first point at or after its own hash, so adding applications
+    moves none of the others, and adding a shard only moves the applications it takes over.
+    :param num_of_shards:
+    :param virtual_nodes:
+    :return:
+    """
+    return sorted((get_ring_hash('shard-{0}-{1}'.format(shard_id, virtual_node)), shard_id)
+                  for shard_id in range(num_of_shards) for virtual_node in range(virtual_nodes))
+
+
+def get_ring_hash(key):
+    """
+    This function returns the position of a key on the shard ring. It is stable across processes, unlike hash().
+    :param key:
+    :return:
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def assign_fleet_shards(flink_app_names, num_of_shards):
+    """
+    This function splits a fleet into shards by consistent hashing, see build_shard_ring. It returns one list of
+    applications per shard, in the order of the input list; a shard can be empty.
+    :param flink_app_names:
+    :param num_of_shards:
+    :return:
+    """
+    shard_ring = build_shard_ring(num_of_shards)
+    ring_hashes = [ring_hash for ring_hash, _ in shard_ring]
+    shards = [[] for _ in range(num_of_shards)]
+    for flink_app_name in flink_app_names:
+        ring_index = bisect.bisect_left(ring_hashes, get_ring_hash(flink_app_name)) % len(shard_ring)
+        shards[shard_ring[ring_index][1]].append(flink_app_name)
+    return shards
+
+
+def orchestrate_fleet(lambda_client, config, flink_app_names, snapshot_manager_run_id):
+    """
+    This function manages a fleet too large for one invocation. It splits the fleet into fleet_num_of_shards shards
+    by consistent hashing, invokes fleet_shard_function_name once per shard, concurrently and synchronously, with the
+    applications of the shard, and merges the shard responses into one fleet summary. The workers run in fleet mode
+    and write the audit records, so the summary only keeps the run outcome of each application. A shard whose
+    dispatch raises counts as failed, with the error as its error message, and the other shards are still merged.
+    :param lambda_client:
+    :param config:
+    :param flink_app_names:
+    :param snapshot_manager_run_id:
+    :return:
+    """
+    shards = [(shard_id, shard_app_names) for shard_id, shard_app_names
+              in enumerate(assign_fleet_shards(flink_app_names, config['fleet_num_of_shards'])) if shard_app_names]
+    remaining_seconds = get_remaining_budget_seconds(config['run_budget'], True)
+    max_run_seconds = (round(max(0.0, remaining_seconds - ORCHESTRATOR_MARGIN_SECONDS), 3)
+                       if remaining_seconds is not None else None)
+    print('Dispatching {0} applications to {1} shards'.format(len(flink_app_names), len(shards)))
+
+    shard_responses = {}
+    max_workers = max(1, min(config['fleet_shard_max_workers'], len(shards)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(dispatch_fleet_shard, lambda_client, config['fleet_shard_function_name'], {
+                "app_names": shard_app_names,
+                "fleet_shard": {
+                    "shard_id": shard_id,
+                    "num_of_shards": config['fleet_num_of_shards'],
+                    "snapshot_manager_run_id": snapshot_manager_run_id,
+                    "max_run_seconds": max_run_seconds
+                }
+            }): shard_id
+            for shard_id, shard_app_names in shards
+        }
+        for future in concurrent.futures.as_completed(futures):
+            shard_id = futures[future]
+            try:
+                shard_responses[shard_id] = future.result()
+            except Exception as error:
+                # one failing shard must not lose the responses of the others
+                logger.exception('Dispatch of shard {0} failed'.format(shard_id))
+                shard_responses[shard_id] = {
+                    "shard_id": shard_id,
+                    "num_of_apps": len(dict(shards)[shard_id]),
+                    "duration_seconds": None,
+                    "body": None,
+                    "error_message": str(error)
+                }
+    return merge_shard_responses(snapshot_manager_run_id, flink_app_names, shards, shard_responses)
+
+
+def dispatch_fleet_shard(lambda_client, function_name, shard_event):
+    """
+    This function invokes a shard worker and waits for its response. Invocations throttled by Lambda are retried
+    with backoff, up to DISPATCH_MAX_ATTEMPTS attempts. A worker which fails, cannot be invoked or cannot be reached,
+    e.g. a read timeout, or which returns a payload that cannot be decoded, gives a response with the error message.
+    Such errors are not retried, as the worker may still be running. It returns the shard response.
+    :param lambda_client:
+    :param function_name:
+    :param shard_event:
+    :return:
+    """
+    shard_response = {
+        "shard_id": shard_event['fleet_shard']['shard_id'],
+        "num_of_apps": len(shard_event['app_names']),
+        "duration_seconds": None,
+        "body": None,
+        "error_message": None
+    }
+    start_time = time.perf_counter()
+    attempt = 0
+    while attempt < DISPATCH_MAX_ATTEMPTS:
+        if attempt > 0:
+            time.sleep(random.uniform(0, min(2, 0.05 * 2 ** attempt)))
+        attempt += 1
+        try:
+            response = lambda_client.invoke(FunctionName=function_name, InvocationType='RequestResponse',
+                                            Payload=json.dumps(shard_event).encode('utf-8'))
+            payload = json.loads(response['Payload'].read())
+            if response.get('FunctionError'):
+                shard_response['error_message'] = payload.get('errorMessage', response['FunctionError'])
+            else:
+                shard_response['body'] = json.loads(payload['body'])
+            break
+        except botocore.exceptions.ClientError as error:
+            shard_response['error_message'] = error.response['Error']['Message']
+            if error.response['Error']['Code'] not in THROTTLING_ERROR_CODES:
+                break
+        except (botocore.exceptions.BotoCoreError, ValueError, KeyError, TypeError) as error:
+            shard_response['error_message'] = '{0}: {1}'.format(type(error).__name__, error)
+            break
+    shard_response['duration_seconds'] = round(time.perf_counter() - start_time, 3)
+    if shard_response['error_message'] is not None and shard_response['body'] is None:
+        logger.error('Shard {0} failed: {1}'.format(shard_response['shard_id'], shard_response['error_message']))
+    return shard_response
+
+
+def merge_shard_responses(snapshot_manager_run_id, flink_app_names, shards, shard_responses):
+    """
+    This function merges the responses of the shard workers into one fleet summary. The applications of a failed
+    shard count as failed, with the outcome shard_failed.
+    :param snapshot_manager_run_id:
+    :param flink_app_names:
+    :param shards:
+    :param shard_responses:
+    :return:
+    """
+    fleet_response_body = {
+        "snapshot_manager_run_id": snapshot_manager_run_id,
+        "num_of_apps": len(flink_app_names),
+        "num_of_apps_failed": 0,
+        "kda_api_calls": 0,
+        "num_of_shards": len(shards),
+        "num_of_shards_failed": 0,
+        "shards": [],
+        "run_outcomes": {},
+        "apps": {}
+    }
+    app_outcomes = {}
+    for shard_id, shard_app_names in shards:
+        shard_response = shard_responses[shard_id]
+        shard_body = shard_response['body']
+        fleet_response_body['shards'].append({name: value for name, value in shard_response.items() if name != 'body'})
+        if shard_body is None:
+            fleet_response_body['num_of_shards_failed'] += 1
+            fleet_response_body['num_of_apps_failed'] += len(shard_app_names)
+            app_outcomes.update(dict.fromkeys(shard_app_names, 'shard_failed'))
+            continue
+        fleet_response_body['num_of_apps_failed'] += shard_body.get('num_of_apps_failed', 0)
+        fleet_response_body['kda_api_calls'] += shard_body.get('kda_api_calls', 0)
+        for flink_app_name, app_response_body in shard_body['apps'].items():
+            app_outcomes[flink_app_name] = app_response_body.get('run_outcome', 'error')
+    fleet_response_body['apps'] = {name: app_outcomes.get(name, 'shard_failed') for name in flink_app_names}
+    for run_outcome in fleet_response_body['apps'].values():
+        fleet_response_body['run_outcomes'][run_outcome] = fleet_response_body['run_outcomes'].get(run_outcome, 0) + 1
+    return fleet_response_body
+
+
+def manage_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config, flink_app_name, snapshot_manager_run_id,
+                               audit_records, deletion_jobs=None):
+    """
+    This function takes a snapshot of a Kinesis Data Analytics Flink application, retains the most recent X number
+    of snapshots, and deletes the rest. It returns the execution status of the application and adds its audit
+    items to audit_records, whatever the outcome. In queued deletion mode, the snapshots to delete are added to
+    deletion_jobs instead; without a deletion_jobs list they are deleted in the run. If the application has the
+    checkpoint of a run that did not finish, that run is resumed instead, and no new snapshot is taken. If another
+    run of the application holds its run lock, the function returns at once with the run outcome run_locked, and
+    nothing is recorded. With adaptive cadence, the poll timing of the run follows the time to ready history of the
+    application, and once the history has enough snapshots which were not delayed, the run is skipped, with the run
+    outcome cadence_skipped, while the last snapshot is more recent than the recommended interval.
+    :param sns:
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param flink_app_name:
+    :param snapshot_manager_run_id:
+    :param audit_records:
+    :param deletion_jobs:
+    :return:
+    """
+    sns_topic_arn = config['sns_topic_arn']
+
+    # initialize variables
+    response_body = new_response_body(flink_app_name, snapshot_manager_run_id)
+    snapshot_name = response_body['new_snapshot_name']
+    latest_snapshot = None
+    run_metrics = new_run_metrics()
+
+    # an overlapping run of the application, e.g. a retry or a manual trigger, exits before any other call
+    if config['run_locks']:
+        run_lock = acquire_run_lock(dynamodb, config, flink_app_name, snapshot_manager_run_id, run_metrics)
+        if run_lock['is_held_by_another_run']:
+            print('Another run of application {0} is in progress, exiting'.format(flink_app_name))
+            response_body['run_locked'] = True
+            response_body['run_outcome'] = get_run_outcome(response_body)
+            return response_body
+        response_body['run_lock_fencing_token'] = run_lock['fencing_token']
+        response_body['run_lock_expires_at'] = run_lock['lease_expires_at']
+
+    # resume the previous run if it stopped before writing its audit record, e.g. because the function timed out
+    if config['run_checkpoints']:
+        run_checkpoint = get_run_checkpoint(dynamodb, config, flink_app_name, run_metrics)
+        checkpoint_age_seconds = time.time() - run_checkpoint['checkpoint_time'] / 1000 if run_checkpoint else None
+        if run_checkpoint is not None and checkpoint_age_seconds < config['run_checkpoint_max_age_seconds']:
+            run_checkpoint['run_lock_fencing_token'] = response_body.get('run_lock_fencing_token')
+            run_checkpoint['run_lock_expires_at'] = response_body.get('run_lock_expires_at')
+            return resume_flink_app_run(sns, dynamodb, kinesis_analytics, config, run_checkpoint, run_metrics,
+                                        audit_records, deletion_jobs)
+
+    # slow applications are snapshotted less often, and every application is polled at its own pace
+    ttr_samples = None
+    if config['ttr_history']:
+        ttr_samples = get_ttr_history(dynamodb, config, flink_app_name, run_metrics)
+        ttr_summary = summarize_ttr_history(ttr_samples, config)
+        response_body['ttr_history'] = ttr_summary
+        if config['adaptive_cadence'] and ttr_summary['is_cadence_adaptive']:
+            seconds_since_last_snapshot = time.time() - ttr_samples[-1]['initiated_at'] / 1000
+            if seconds_since_last_snapshot < ttr_summary['recommended_interval_seconds']:
+                print('Last snapshot of application {0} taken {1:.0f} seconds ago, skipping the run'.format(
+                    flink_app_name, seconds_since_last_snapshot))
+                response_body['cadence_skipped'] = True
+                response_body['run_outcome'] = get_run_outcome(response_body)
+                audit_records.append({
+                    config['primary_partition_key_name']: {'S': flink_app_name},
+                    config['primary_sort_key_name']: {'N': str(snapshot_manager_run_id)},
+                    'run_outcome': {'S': response_body['run_outcome']},
+                    'run_date': {'S': get_run_date(snapshot_manager_run_id)}
+                })
+                return response_body
+        if config['adaptive_cadence'] and ttr_summary['is_adaptive']:
+            config = dict(config, **ttr_summary['poll_settings'])
 
     # describe application to get application status and current version
-    response = describe_flink_application(kinesis_analytics, flink_app_name)
-    response_body['app_version'] = response['ApplicationDetail']['ApplicationVersionId']
+    response = describe_flink_application(kinesis_analytics, flink_app_name, run_metrics)
+    if response is not None:
+        response_body['app_version'] = response['ApplicationDetail']['ApplicationVersionId']
 
     # If application is running then takes a snapshot
-    if response['ApplicationDetail']['ApplicationStatus'] == 'RUNNING':
-        snapshot_creation_res = take_app_snapshot(kinesis_analytics, flink_app_name, snapshot_name)
+    if response is None:
+        response_body['app_is_described'] = False
+        response_body['app_is_running'] = False
+        error_message = """
+                    Application Team:
+
+                    Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been taken.
+                    The application {1} could not be described.
+                    """.format(snapshot_manager_run_id, flink_app_name)
+
+        print(error_message)
+        notify_error(sns, sns_topic_arn, error_message, run_metrics)
+    elif response['ApplicationDetail']['ApplicationStatus'] == 'RUNNING':
+        snapshot_creation_res = take_app_snapshot(kinesis_analytics, flink_app_name, snapshot_name, run_metrics)
         if snapshot_creation_res['is_initiated']:
             response_body['new_snapshot_initiated'] = True
+            response_body['new_snapshot_initiated_at'] = int(time.time() * 1000)
+        elif snapshot_creation_res['error_code'] in THROTTLING_ERROR_CODES:
+            # a throttled request says nothing about the health of the application
+            error_message = """
+                    Application Team:
+
+                    Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been taken.
+                    The snapshot request of application {1} has been throttled.
+                    """.format(snapshot_manager_run_id, flink_app_name)
+
+            print(error_message)
+            notify_error(sns, sns_topic_arn, error_message, run_metrics)
         else:
             response_body['app_is_healthy'] = False
     else:
@@ -78,105 +873,923 @@ def lambda_handler(event, context):
         error_message = """
                     Application Team:
 
-                    Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been taken.
-                    The application {1} is not running.
-                    """.format(snapshot_manager_run_id, flink_app_name)
+                    Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been taken.
+                    The application {1} is not running.
+                    """.format(snapshot_manager_run_id, flink_app_name)
+
+        print(error_message)
+        notify_error(sns, sns_topic_arn, error_message, run_metrics)
+
+    # If application is not healthy then send a notification
+    if not response_body['app_is_healthy']:
+        error_message = """
+                            Application Team:
+
+                            Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been 
+                            taken. The application {1} may not be healthy.""".format(snapshot_manager_run_id, flink_app_name)
+
+        print(error_message)
+        notify_error(sns, sns_topic_arn, error_message, run_metrics)
+
+    # In deferred completion mode, the snapshot is checked by a later invocation triggered by a delayed queue message
+    if response_body['new_snapshot_initiated'] and config['completion_mode'] == 'deferred':
+        response_body['new_snapshot_completion_deferred'] = defer_snapshot_completion(
+            config, response_body, response_body['new_snapshot_initiated_at'], 0, run_metrics)
+
+    # If new snapshot creation initiated then wait until it is completed or failed
+    if response_body['new_snapshot_initiated'] and not response_body.get('new_snapshot_completion_deferred'):
+        if config['run_checkpoints']:
+            response_body['run_checkpointed'] = save_run_checkpoint(dynamodb, config, response_body,
+                                                                    'snapshot_initiated', None, run_metrics)
+        snapshot_completion = wait_for_new_snapshot(dynamodb, kinesis_analytics, config, response_body, run_metrics)
+        response_body['new_snapshot_wait_seconds'] = snapshot_completion['wait_time_seconds']
+        if snapshot_completion['snapshot_status'] == 'READY':
+            latest_snapshot = snapshot_completion['snapshot']
+            response_body['new_snapshot_completed'] = True
+            print(response_body)
+        elif snapshot_completion['snapshot_status'] == 'FAILED':
+            print("Snapshot creation has failed")
+            response_body['new_snapshot_failed'] = True
+        elif not response_body.get('new_snapshot_completion_deferred'):
+            print("Snapshot creation has been delayed")
+            response_body['new_snapshot_creation_delayed'] = True
+
+    return finish_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config, response_body, latest_snapshot,
+                                      run_metrics, audit_records, deletion_jobs, ttr_samples=ttr_samples)
+
+
+def new_response_body(flink_app_name, snapshot_manager_run_id):
+    """
+    This function returns the initial execution status of an application for a Snapshot Manager run
+    :param flink_app_name:
+    :param snapshot_manager_run_id:
+    :return:
+    """
+    return {
+        "app_name": flink_app_name,
+        "app_version": "",
+        "snapshot_manager_run_id": snapshot_manager_run_id,
+        "new_snapshot_name": 'custom_' + str(snapshot_manager_run_id),
+        "app_is_described": True,
+        "app_is_running": True,
+        "app_is_healthy": True,
+        "new_snapshot_initiated": False,
+        "new_snapshot_completed": False,
+        "new_snapshot_creation_delayed": False,
+        "new_snapshot_failed": False,
+        "old_snapshots_to_be_deleted": False,
+        "num_of_snapshot_deleted": 0,
+        "num_of_snapshot_not_deleted": 0,
+        "num_of_snapshots_queued_for_deletion": 0
+    }
+
+
+def finish_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config, response_body, latest_snapshot, run_metrics,
+                               audit_records, deletion_jobs=None, snapshot_deletion_status=None, ttr_samples=None):
+    """
+    This function completes a Snapshot Manager run of an application once the status of its new snapshot is known,
+    or once the check has been deferred: it sends the notifications, records the latest restorable snapshot, applies
+    the retention policy, adds the audit items of the run to audit_records and emits the run metrics. It returns the
+    execution status of the application. Inline deletions are checkpointed chunk by chunk; a resumed run passes the
+    deletions of the interrupted run in snapshot_deletion_status. The time to ready of a completed or delayed
+    snapshot is added to the history of the application, read again unless passed in ttr_samples, unless it was not
+    observed, i.e. new_snapshot_wait_seconds is None.
+    :param sns:
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param response_body:
+    :param latest_snapshot:
+    :param run_metrics:
+    :param audit_records:
+    :param deletion_jobs:
+    :param snapshot_deletion_status:
+    :param ttr_samples:
+    :return:
+    """
+    primary_partition_key_name = config['primary_partition_key_name']
+    primary_sort_key_name = config['primary_sort_key_name']
+    sns_topic_arn = config['sns_topic_arn']
+    num_of_older_snapshots_to_retain = config['num_of_older_snapshots_to_retain']
+    flink_app_name = response_body['app_name']
+    snapshot_manager_run_id = response_body['snapshot_manager_run_id']
+    snapshot_name = response_body['new_snapshot_name']
+
+    # initialize variables
+    if snapshot_deletion_status is None:
+        snapshot_deletion_status = {
+            "deleted_snapshots": [],
+            "not_deleted_snapshots": []
+        }
+    deleted_snapshots = snapshot_deletion_status['deleted_snapshots']
+    not_deleted_snapshots = snapshot_deletion_status['not_deleted_snapshots']
+
+    # a run resumed after its deletions started has already sent its notification
+    notify_planned_seconds = get_remaining_budget_seconds(config['run_budget'])
+    notify_start_time = time.perf_counter()
+    if response_body['new_snapshot_completed'] and response_body.get('resumed_from_phase') != 'deleting':
+        send_sns_notification(sns, sns_topic_arn, flink_app_name, snapshot_manager_run_id, snapshot_name,
+                              latest_snapshot, True, run_metrics)
+        response_body['latest_snapshot_record_updated'] = update_latest_snapshot_record(
+            dynamodb, config['ddb_table_name'], primary_partition_key_name, primary_sort_key_name,
+            flink_app_name, snapshot_manager_run_id, latest_snapshot, response_body['new_snapshot_wait_seconds'],
+            run_metrics)
+
+    # If newly initiated snapshot is not completed on time or failed then send a notification
+    if response_body['new_snapshot_creation_delayed'] or response_body['new_snapshot_failed']:
+        send_sns_notification(sns, sns_topic_arn, flink_app_name, snapshot_manager_run_id, snapshot_name, None, False,
+                              run_metrics)
+    if (config['ttr_history'] and response_body.get('resumed_from_phase') != 'deleting' and
+            response_body.get('new_snapshot_wait_seconds') is not None and
+            (response_body['new_snapshot_completed'] or response_body['new_snapshot_creation_delayed'])):
+        record_ttr_sample(dynamodb, config, response_body, ttr_samples, run_metrics)
+    record_phase(run_metrics, 'notify', notify_planned_seconds, time.perf_counter() - notify_start_time)
+
+    # The snapshot inventory is listed once per run, only when a new snapshot has been added. It is streamed page by
+    # page into the retention selector, which keeps the X most recent snapshots and hands the older ones to the
+    # deletion workers as soon as they are found.
+    if response_body['new_snapshot_completed']:
+        snapshot_inventory_status = {"num_of_snapshots": 0}
+        snapshot_inventory = iter_snapshot_inventory(kinesis_analytics, flink_app_name, response_body['app_version'],
+                                                     latest_snapshot, snapshot_inventory_status, run_metrics)
+        retention_policy = config['retention_policy']
+        if is_tiered_retention_policy(retention_policy):
+            # hourly, daily and weekly tiers and pinned snapshots need the whole inventory sorted by creation time
+            sorted_snapshot_inventory = sorted(snapshot_inventory, key=lambda k: k['SnapshotCreationTimestamp'],
+                                               reverse=True)
+            retention_plan = plan_snapshot_retention(sorted_snapshot_inventory, retention_policy,
+                                                     latest_snapshot['SnapshotName'])
+            snapshots_to_be_deleted = retention_plan['snapshots_to_delete']
+            response_body['num_of_snapshots_retained_by_tier'] = retention_plan['num_of_snapshots_retained_by_tier']
+        else:
+            snapshots_to_be_deleted = select_snapshots_to_delete(snapshot_inventory, num_of_older_snapshots_to_retain,
+                                                                 latest_snapshot['SnapshotName'])
+        if config['deletion_mode'] == 'queued' and config['snapshot_deletion_queue_url'] and deletion_jobs is not None:
+            # the snapshots are deleted by snapshot_deletion_handler, after the audit record of the run is written
+            snapshots_to_be_deleted = list(snapshots_to_be_deleted)
+            deletion_jobs.extend(build_deletion_jobs(flink_app_name, snapshot_manager_run_id, snapshots_to_be_deleted,
+                                                     config['snapshot_deletion_job_size']))
+            response_body['num_of_snapshots_queued_for_deletion'] = len(snapshots_to_be_deleted)
+            snapshot_deletion_status['num_of_retries'] = 0
+        else:
+            delete_snapshots_within_budget(dynamodb, kinesis_analytics, config, response_body,
+                                           snapshots_to_be_deleted, snapshot_deletion_status, run_metrics)
+        response_body['num_of_snapshots'] = snapshot_inventory_status['num_of_snapshots']
+        num_of_snapshots_to_be_deleted = (len(deleted_snapshots) + len(not_deleted_snapshots) +
+                                          response_body['num_of_snapshots_queued_for_deletion'])
+        response_body['old_snapshots_to_be_deleted'] = num_of_snapshots_to_be_deleted > 0
+        response_body['num_of_snapshot_deleted'] = len(deleted_snapshots)
+        response_body['num_of_snapshot_not_deleted'] = len(not_deleted_snapshots)
+        response_body['num_of_snapshot_deletion_retries'] = snapshot_deletion_status.get('num_of_retries', 0)
+
+    if not response_body['old_snapshots_to_be_deleted']:
+        logger.info('Number of historical snapshots less than the threshold. No need to delete any snapshots.')
+
+    # Tracking
+    response_body['api_throttled'] = run_metrics['api_throttled']
+    response_body['run_outcome'] = get_run_outcome(response_body)
+    audit_records.extend(build_snapshot_manager_status_items(
+        primary_partition_key_name, primary_sort_key_name, response_body,
+        latest_snapshot if response_body['new_snapshot_completed'] else None, snapshot_deletion_status))
+
+    response_body['api_calls'] = run_metrics['api_calls']
+    response_body['phases'] = run_metrics['phases']
+    response_body['kda_api_calls'] = sum(count for api_name, count in run_metrics['api_calls'].items()
+                                         if api_name in KDA_API_NAMES)
+    if response_body['new_snapshot_completed'] and response_body.get('new_snapshot_wait_seconds') is not None:
+        run_metrics['snapshot_time_to_ready_seconds'] = response_body['new_snapshot_wait_seconds']
+    run_metrics['num_of_snapshot_deleted'] = response_body['num_of_snapshot_deleted']
+    emit_metrics(config['metrics_namespace'], flink_app_name, run_metrics, config['per_app_api_metrics'])
+    if config['include_metrics_in_response']:
+        response_body['metrics'] = summarize_run_metrics(run_metrics)
+    return response_body
+
+
+def defer_snapshot_completion(config, response_body, snapshot_initiated_at, num_of_checks, run_metrics=None):
+    """
+    This function sends the delayed SQS message which triggers the next check of a new snapshot in deferred
+    completion mode. The message holds what the check needs to resume the run. It returns True if the message has
+    been sent.
+    :param config:
+    :param response_body:
+    :param snapshot_initiated_at: epoch milliseconds
+    :param num_of_checks:
+    :param run_metrics:
+    :return:
+    """
+    if not config['snapshot_completion_queue_url']:
+        logger.warning('No snapshot_completion_queue_url configured, waiting for the snapshot instead')
+        return False
+    message = {
+        "app_name": response_body['app_name'],
+        "app_version": response_body['app_version'],
+        "snapshot_manager_run_id": response_body['snapshot_manager_run_id'],
+        "snapshot_name": response_body['new_snapshot_name'],
+        "snapshot_initiated_at": snapshot_initiated_at,
+        "num_of_checks": num_of_checks
+    }
+    sqs = get_client('sqs', config['region'])
+    try:
+        call_aws_api(run_metrics, sqs.send_message, QueueUrl=config['snapshot_completion_queue_url'],
+                     MessageBody=json.dumps(message),
+                     DelaySeconds=max(0, min(MAX_SQS_DELAY_SECONDS, config['snapshot_completion_delay_seconds'])))
+        logger.info('Check of snapshot {0} deferred'.format(response_body['new_snapshot_name']))
+        return True
+    except botocore.exceptions.ClientError as error:
+        print('Error Message: {}'.format(error.response['Error']['Message']))
+    return False
+
+
+def complete_flink_app_snapshot(sns, dynamodb, kinesis_analytics, config, message, audit_records, deletion_jobs=None):
+    """
+    This function checks a snapshot initiated in deferred completion mode, from the message sent by
+    defer_snapshot_completion, and completes its run once the snapshot is READY or FAILED or the completion deadline
+    has passed. It returns the execution status of the application, or None if the check has been deferred again.
+    :param sns:
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param message:
+    :param audit_records:
+    :param deletion_jobs:
+    :return:
+    """
+    run_metrics = new_run_metrics()
+    response_body = new_response_body(message['app_name'], message['snapshot_manager_run_id'])
+    response_body['app_version'] = message['app_version']
+    response_body['new_snapshot_initiated'] = True
+    response_body['new_snapshot_initiated_at'] = message['snapshot_initiated_at']
+    response_body['new_snapshot_completion_deferred'] = True
+    latest_snapshot = None
+
+    # the run lock is taken on behalf of the run of the snapshot; while another run holds it, the check is deferred
+    if config['run_locks']:
+        run_lock = acquire_run_lock(dynamodb, config, message['app_name'], message['snapshot_manager_run_id'],
+                                    run_metrics)
+        if run_lock['is_held_by_another_run']:
+            if defer_snapshot_completion(config, response_body, message['snapshot_initiated_at'],
+                                         message['num_of_checks'], run_metrics):
+                return None
+            raise RuntimeError('Check of snapshot {0} could not be deferred'.format(message['snapshot_name']))
+        response_body['run_lock_fencing_token'] = run_lock['fencing_token']
+        response_body['run_lock_expires_at'] = run_lock['lease_expires_at']
+
+    snapshot = get_flink_app_snapshot(kinesis_analytics, message['app_name'], message['snapshot_name'], run_metrics)
+    snapshot_status = snapshot['SnapshotStatus'] if snapshot is not None else None
+    wait_time_seconds = round(time.time() - message['snapshot_initiated_at'] / 1000, 3)
+    response_body['new_snapshot_wait_seconds'] = wait_time_seconds
+    response_body['new_snapshot_checks'] = message['num_of_checks'] + 1
+    if snapshot_status == 'READY':
+        latest_snapshot = snapshot
+        response_body['new_snapshot_completed'] = True
+    elif snapshot_status == 'FAILED':
+        print("Snapshot creation has failed")
+        response_body['new_snapshot_failed'] = True
+    elif wait_time_seconds < config['snapshot_completion_deadline_seconds']:
+        if defer_snapshot_completion(config, response_body, message['snapshot_initiated_at'],
+                                     message['num_of_checks'] + 1, run_metrics):
+            release_run_locks(dynamodb, config, [response_body], run_metrics)
+            return None
+        # the message could not be sent, the SQS message being processed is retried instead
+        raise RuntimeError('Next check of snapshot {0} could not be deferred'.format(message['snapshot_name']))
+    else:
+        print("Snapshot creation has been delayed")
+        response_body['new_snapshot_creation_delayed'] = True
+
+    return finish_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config, response_body, latest_snapshot,
+                                      run_metrics, audit_records, deletion_jobs)
+
+
+def resume_flink_app_run(sns, dynamodb, kinesis_analytics, config, run_checkpoint, run_metrics, audit_records,
+                         deletion_jobs=None):
+    """
+    This function resumes a run of an application from its checkpoint (see save_run_checkpoint), under the run id of
+    the interrupted run. The snapshot of that run is checked again rather than taking a new one, and waited for until
+    snapshot_completion_deadline_seconds have passed since it was initiated. The run is then finished as usual,
+    starting from the deletions already done, and the inventory is listed again to find the snapshots left to
+    delete. It returns the execution status of the application.
+    :param sns:
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param run_checkpoint:
+    :param run_metrics:
+    :param audit_records:
+    :param deletion_jobs:
+    :return:
+    """
+    flink_app_name = run_checkpoint['app_name']
+    snapshot_name = run_checkpoint['snapshot_name']
+    print('Resuming run {0} of application {1} from phase {2}'.format(
+        run_checkpoint['snapshot_manager_run_id'], flink_app_name, run_checkpoint['phase']))
+    response_body = new_response_body(flink_app_name, run_checkpoint['snapshot_manager_run_id'])
+    response_body['app_version'] = run_checkpoint['app_version']
+    response_body['new_snapshot_name'] = snapshot_name
+    response_body['new_snapshot_initiated'] = True
+    response_body['new_snapshot_initiated_at'] = run_checkpoint['snapshot_initiated_at']
+    response_body['resumed_from_phase'] = run_checkpoint['phase']
+    response_body['run_checkpointed'] = True
+    response_body['run_lock_fencing_token'] = run_checkpoint.get('run_lock_fencing_token')
+    response_body['run_lock_expires_at'] = run_checkpoint.get('run_lock_expires_at')
+    latest_snapshot = None
+
+    snapshot = get_flink_app_snapshot(kinesis_analytics, flink_app_name, snapshot_name, run_metrics)
+    snapshot_status = snapshot['SnapshotStatus'] if snapshot is not None else None
+    response_body['new_snapshot_checks'] = 1
+    if snapshot_status not in ('READY', 'FAILED'):
+        snapshot_completion = wait_for_new_snapshot(dynamodb, kinesis_analytics, config, response_body, run_metrics)
+        snapshot_status = snapshot_completion['snapshot_status']
+        snapshot = snapshot_completion['snapshot']
+    # the time to ready is only known if the interrupted run saw the snapshot READY. Otherwise the time since it was
+    # initiated is only an upper bound, which is neither recorded as the time to ready of the snapshot nor added to
+    # the history of the application, while the time waited for a delayed snapshot is a lower bound, as usual.
+    response_body['new_snapshot_wait_seconds'] = run_checkpoint.get('new_snapshot_wait_seconds')
+    if snapshot_status not in ('READY', 'FAILED') and response_body['new_snapshot_wait_seconds'] is None:
+        response_body['new_snapshot_wait_seconds'] = round(
+            time.time() - run_checkpoint['snapshot_initiated_at'] / 1000, 3)
+    if snapshot_status == 'READY':
+        latest_snapshot = snapshot
+        response_body['new_snapshot_completed'] = True
+    elif snapshot_status == 'FAILED':
+        print("Snapshot creation has failed")
+        response_body['new_snapshot_failed'] = True
+    elif not response_body.get('new_snapshot_completion_deferred'):
+        print("Snapshot creation has been delayed")
+        response_body['new_snapshot_creation_delayed'] = True
+
+    snapshot_deletion_status = {
+        "deleted_snapshots": run_checkpoint['snapshots_deleted'],
+        "not_deleted_snapshots": run_checkpoint['snapshots_failed_to_be_deleted']
+    }
+    return finish_flink_app_snapshots(sns, dynamodb, kinesis_analytics, config, response_body, latest_snapshot,
+                                      run_metrics, audit_records, deletion_jobs, snapshot_deletion_status)
+
+
+def wait_for_new_snapshot(dynamodb, kinesis_analytics, config, response_body, run_metrics):
+    """
+    This function waits inline for the new snapshot of a run, until snapshot_completion_deadline_seconds have passed
+    since it was initiated or the run budget is used up, whichever comes first. If the budget runs out first, the
+    snapshot is handed over rather than reported as delayed: to the deferred completion queue if there is one,
+    otherwise to the next run, which resumes the run from its checkpoint. The run is then pending. It returns the
+    outcome of wait_for_snapshot_completion.
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param response_body:
+    :param run_metrics:
+    :return:
+    """
+    deadline_seconds = max(0.0, config['snapshot_completion_deadline_seconds'] - (
+        time.time() - response_body['new_snapshot_initiated_at'] / 1000))
+    remaining_seconds = get_remaining_budget_seconds(config['run_budget'])
+    planned_seconds = deadline_seconds if remaining_seconds is None else min(deadline_seconds, remaining_seconds)
+    snapshot_completion = wait_for_snapshot_completion(
+        kinesis_analytics, response_body['app_name'], response_body['new_snapshot_name'],
+        config['snapshot_first_probe_seconds'], config['snapshot_creation_wait_time_seconds'], planned_seconds,
+        run_metrics)
+    record_phase(run_metrics, 'poll', planned_seconds, snapshot_completion['wait_time_seconds'])
+    response_body['new_snapshot_checks'] = (response_body.get('new_snapshot_checks', 0) +
+                                            snapshot_completion['num_of_checks'])
+    if snapshot_completion['snapshot_status'] == 'TIMED_OUT' and planned_seconds < deadline_seconds:
+        logger.warning('Run budget used up while waiting for snapshot {0}'.format(response_body['new_snapshot_name']))
+        response_body['run_budget_exhausted'] = True
+        if config['snapshot_completion_queue_url'] and defer_snapshot_completion(
+                config, response_body, response_body['new_snapshot_initiated_at'],
+                response_body['new_snapshot_checks'], run_metrics):
+            response_body['new_snapshot_completion_deferred'] = True
+        elif config['run_checkpoints'] and save_run_checkpoint(dynamodb, config, response_body, 'snapshot_initiated',
+                                                               None, run_metrics):
+            # the checkpoint is kept for the next run
+            response_body['new_snapshot_completion_deferred'] = True
+            response_body['run_suspended'] = True
+    return snapshot_completion
+
+
+def wait_for_snapshot_completion(kin_analytics, flink_app_name, snapshot_name, first_probe_seconds, max_wait_seconds,
+                                 deadline_seconds, run_metrics=None):
+    """
+    This function waits until a snapshot is READY or FAILED. The first check runs after a short probe interval, the
+    following ones back off exponentially with jitter up to max_wait_seconds between checks, and the function gives
+    up once deadline_seconds have passed. It returns as soon as the snapshot reaches a final status.
+    :param kin_analytics:
+    :param flink_app_name:
+    :param snapshot_name:
+    :param first_probe_seconds:
+    :param max_wait_seconds:
+    :param deadline_seconds:
+    :param run_metrics:
+    :return:
+    """
+    snapshot_completion = {
+        "snapshot_status": "TIMED_OUT",
+        "snapshot": None,
+        "num_of_checks": 0,
+        "wait_time_seconds": 0
+    }
+    start_time = time.monotonic()
+    deadline = start_time + deadline_seconds
+    max_wait_seconds = max(max_wait_seconds, first_probe_seconds)
+    wait_seconds = first_probe_seconds
+    while True:
+        remaining_seconds = deadline - time.monotonic()
+        if remaining_seconds <= 0:
+            break
+        time.sleep(min(wait_seconds, remaining_seconds))
+        snapshot_completion['num_of_checks'] += 1
+        snapshot = get_flink_app_snapshot(kin_analytics, flink_app_name, snapshot_name, run_metrics)
+        if snapshot is None:
+            print('No snapshot found with the name: {0}'.format(snapshot_name))
+        elif snapshot['SnapshotStatus'] in ('READY', 'FAILED'):
+            snapshot_completion['snapshot_status'] = snapshot['SnapshotStatus']
+            snapshot_completion['snapshot'] = snapshot
+            break
+        # exponential backoff with jitter, capped by max_wait_seconds
+        backoff_seconds = min(max_wait_seconds, first_probe_seconds * 2 ** snapshot_completion['num_of_checks'])
+        wait_seconds = random.uniform(first_probe_seconds, backoff_seconds)
+    snapshot_completion['wait_time_seconds'] = round(time.monotonic() - start_time, 3)
+    return snapshot_completion
+
+
+def is_tiered_retention_policy(retention_policy):
+    """
+    This function checks if a retention policy has hourly, daily or weekly tiers or pinned snapshots, i.e. if it
+    needs more than the number of most recent snapshots to retain
+    :param retention_policy:
+    :return:
+    """
+    return (retention_policy['num_of_hourly_snapshots'] > 0 or retention_policy['num_of_daily_snapshots'] > 0 or
+            retention_policy['num_of_weekly_snapshots'] > 0 or len(retention_policy['pinned_snapshot_names']) > 0)
+
+
+def plan_snapshot_retention(sorted_snapshots, retention_policy, new_snapshot_name=None):
+    """
+    This function splits the snapshots into the ones to keep and the ones to delete according to a tiered
+    (grandfather-father-son) retention policy, in a single pass over the snapshots sorted by creation time, most
+    recent first. A snapshot is kept if it is one of the X most recent ones, if it is pinned, or if it is the most
+    recent snapshot of one of the N most recent hours, M most recent days or W most recent ISO weeks (UTC) that have
+    a snapshot. The new snapshot is always kept.
+    :param sorted_snapshots:
+    :param retention_policy:
+    :param new_snapshot_name:
+    :return:
+    """
+    retention_plan = {
+        "snapshots_to_keep": [],
+        "snapshots_to_delete": [],
+        "num_of_snapshots_retained_by_tier": {"recent": 0, "hourly": 0, "daily": 0, "weekly": 0, "pinned": 0}
+    }
+    retained_by_tier = retention_plan['num_of_snapshots_retained_by_tier']
+    num_of_recent_snapshots = retention_policy['num_of_recent_snapshots']
+    pinned_snapshot_names = retention_policy['pinned_snapshot_names']
+    # tier name, number of buckets to keep, bucket size in seconds, bucket offset in seconds
+    # the offset aligns weekly buckets with ISO weeks, since 1970-01-01 was a Thursday
+    tiers = [
+        ('hourly', retention_policy['num_of_hourly_snapshots'], 3600, 0),
+        ('daily', retention_policy['num_of_daily_snapshots'], 86400, 0),
+        ('weekly', retention_policy['num_of_weekly_snapshots'], 7 * 86400, 3 * 86400)
+    ]
+    tiers = [tier for tier in tiers if tier[1] > 0]
+    last_bucket_by_tier = {}
+    for position, snapshot in enumerate(sorted_snapshots):
+        keep = False
+        if position < num_of_recent_snapshots:
+            retained_by_tier['recent'] += 1
+            keep = True
+        if tiers:
+            snapshot_time = snapshot['SnapshotCreationTimestamp']
+            epoch_seconds = snapshot_time.timestamp() if isinstance(snapshot_time, datetime.datetime) else snapshot_time
+            for tier_name, num_of_buckets, bucket_seconds, offset_seconds in tiers:
+                bucket = (epoch_seconds + offset_seconds) // bucket_seconds
+                if bucket != last_bucket_by_tier.get(tier_name):
+                    # the first snapshot of a bucket is its most recent one
+                    last_bucket_by_tier[tier_name] = bucket
+                    retained_by_tier[tier_name] += 1
+                    keep = True
+            # tiers that have all their buckets are not evaluated any more
+            tiers = [tier for tier in tiers if retained_by_tier[tier[0]] < tier[1]]
+        if snapshot['SnapshotName'] in pinned_snapshot_names or snapshot['SnapshotName'] == new_snapshot_name:
+            if not keep:
+                retained_by_tier['pinned'] += 1
+            keep = True
+        if keep:
+            retention_plan['snapshots_to_keep'].append(snapshot)
+        else:
+            retention_plan['snapshots_to_delete'].append(snapshot)
+    return retention_plan
+
+
+def iter_snapshot_inventory(kin_analytics, flink_app_name, app_ver_id, new_snapshot, snapshot_inventory_status,
+                            run_metrics=None):
+    """
+    This function streams the snapshots of the given application version, listed once. The new snapshot is added
+    at the end if the listing does not show it yet. The number of snapshots is counted in snapshot_inventory_status.
+    :param kin_analytics:
+    :param flink_app_name:
+    :param app_ver_id:
+    :param new_snapshot:
+    :param snapshot_inventory_status:
+    :param run_metrics:
+    :return:
+    """
+    new_snapshot_listed = False
+    for snapshot in iter_flink_app_snapshots(kin_analytics, flink_app_name, app_ver_id, run_metrics):
+        new_snapshot_listed = new_snapshot_listed or snapshot['SnapshotName'] == new_snapshot['SnapshotName']
+        snapshot_inventory_status['num_of_snapshots'] += 1
+        yield snapshot
+    if not new_snapshot_listed:
+        snapshot_inventory_status['num_of_snapshots'] += 1
+        yield new_snapshot
+
+
+def select_snapshots_to_delete(snapshots, num_of_snapshots_to_retain, new_snapshot_name=None):
+    """
+    This function streams the snapshots to be deleted, i.e. all but the num_of_snapshots_to_retain most recent ones.
+    The most recent snapshots seen so far are kept in a bounded min-heap, so memory stays proportional to
+    num_of_snapshots_to_retain and an older snapshot is yielded as soon as it falls out of the heap. The snapshots
+    are yielded in no particular order. The new snapshot is never yielded, like in plan_snapshot_retention, so that
+    the latest restorable snapshot recorded by the run is not deleted even with num_of_snapshots_to_retain at 0.
+    :param snapshots:
+    :param num_of_snapshots_to_retain:
+    :param new_snapshot_name:
+    :return:
+    """
+    snapshots_to_retain = []
+    # the position breaks ties between snapshots with the same creation time
+    for position, snapshot in enumerate(snapshots):
+        entry = (snapshot['SnapshotCreationTimestamp'], position, snapshot)
+        if len(snapshots_to_retain) < num_of_snapshots_to_retain:
+            heapq.heappush(snapshots_to_retain, entry)
+        else:
+            snapshot_to_delete = heapq.heappushpop(snapshots_to_retain, entry)[2]
+            if snapshot_to_delete['SnapshotName'] != new_snapshot_name:
+                yield snapshot_to_delete
+
+
+def get_flink_app_snapshot(kin_analytics, flink_app_name, snapshot_name, run_metrics=None):
+    """
+    This function describes a single snapshot of a Kinesis Data Analytics Flink Application. Unlike
+    list_flink_app_snapshots, its cost does not depend on the number of snapshots the application has. It returns
+    None if the snapshot is not found.
+    :param kin_analytics:
+    :param flink_app_name:
+    :param snapshot_name:
+    :param run_metrics:
+    :return:
+    """
+    snapshot = None
+    try:
+        res = call_aws_api(run_metrics, kin_analytics.describe_application_snapshot, ApplicationName=flink_app_name,
+                           SnapshotName=snapshot_name)
+        snapshot = res['SnapshotDetails']
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ResourceNotFoundException':
+            logger.warning('The requested snapshot {0} was not found'.format(snapshot_name))
+        else:
+            print('Error Message: {}'.format(error.response['Error']['Message']))
+    return snapshot
+
+
+def new_run_budget(context, safety_margin_seconds, max_seconds=None):
+    """
+    This function returns the time budget of an invocation, from the time left before the function timeout as told
+    by the Lambda context, or max_seconds if that is sooner. The phases of a run (poll, notify, delete, audit) are
+    planned against it, and safety_margin_seconds of it are kept for the audit writes at the end. Without a Lambda
+    context or max_seconds, e.g. in local runs, there is no deadline.
+    :param context:
+    :param safety_margin_seconds:
+    :param max_seconds:
+    :return:
+    """
+    remaining_seconds = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    if max_seconds is not None:
+        remaining_seconds = max_seconds if remaining_seconds is None else min(remaining_seconds, max_seconds)
+    return {
+        "deadline": time.monotonic() + remaining_seconds if remaining_seconds is not None else None,
+        "remaining_seconds_at_start": remaining_seconds,
+        "safety_margin_seconds": safety_margin_seconds
+    }
+
+
+def get_remaining_budget_seconds(run_budget, include_safety_margin=False):
+    """
+    This function returns the time left for work in a run budget, i.e. until the deadline minus the safety margin,
+    or until the deadline with include_safety_margin. It returns None if there is no deadline.
+    :param run_budget:
+    :param include_safety_margin:
+    :return:
+    """
+    if run_budget is None or run_budget['deadline'] is None:
+        return None
+    remaining_seconds = run_budget['deadline'] - time.monotonic()
+    if not include_safety_margin:
+        remaining_seconds -= run_budget['safety_margin_seconds']
+    return max(0.0, remaining_seconds)
+
+
+def record_phase(run_metrics, phase_name, planned_seconds, used_seconds):
+    """
+    This function records the time planned for a phase of a run, i.e. the budget it was given (None without a
+    deadline), and the time it used
+    :param run_metrics:
+    :param phase_name:
+    :param planned_seconds:
+    :param used_seconds:
+    :return:
+    """
+    phase = run_metrics['phases'].setdefault(phase_name, {"planned_seconds": None, "used_seconds": 0.0})
+    if phase['planned_seconds'] is None and planned_seconds is not None:
+        phase['planned_seconds'] = round(planned_seconds, 3)
+    phase['used_seconds'] = round(phase['used_seconds'] + used_seconds, 3)
+
+
+def summarize_run_budget(run_budget, run_metrics):
+    """
+    This function summarizes the time budget of an invocation at its end, with the phases recorded in run_metrics
+    :param run_budget:
+    :param run_metrics:
+    :return:
+    """
+    remaining_seconds = get_remaining_budget_seconds(run_budget, True)
+    return {
+        "remaining_seconds_at_start": run_budget['remaining_seconds_at_start'],
+        "remaining_seconds_at_end": round(remaining_seconds, 3) if remaining_seconds is not None else None,
+        "safety_margin_seconds": run_budget['safety_margin_seconds'],
+        "phases": run_metrics['phases']
+    }
+
+
+def new_run_metrics():
+    """
+    This function returns an empty set of run metrics. API calls, errors and latencies are keyed by the API name.
+    :return:
+    """
+    return {
+        "api_calls": {},
+        "api_errors": {},
+        "api_latency_ms": {},
+        "api_throttles": {},
+        "api_retries": 0,
+        "api_throttled": False,
+        "rate_limiter_wait_seconds": 0.0,
+        "phases": {}
+    }
+
+
+def call_aws_api(run_metrics, api_method, **kwargs):
+    """
+    This function calls an AWS API and records the call, its latency and its error, if any, in run_metrics, keyed by
+    the API name. Kinesis Data Analytics calls first take a token from the API's rate limiter. When they are rejected
+    with a code of RETRYABLE_API_ERROR_CODES, they are retried with exponential backoff and jitter, up to the
+    configured maximum attempts; any other error is raised right away. api_throttled is set in run_metrics when a
+    call still throttles after its last attempt.
+    :param run_metrics:
+    :param api_method:
+    :param kwargs:
+    :return:
+    """
+    api_name = api_method.__name__
+    if api_name not in KDA_API_NAMES:
+        return call_aws_api_once(run_metrics, api_method, api_name, **kwargs)
+    attempt = 0
+    while True:
+        attempt += 1
+        wait_seconds = acquire_api_token(api_name)
+        if run_metrics is not None and wait_seconds > 0:
+            with _run_metrics_lock:
+                run_metrics['rate_limiter_wait_seconds'] += wait_seconds
+        try:
+            response = call_aws_api_once(run_metrics, api_method, api_name, **kwargs)
+            record_api_outcome(api_name, throttled=False)
+            return response
+        except botocore.exceptions.ClientError as error:
+            error_code = error.response['Error']['Code']
+            if error_code not in RETRYABLE_API_ERROR_CODES:
+                raise
+            throttled = error_code in THROTTLING_ERROR_CODES
+            if throttled:
+                record_api_outcome(api_name, throttled=True)
+            if run_metrics is not None:
+                with _run_metrics_lock:
+                    if throttled:
+                        run_metrics['api_throttles'][api_name] = run_metrics['api_throttles'].get(api_name, 0) + 1
+                    if attempt >= _rate_limit_settings['max_attempts']:
+                        run_metrics['api_throttled'] = run_metrics['api_throttled'] or throttled
+                    else:
+                        run_metrics['api_retries'] += 1
+            if attempt >= _rate_limit_settings['max_attempts']:
+                raise
+            logger.info('{0} rejected with {1}, retrying'.format(api_name, error_code))
+            time.sleep(random.uniform(0, min(MAX_API_BACKOFF_SECONDS, 0.1 * 2 ** attempt)))
+
+
+def call_aws_api_once(run_metrics, api_method, api_name, **kwargs):
+    """
+    This function makes a single AWS API call and records it in run_metrics, see call_aws_api
+    :param run_metrics:
+    :param api_method:
+    :param api_name:
+    :param kwargs:
+    :return:
+    """
+    if run_metrics is None:
+        return api_method(**kwargs)
+    failed = False
+    start_time = time.perf_counter()
+    try:
+        return api_method(**kwargs)
+    except botocore.exceptions.ClientError:
+        failed = True
+        raise
+    finally:
+        latency_ms = round((time.perf_counter() - start_time) * 1000, 3)
+        with _run_metrics_lock:
+            run_metrics['api_calls'][api_name] = run_metrics['api_calls'].get(api_name, 0) + 1
+            if failed:
+                run_metrics['api_errors'][api_name] = run_metrics['api_errors'].get(api_name, 0) + 1
+            latencies = run_metrics['api_latency_ms'].setdefault(api_name, [])
+            if len(latencies) < MAX_LATENCY_SAMPLES_PER_API:
+                latencies.append(latency_ms)
+
+
+def configure_api_rate_limits(requests_per_second, max_attempts):
+    """
+    This function sets the maximum rate of each Kinesis Data Analytics API and the maximum attempts per call. Token
+    buckets already in use keep their state and are capped at the new rate.
+    :param requests_per_second:
+    :param max_attempts:
+    :return:
+    """
+    with _rate_limiters_lock:
+        _rate_limit_settings['requests_per_second'] = max(MIN_API_REQUESTS_PER_SECOND, requests_per_second)
+        _rate_limit_settings['max_attempts'] = max(1, max_attempts)
+        for rate_limiter in _rate_limiters.values():
+            rate_limiter['max_rate'] = _rate_limit_settings['requests_per_second']
+            rate_limiter['rate'] = min(rate_limiter['rate'], rate_limiter['max_rate'])
+
 
-        print(error_message)
-        notify_error(sns, sns_topic_arn, error_message)
+def acquire_api_token(api_name):
+    """
+    This function takes a token from the token bucket of an API, waiting until one is available. A bucket holds up
+    to one second worth of tokens at the maximum rate, and at least one token so that a rate below one request per
+    second still lets calls through, and refills at the current rate. It returns the time waited in seconds.
+    :param api_name:
+    :return:
+    """
+    waited_seconds = 0.0
+    while True:
+        with _rate_limiters_lock:
+            now = time.monotonic()
+            rate_limiter = _rate_limiters.get(api_name)
+            if rate_limiter is None:
+                max_rate = _rate_limit_settings['requests_per_second']
+                rate_limiter = {"max_rate": max_rate, "rate": max_rate, "tokens": max(1.0, max_rate), "updated": now}
+                _rate_limiters[api_name] = rate_limiter
+            refill = (now - rate_limiter['updated']) * rate_limiter['rate']
+            rate_limiter['tokens'] = min(max(1.0, rate_limiter['max_rate']), rate_limiter['tokens'] + refill)
+            rate_limiter['updated'] = now
+            if rate_limiter['tokens'] >= 1:
+                rate_limiter['tokens'] -= 1
+                return waited_seconds
+            wait_seconds = (1 - rate_limiter['tokens']) / rate_limiter['rate']
+        time.sleep(wait_seconds)
+        waited_seconds += wait_seconds
 
-    # If application is not healthy then send a notification
-    if not response_body['app_is_healthy']:
-        error_message = """
-                            Application Team:
 
-                            Snapshot Manager execution completed. Run Id: {0}. However, a new snapshot has not been 
-                            taken. The application {1} may not be healthy.""".format(snapshot_manager_run_id, flink_app_name)
+def record_api_outcome(api_name, throttled):
+    """
+    This function adapts the rate of an API's token bucket: a throttled call cuts it by 30% and empties the bucket, a
+    successful one adds 1/20 of the maximum rate back
+    :param api_name:
+    :param throttled:
+    :return:
+    """
+    with _rate_limiters_lock:
+        rate_limiter = _rate_limiters.get(api_name)
+        if rate_limiter is None:
+            return
+        if throttled:
+            rate_limiter['rate'] = max(MIN_API_REQUESTS_PER_SECOND, rate_limiter['rate'] * 0.7)
+            rate_limiter['tokens'] = min(rate_limiter['tokens'], 0.0)
+        elif rate_limiter['rate'] < rate_limiter['max_rate']:
+            rate_limiter['rate'] = min(rate_limiter['max_rate'], rate_limiter['rate'] + rate_limiter['max_rate'] / 20)
 
-        print(error_message)
-        notify_error(sns, sns_topic_arn, error_message)
-
-    # If new snapshot creation initiated then check if it is completed
-    max_checks = 4
-    checks_done = 0
-    if response_body['new_snapshot_initiated']:
-        while checks_done < max_checks:
-            time.sleep(snapshot_creation_wait_time_seconds)
-            snapshots = list_flink_app_snapshots(kinesis_analytics, flink_app_name, response_body['app_version'])
-            print('Application {0} of version {1} has {2} snapshots: '.format(flink_app_name,
-                                                                              response_body['app_version'],
-                                                                              len(snapshots)))
-            sorted_snapshots = sorted(snapshots, key=lambda k: k['SnapshotCreationTimestamp'], reverse=True)
-            latest_snapshot = sorted_snapshots[0]
-            if latest_snapshot['SnapshotName'] == snapshot_creation_res['snapshot_name']:
-                if latest_snapshot['SnapshotStatus'] == 'READY':
-                    checks_done = 4
-                    response_body['new_snapshot_completed'] = True
-                    print(response_body)
-                    send_sns_notification(sns, sns_topic_arn, flink_app_name, snapshot_manager_run_id, snapshot_name,
-                                          latest_snapshot, True)
-                else:
-                    checks_done += 1
-            else:
-                print('No snapshot found with the name: {0}'.format(snapshot_creation_res['snapshot_name']))
 
-    if checks_done == 4 and not response_body['new_snapshot_completed']:
-        print("Snapshot creation has been delayed")
-        response_body['new_snapshot_creation_delayed'] = True
+def summarize_run_metrics(run_metrics):
+    """
+    This function summarizes run metrics: calls, errors, latency percentiles and a latency histogram per API, plus
+    retries, snapshot time-to-ready and deletion throughput
+    :param run_metrics:
+    :return:
+    """
+    api_summary = {}
+    for api_name, num_of_calls in run_metrics['api_calls'].items():
+        latencies = sorted(run_metrics['api_latency_ms'].get(api_name, []))
+        histogram = {}
+        for latency_ms in latencies:
+            bucket = next((upper_bound for upper_bound in LATENCY_HISTOGRAM_BUCKETS_MS if latency_ms <= upper_bound),
+                          None)
+            bucket_name = 'le_{0}ms'.format(bucket) if bucket is not None else 'gt_{0}ms'.format(
+                LATENCY_HISTOGRAM_BUCKETS_MS[-1])
+            histogram[bucket_name] = histogram.get(bucket_name, 0) + 1
+        api_summary[api_name] = {
+            "calls": num_of_calls,
+            "errors": run_metrics['api_errors'].get(api_name, 0),
+            "throttles": run_metrics['api_throttles'].get(api_name, 0),
+            "p50_ms": latencies[int(0.5 * (len(latencies) - 1))] if latencies else None,
+            "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            "max_ms": latencies[-1] if latencies else None,
+            "latency_histogram": histogram
+        }
+    run_summary = {
+        "apis": api_summary,
+        "api_retries": run_metrics['api_retries'],
+        "api_throttled": run_metrics['api_throttled'],
+        "rate_limiter_wait_seconds": round(run_metrics['rate_limiter_wait_seconds'], 3),
+        "snapshot_time_to_ready_seconds": run_metrics.get('snapshot_time_to_ready_seconds'),
+        "snapshot_deletions_per_second": None,
+        "phases": run_metrics['phases']
+    }
+    if run_metrics.get('snapshot_deletion_seconds'):
+        run_summary['snapshot_deletions_per_second'] = round(
+            run_metrics.get('num_of_snapshot_deleted', 0) / run_metrics['snapshot_deletion_seconds'], 3)
+    return run_summary
 
-    # If newly initiated snapshot is not completed on time then send a notification
-    if response_body['new_snapshot_creation_delayed']:
-        send_sns_notification(sns, sns_topic_arn, flink_app_name, snapshot_manager_run_id, snapshot_name, None, False)
-    
-    if response_body['new_snapshot_completed']:
-        num_of_snapshots_after_new_snapshot = list_flink_app_snapshots(kinesis_analytics, flink_app_name,
-                                                                       response['ApplicationDetail'][
-                                                                           'ApplicationVersionId'])
-        # check if the number of old snapshots exceeds the threshold.
-        if len(num_of_snapshots_after_new_snapshot) > num_of_older_snapshots_to_retain:
-            response_body['old_snapshots_to_be_deleted'] = True
-
-    # initiate old snapshot deletion process
-    if response_body['old_snapshots_to_be_deleted']:
-        sorted_snapshots_after_new_snapshots = sorted(num_of_snapshots_after_new_snapshot,
-                                                      key=lambda k: k['SnapshotCreationTimestamp'], reverse=True)
-        snapshots_to_be_deleted = sorted_snapshots_after_new_snapshots[num_of_older_snapshots_to_retain:None]
-        for snapshot_to_be_deleted in snapshots_to_be_deleted:
-            snapshot_deleted = delete_snapshot(kinesis_analytics, flink_app_name, snapshot_to_be_deleted)
-            if snapshot_deleted:
-                deleted_snapshots.append(snapshot_to_be_deleted)
-                print(
-                    'Snapshot deleted: {0}, name: {1}'.format(snapshot_deleted,
-                                                              snapshot_to_be_deleted['SnapshotName']))
-            else:
-                not_deleted_snapshots.append(snapshot_to_be_deleted)
-        # add deleted and not-deleted snapshots to snapshot_deletion_status dictionary
-        snapshot_deletion_status['deleted_snapshots'] = deleted_snapshots
-        snapshot_deletion_status['not_deleted_snapshots'] = not_deleted_snapshots
-        response_body['num_of_snapshot_deleted'] = len(deleted_snapshots)
-        response_body['num_of_snapshot_not_deleted'] = len(not_deleted_snapshots)
-    else:
-        logger.info('Number of historical snapshots less than the threshold. No need to delete any snapshots.')
 
-    # Tracking and Notifications
-    if response_body['new_snapshot_completed']:
-        track_snapshot_manager_status(dynamodb, ddb_table_name, primary_partition_key_name, primary_sort_key_name,
-                                      flink_app_name, snapshot_manager_run_id, latest_snapshot,
-                                      snapshot_deletion_status)
+def emit_metrics(namespace, flink_app_name, run_metrics, per_app_api_metrics=False):
+    """
+    This function prints the run metrics as CloudWatch Embedded Metric Format (EMF) log lines, so that CloudWatch
+    extracts them as metrics without any API call. Latencies are emitted as value arrays, at most 100 per line, so
+    that CloudWatch builds their distribution. Only the run level metrics have the app_name dimension: the per API
+    and per phase metrics are aggregated over the applications, unless per_app_api_metrics is set, as a fleet would
+    otherwise create some 40 custom metrics per application. The app_name is still a property of every line, for
+    CloudWatch Logs Insights.
+    :param namespace:
+    :param flink_app_name:
+    :param run_metrics:
+    :param per_app_api_metrics:
+    :return:
+    """
+    timestamp = int(time.time() * 1000)
 
-    return_response = {'statusCode': 200, 'body': json.dumps(response_body)}
-    return return_response
+    def emf_document(dimension_values, metrics):
+        document = {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimension_values)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit, _ in metrics]
+                }]
+            }
+        }
+        document['app_name'] = flink_app_name
+        document.update(dimension_values)
+        document.update({name: value for name, _, value in metrics})
+        return json.dumps(document)
+
+    app_dimension_values = {"app_name": flink_app_name} if per_app_api_metrics else {}
+    for api_name, num_of_calls in run_metrics['api_calls'].items():
+        dimension_values = dict(app_dimension_values, api_name=api_name)
+        latencies = run_metrics['api_latency_ms'].get(api_name, [])
+        for chunk_start in range(0, max(len(latencies), 1), 100):
+            metrics = [("ApiLatency", "Milliseconds", latencies[chunk_start:chunk_start + 100])]
+            if chunk_start == 0:
+                metrics += [("ApiCalls", "Count", num_of_calls),
+                            ("ApiErrors", "Count", run_metrics['api_errors'].get(api_name, 0)),
+                            ("ApiThrottles", "Count", run_metrics['api_throttles'].get(api_name, 0))]
+            print(emf_document(dimension_values, metrics))
 
+    run_summary = summarize_run_metrics(run_metrics)
+    metrics = [("ApiRetries", "Count", run_metrics['api_retries']),
+               ("RateLimiterWait", "Seconds", round(run_metrics['rate_limiter_wait_seconds'], 3)),
+               ("SnapshotsDeleted", "Count", run_metrics.get('num_of_snapshot_deleted', 0))]
+    if run_summary['snapshot_time_to_ready_seconds'] is not None:
+        metrics.append(("SnapshotTimeToReady", "Seconds", run_summary['snapshot_time_to_ready_seconds']))
+    if run_summary['snapshot_deletions_per_second'] is not None:
+        metrics.append(("SnapshotDeletionsPerSecond", "Count/Second", run_summary['snapshot_deletions_per_second']))
+    print(emf_document({"app_name": flink_app_name}, metrics))
 
-def describe_flink_application(kin_analytics, flink_app_name):
+    for phase_name, phase in run_metrics['phases'].items():
+        metrics = [("PhaseUsedSeconds", "Seconds", phase['used_seconds'])]
+        if phase['planned_seconds'] is not None:
+            metrics.append(("PhasePlannedSeconds", "Seconds", phase['planned_seconds']))
+        print(emf_document(dict(app_dimension_values, phase=phase_name), metrics))
+
+
+def describe_flink_application(kin_analytics, flink_app_name, run_metrics=None):
     """
     This function describes a Kinesis Data Analytics Flink Application
     :param kin_analytics:
     :param flink_app_name:
+    :param run_metrics:
     :return:
     """
+    res = None
     try:
-        res = kin_analytics.describe_application(ApplicationName=flink_app_name, IncludeAdditionalDetails=True)
+        # only the status and the version of the application are used, the additional details are not requested
+        res = call_aws_api(run_metrics, kin_analytics.describe_application, ApplicationName=flink_app_name)
     except botocore.exceptions.ClientError as error:
         if error.response['Error']['Code'] == 'ResourceNotFoundException':
             logger.warning('The requested Kinesis Data Analytics Flink Application was not found')
@@ -185,45 +1798,56 @@ def describe_flink_application(kin_analytics, flink_app_name):
     return res
 
 
-def list_flink_app_snapshots(kin_analytics, flink_app_name, app_ver_id):
+def list_flink_app_snapshots(kin_analytics, flink_app_name, app_ver_id, run_metrics=None):
     """
     This function get a list of snapshots for a Kinesis Data Analytics Flink Application
     :param kin_analytics:
     :param flink_app_name:
     :param app_ver_id:
+    :param run_metrics:
+    :return:
+    """
+    return list(iter_flink_app_snapshots(kin_analytics, flink_app_name, app_ver_id, run_metrics))
+
+
+def iter_flink_app_snapshots(kin_analytics, flink_app_name, app_ver_id, run_metrics=None):
+    """
+    This function streams the snapshots of a Kinesis Data Analytics Flink Application version. The next page is
+    only requested once the snapshots of the current page have been consumed.
+    :param kin_analytics:
+    :param flink_app_name:
+    :param app_ver_id:
+    :param run_metrics:
     :return:
     """
-    app_snapshots_latest_version = []
     try:
-        response = kin_analytics.list_application_snapshots(ApplicationName=flink_app_name, Limit=10)
-        snapshot_summary_list = response['SnapshotSummaries']
-        for snapshot_summary in snapshot_summary_list:
-            if app_ver_id == snapshot_summary['ApplicationVersionId']:
-                app_snapshots_latest_version.append(snapshot_summary)
-        # process next set list of items if 'NextToken' exist in the response
-        while 'NextToken' in response:
-            response = kin_analytics.list_application_snapshots(
+        response = call_aws_api(run_metrics, kin_analytics.list_application_snapshots, ApplicationName=flink_app_name,
+                                Limit=10)
+        while True:
+            for snapshot_summary in response['SnapshotSummaries']:
+                if app_ver_id == snapshot_summary['ApplicationVersionId']:
+                    yield snapshot_summary
+            # process next set list of items if 'NextToken' exist in the response
+            if 'NextToken' not in response:
+                break
+            response = call_aws_api(
+                run_metrics, kin_analytics.list_application_snapshots,
                 ApplicationName=flink_app_name, Limit=50, NextToken=response['NextToken']
             )
-            snapshot_summary_list = response['SnapshotSummaries']
-            for snapshot_summary in snapshot_summary_list:
-                if app_ver_id == snapshot_summary['ApplicationVersionId']:
-                    app_snapshots_latest_version.append(snapshot_summary)
     except botocore.exceptions.ClientError as error:
         if error.response['Error']['Code'] == 'ResourceNotFoundException':
             logger.warning('The requested Kinesis Data Analytics Flink Application was not found')
         else:
             print('Error Message: {}'.format(error.response['Error']['Message']))
 
-    return app_snapshots_latest_version
 
-
-def take_app_snapshot(kin_analytics, flink_app_name, snapshot_name):
+def take_app_snapshot(kin_analytics, flink_app_name, snapshot_name, run_metrics=None):
     """
     This function takes a Flink snapshot
     :param kin_analytics:
     :param flink_app_name:
     :param snapshot_name:
+    :param run_metrics:
     :return:
     """
     snapshot_creation_resp = {
@@ -231,16 +1855,19 @@ def take_app_snapshot(kin_analytics, flink_app_name, snapshot_name):
         "snapshot_name": "",
         "is_initiated": False,
         "error_message": "",
+        "error_code": "",
         "app_version": ""
     }
     try:
-        res = kin_analytics.create_application_snapshot(ApplicationName=flink_app_name, SnapshotName=snapshot_name)
+        res = call_aws_api(run_metrics, kin_analytics.create_application_snapshot, ApplicationName=flink_app_name,
+                           SnapshotName=snapshot_name)
         if res['ResponseMetadata']['HTTPStatusCode'] == 200:
             snapshot_creation_resp['is_initiated'] = True
             snapshot_creation_resp['snapshot_name'] = snapshot_name
             logger.info('Snapshot creation initiated.')
     except botocore.exceptions.ClientError as error:
         snapshot_creation_resp['error_message'] = error.response['Error']['Message']
+        snapshot_creation_resp['error_code'] = error.response['Error']['Code']
         if error.response['Error']['Code'] == 'ResourceNotFoundException':
             logger.warning('The requested Kinesis Data Analytics Flink Application was not found')
         elif error.response['Error']['Code'] == 'InvalidRequestException':
@@ -250,17 +1877,60 @@ def take_app_snapshot(kin_analytics, flink_app_name, snapshot_name):
     return snapshot_creation_resp
 
 
-def delete_snapshot(kin_analytics, flink_app_name, snapshot):
+def delete_snapshots(kin_analytics, flink_app_name, snapshots, snapshot_deletion_status, max_workers=5,
+                     run_metrics=None):
+    """
+    This function deletes Flink snapshots concurrently using a bounded worker pool. The workers share the rate limiter
+    of the deletion API, which slows all of them down when the API throttles. The outcome of each snapshot is added
+    to snapshot_deletion_status.
+    :param kin_analytics:
+    :param flink_app_name:
+    :param snapshots:
+    :param snapshot_deletion_status:
+    :param max_workers:
+    :param run_metrics:
+    :return:
+    """
+    num_of_throttles = run_metrics['api_throttles'].get('delete_application_snapshot', 0) if run_metrics else 0
+    snapshot_deletion_status.setdefault('deletion_outcomes', [])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+        for snapshot in snapshots:
+            deletion_outcome = {"SnapshotName": snapshot['SnapshotName']}
+            future = executor.submit(delete_snapshot, kin_analytics, flink_app_name, snapshot, run_metrics,
+                                     deletion_outcome)
+            futures[future] = (snapshot, deletion_outcome)
+        for future in concurrent.futures.as_completed(futures):
+            snapshot, deletion_outcome = futures[future]
+            snapshot_deleted = future.result()
+            if snapshot_deleted:
+                snapshot_deletion_status['deleted_snapshots'].append(snapshot)
+                print('Snapshot deleted: {0}, name: {1}'.format(snapshot_deleted, snapshot['SnapshotName']))
+            else:
+                snapshot_deletion_status['not_deleted_snapshots'].append(snapshot)
+            snapshot_deletion_status['deletion_outcomes'].append(deletion_outcome)
+    if run_metrics:
+        num_of_throttles = run_metrics['api_throttles'].get('delete_application_snapshot', 0) - num_of_throttles
+    snapshot_deletion_status['num_of_retries'] = snapshot_deletion_status.get('num_of_retries', 0) + num_of_throttles
+    return snapshot_deletion_status
+
+
+def delete_snapshot(kin_analytics, flink_app_name, snapshot, run_metrics=None, deletion_outcome=None):
     """
-    This function deletes a Flink snapshot
+    This function deletes a Flink snapshot. Throttled calls are retried by call_aws_api.
     :param kin_analytics:
     :param flink_app_name:
     :param snapshot:
+    :param run_metrics:
+    :param deletion_outcome:
     :return:
     """
     is_snapshot_deleted = False
+    if deletion_outcome is None:
+        deletion_outcome = {}
     try:
-        res = kin_analytics.delete_application_snapshot(
+        res = call_aws_api(
+            run_metrics, kin_analytics.delete_application_snapshot,
             ApplicationName=flink_app_name,
             SnapshotName=snapshot['SnapshotName'],
             SnapshotCreationTimestamp=snapshot['SnapshotCreationTimestamp']
@@ -268,24 +1938,236 @@ def delete_snapshot(kin_analytics, flink_app_name, snapshot):
         if res['ResponseMetadata']['HTTPStatusCode'] == 200:
             is_snapshot_deleted = True
     except botocore.exceptions.ClientError as error:
+        deletion_outcome['error_code'] = error.response['Error']['Code']
         if error.response['Error']['Code'] == 'ResourceNotFoundException':
-            logger.warning('The requested Kinesis Data Analytics Flink Application was not found')
+            logger.warning('The requested Kinesis Data Analytics Flink Application or snapshot was not found')
         else:
             print('Error Message: {}'.format(error.response['Error']['Message']))
+    deletion_outcome['deleted'] = is_snapshot_deleted
     return is_snapshot_deleted
 
 
-def notify_error(sns, topic_arn, message):
+def delete_snapshots_within_budget(dynamodb, kinesis_analytics, config, response_body, snapshots,
+                                   snapshot_deletion_status, run_metrics):
+    """
+    This function deletes the expired snapshots of a run in chunks sized to the run budget. A chunk holds at most
+    RUN_CHECKPOINT_INTERVAL snapshots, and no more than the budget left can delete at the time per deletion of the
+    last chunk, which is never taken below the rate limit of the API. Once not even one more deletion fits, the
+    snapshots left are not deleted, and the next run finds them again. With run checkpoints, the progress is
+    checkpointed after each chunk but the last one, so that a run resumed after a timeout does not repeat the
+    deletions. It returns True if all snapshots have been deleted.
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param response_body:
+    :param snapshots:
+    :param snapshot_deletion_status:
+    :param run_metrics:
+    :return:
+    """
+    planned_seconds = get_remaining_budget_seconds(config['run_budget'])
+    deletion_start_time = time.perf_counter()
+    # a chunk can run faster than the rate limit on the burst of the token bucket, but not the next ones
+    min_seconds_per_deletion = 1 / config['kda_api_requests_per_second']
+    seconds_per_deletion = min_seconds_per_deletion
+    snapshots = iter(snapshots)
+    next_snapshot = next(snapshots, None)
+    while next_snapshot is not None:
+        chunk_size = RUN_CHECKPOINT_INTERVAL
+        remaining_seconds = get_remaining_budget_seconds(config['run_budget'])
+        if remaining_seconds is not None:
+            chunk_size = min(chunk_size, int(remaining_seconds / seconds_per_deletion))
+        if chunk_size < 1:
+            logger.warning('Run budget used up, the remaining snapshots of {0} are left to the next run'.format(
+                response_body['app_name']))
+            response_body['run_budget_exhausted'] = True
+            response_body['deletions_deferred'] = True
+            break
+        # a run which has lost its run lock leaves the deletions to the run holding it
+        if (response_body.get('run_lock_expires_at') is not None and
+                response_body['run_lock_expires_at'] - time.time() * 1000 < RUN_LOCK_RENEWAL_SECONDS * 1000):
+            renew_run_lock(dynamodb, config, response_body, run_metrics)
+        if response_body.get('run_lock_lost'):
+            response_body['deletions_deferred'] = True
+            break
+        # the time per deletion includes the listing of the inventory, which is streamed into the chunks
+        chunk_start_time = time.perf_counter()
+        chunk = [next_snapshot] + list(itertools.islice(snapshots, chunk_size - 1))
+        delete_snapshots(kinesis_analytics, response_body['app_name'], chunk, snapshot_deletion_status,
+                         config['snapshot_deletion_max_workers'], run_metrics)
+        next_snapshot = next(snapshots, None)
+        seconds_per_deletion = max((time.perf_counter() - chunk_start_time) / len(chunk), min_seconds_per_deletion)
+        if next_snapshot is not None and config['run_checkpoints'] and save_run_checkpoint(
+                dynamodb, config, response_body, 'deleting', snapshot_deletion_status, run_metrics):
+            response_body['run_checkpointed'] = True
+    run_metrics['snapshot_deletion_seconds'] = time.perf_counter() - deletion_start_time
+    record_phase(run_metrics, 'delete', planned_seconds, run_metrics['snapshot_deletion_seconds'])
+    return next_snapshot is None
+
+
+def build_deletion_jobs(flink_app_name, snapshot_manager_run_id, snapshots, job_size):
+    """
+    This function splits the snapshots to delete of a run into deletion jobs of up to job_size snapshots, i.e. the
+    bodies of the messages read by snapshot_deletion_handler. Each job has an id unique to its run, and its
+    snapshots are encoded like in the audit items.
+    :param flink_app_name:
+    :param snapshot_manager_run_id:
+    :param snapshots:
+    :param job_size:
+    :return:
+    """
+    job_size = max(1, job_size)
+    return [{
+        "job_type": "snapshot_deletion",
+        "job_id": '{0}-{1}'.format(snapshot_manager_run_id, job_number),
+        "app_name": flink_app_name,
+        "snapshot_manager_run_id": snapshot_manager_run_id,
+        "snapshots": encode_snapshot_summaries(snapshots[job_start:job_start + job_size])
+    } for job_number, job_start in enumerate(range(0, len(snapshots), job_size))]
+
+
+def send_deletion_jobs(config, deletion_jobs, run_metrics=None):
+    """
+    This function sends deletion jobs to the snapshot deletion queue with SendMessageBatch, SQS_BATCH_SIZE jobs per
+    call. Entries which failed with a sender fault are not retried, the others are attempted up to
+    DISPATCH_MAX_ATTEMPTS times. It returns the queueing status.
+    :param config:
+    :param deletion_jobs:
+    :param run_metrics:
+    :return:
+    """
+    deletion_queue_status = {
+        "num_of_deletion_jobs": len(deletion_jobs),
+        "num_of_deletion_jobs_not_sent": 0
+    }
+    sqs = get_client('sqs', config['region'])
+    for batch_start in range(0, len(deletion_jobs), SQS_BATCH_SIZE):
+        entries = [{'Id': str(index), 'MessageBody': json.dumps(deletion_job)}
+                   for index, deletion_job in enumerate(deletion_jobs[batch_start:batch_start + SQS_BATCH_SIZE])]
+        attempt = 0
+        while entries and attempt < DISPATCH_MAX_ATTEMPTS:
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(2, 0.05 * 2 ** attempt)))
+            attempt += 1
+            try:
+                response = call_aws_api(run_metrics, sqs.send_message_batch,
+                                        QueueUrl=config['snapshot_deletion_queue_url'], Entries=entries)
+                failed_entries = response.get('Failed', [])
+                retryable_entry_ids = {failed_entry['Id'] for failed_entry in failed_entries
+                                       if not failed_entry.get('SenderFault')}
+                deletion_queue_status['num_of_deletion_jobs_not_sent'] += len(failed_entries) - len(retryable_entry_ids)
+                entries = [entry for entry in entries if entry['Id'] in retryable_entry_ids]
+            except botocore.exceptions.ClientError as error:
+                print('Error Message: {}'.format(error.response['Error']['Message']))
+        deletion_queue_status['num_of_deletion_jobs_not_sent'] += len(entries)
+    if deletion_queue_status['num_of_deletion_jobs_not_sent'] > 0:
+        logger.warning('{0} deletion job(s) could not be queued, their snapshots are deleted by a later run'.format(
+            deletion_queue_status['num_of_deletion_jobs_not_sent']))
+    else:
+        logger.info('{0} deletion job(s) queued successfully'.format(len(deletion_jobs)))
+    return deletion_queue_status
+
+
+def split_deletion_job(deletion_job, num_of_snapshots):
+    """
+    This function splits a deletion job after its first num_of_snapshots snapshots. The first job keeps the job id,
+    so that a message delivered again is still counted once in the audit record of its run, and the remaining job,
+    if any, gets the job id with a suffix. Each split makes the remaining job smaller, so a job is split at most once
+    per snapshot. It returns both jobs.
+    :param deletion_job:
+    :param num_of_snapshots:
+    :return:
+    """
+    snapshots = deletion_job['snapshots']['L']
+    if num_of_snapshots >= len(snapshots):
+        return deletion_job, None
+    return (dict(deletion_job, snapshots={'L': snapshots[:num_of_snapshots]}),
+            dict(deletion_job, snapshots={'L': snapshots[num_of_snapshots:]},
+                 job_id='{0}.{1}'.format(deletion_job['job_id'], num_of_snapshots)))
+
+
+def run_deletion_job(dynamodb, kinesis_analytics, config, deletion_job):
+    """
+    This function deletes the snapshots of a deletion job. A snapshot which is not found any more has been deleted by
+    a previous attempt of the job and counts as deleted. If some snapshots could not be deleted because of throttling
+    or a concurrent modification, the job is to be retried and nothing is recorded. Otherwise, the counts of the job
+    are added to the audit record of its run, together with the job id in deletion_jobs_done. The update is
+    conditional on the job id, so a job delivered twice is only counted once. It returns the status of the job.
+    :param dynamodb:
+    :param kinesis_analytics:
+    :param config:
+    :param deletion_job:
+    :return:
+    """
+    run_metrics = new_run_metrics()
+    flink_app_name = deletion_job['app_name']
+    snapshot_deletion_status = {
+        "deleted_snapshots": [],
+        "not_deleted_snapshots": []
+    }
+    deletion_start_time = time.perf_counter()
+    delete_snapshots(kinesis_analytics, flink_app_name, decode_snapshot_summaries(deletion_job['snapshots']),
+                     snapshot_deletion_status, config['snapshot_deletion_max_workers'], run_metrics)
+    run_metrics['snapshot_deletion_seconds'] = time.perf_counter() - deletion_start_time
+    error_codes = [deletion_outcome['error_code'] for deletion_outcome in snapshot_deletion_status['deletion_outcomes']
+                   if not deletion_outcome['deleted'] and 'error_code' in deletion_outcome]
+    num_of_snapshots_already_deleted = error_codes.count('ResourceNotFoundException')
+    job_status = {
+        "job_id": deletion_job['job_id'],
+        "app_name": flink_app_name,
+        "snapshot_manager_run_id": deletion_job['snapshot_manager_run_id'],
+        "num_of_snapshots_deleted": len(snapshot_deletion_status['deleted_snapshots']) +
+        num_of_snapshots_already_deleted,
+        "num_of_snapshots_failed_to_be_deleted": len(snapshot_deletion_status['not_deleted_snapshots']) -
+        num_of_snapshots_already_deleted,
+        "retry": any(error_code in RETRYABLE_API_ERROR_CODES for error_code in error_codes),
+        "audit_record_updated": False
+    }
+    if not job_status['retry']:
+        try:
+            call_aws_api(run_metrics, dynamodb.update_item,
+                         TableName=config['ddb_table_name'],
+                         Key={config['primary_partition_key_name']: {'S': flink_app_name},
+                              config['primary_sort_key_name']: {'N': str(deletion_job['snapshot_manager_run_id'])}},
+                         UpdateExpression='ADD num_of_snapshots_deleted :deleted, '
+                                          'num_of_snapshots_failed_to_be_deleted :not_deleted, '
+                                          'deletion_jobs_done :job_ids',
+                         ConditionExpression='attribute_exists(#pk) AND NOT contains(deletion_jobs_done, :job_id)',
+                         ExpressionAttributeNames={'#pk': config['primary_partition_key_name']},
+                         ExpressionAttributeValues={
+                             ':deleted': {'N': str(job_status['num_of_snapshots_deleted'])},
+                             ':not_deleted': {'N': str(job_status['num_of_snapshots_failed_to_be_deleted'])},
+                             ':job_ids': {'SS': [deletion_job['job_id']]},
+                             ':job_id': {'S': deletion_job['job_id']}
+                         })
+            job_status['audit_record_updated'] = True
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.info('Deletion job {0} already recorded, or its run has no audit record'.format(
+                    deletion_job['job_id']))
+            else:
+                print('Error Message: {}'.format(error.response['Error']['Message']))
+    logger.info('Deletion job of {0}: {1} snapshot(s) deleted, {2} not deleted{3}'.format(
+        flink_app_name, job_status['num_of_snapshots_deleted'], job_status['num_of_snapshots_failed_to_be_deleted'],
+        ', to be retried' if job_status['retry'] else ''))
+    run_metrics['num_of_snapshot_deleted'] = job_status['num_of_snapshots_deleted']
+    emit_metrics(config['metrics_namespace'], flink_app_name, run_metrics, config['per_app_api_metrics'])
+    return job_status
+
+
+def notify_error(sns, topic_arn, message, run_metrics=None):
     """
     This function sends a notification to Amazon SNS Topic
     :param sns:
     :param topic_arn:
     :param message:
+    :param run_metrics:
     :return:
     """
+    message_sent = False
     try:
-        pub_response = sns.publish(TopicArn=topic_arn, Message=message,
-                                   Subject='Kinesis Data Analytics Flink Snapshot Manager Alert')
+        pub_response = call_aws_api(run_metrics, sns.publish, TopicArn=topic_arn, Message=message,
+                                    Subject='Kinesis Data Analytics Flink Snapshot Manager Alert')
         if pub_response['ResponseMetadata']['HTTPStatusCode'] == 200:
             message_sent = True
             logger.info(
@@ -299,7 +2181,7 @@ def notify_error(sns, topic_arn, message):
 
 
 def send_sns_notification(sns, topic_arn, flink_app_name, snapshot_manager_run_id, snapshot_name, new_snapshot: None,
-                          snapshot_created):
+                          snapshot_created, run_metrics=None):
     """
     This function sends a notification to Amazon SNS Topic
     :param snapshot_name:
@@ -309,6 +2191,7 @@ def send_sns_notification(sns, topic_arn, flink_app_name, snapshot_manager_run_i
     :param snapshot_manager_run_id:
     :param new_snapshot:
     :param snapshot_created:
+    :param run_metrics:
     :return:
     """
     message_sent = False
@@ -351,8 +2234,8 @@ def send_sns_notification(sns, topic_arn, flink_app_name, snapshot_manager_run_i
                 ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
             """.format(snapshot_manager_run_id, flink_app_name, snapshot_name, datetime.datetime.now())
     try:
-        pub_response = sns.publish(TopicArn=topic_arn, Message=message,
-                                   Subject='Kinesis Data Analytics Flink Snapshot Manager Alert')
+        pub_response = call_aws_api(run_metrics, sns.publish, TopicArn=topic_arn, Message=message,
+                                    Subject='Kinesis Data Analytics Flink Snapshot Manager Alert')
         if pub_response['ResponseMetadata']['HTTPStatusCode'] == 200:
             message_sent = True
             logger.info(
@@ -365,42 +2248,656 @@ def send_sns_notification(sns, topic_arn, flink_app_name, snapshot_manager_run_i
     return message_sent
 
 
-def track_snapshot_manager_status(dynamodb, ddb_table_name, primary_partition_key, primary_sort_key, app_name,
-                                  snapshot_manager_run_id, new_snapshot, snapshot_deletion_status):
+def get_run_outcome(response_body):
+    """
+    This function returns the outcome of a Snapshot Manager run as recorded in the audit table
+    :param response_body:
+    :return:
+    """
+    if response_body.get('run_locked'):
+        return 'run_locked'
+    if response_body.get('cadence_skipped'):
+        return 'cadence_skipped'
+    if not response_body.get('app_is_described', True):
+        return 'api_throttled' if response_body.get('api_throttled') else 'app_not_described'
+    if not response_body['app_is_running']:
+        return 'app_not_running'
+    if response_body.get('api_throttled'):
+        return 'api_throttled'
+    if not response_body['app_is_healthy']:
+        return 'app_not_healthy'
+    if response_body.get('new_snapshot_completion_deferred') and not (
+            response_body['new_snapshot_completed'] or response_body['new_snapshot_failed'] or
+            response_body['new_snapshot_creation_delayed']):
+        return 'snapshot_pending'
+    if response_body['new_snapshot_failed']:
+        return 'snapshot_failed'
+    if response_body['new_snapshot_creation_delayed']:
+        return 'snapshot_delayed'
+    if response_body['num_of_snapshot_not_deleted'] > 0:
+        return 'deletion_failed'
+    return 'snapshot_completed'
+
+
+def flush_audit_records(dynamodb, ddb_table_name, audit_records, run_metrics=None):
+    """
+    This function writes audit items with BatchWriteItem in batches of AUDIT_BATCH_SIZE. Unprocessed items and
+    throttled batches are retried with exponential backoff and jitter, up to AUDIT_MAX_ATTEMPTS times per batch.
+    Overflow items are written before their main item, so that a main item is only visible once its run is complete.
+    :param dynamodb:
+    :param ddb_table_name:
+    :param audit_records:
+    :param run_metrics:
+    :return:
+    """
+    audit_status = {
+        "num_of_audit_records": len(audit_records),
+        "num_of_audit_batches": 0,
+        "num_of_audit_records_not_written": 0
+    }
+    audit_records = sorted(audit_records, key=lambda k: 'overflow_of_run_id' not in k)
+    for batch_start in range(0, len(audit_records), AUDIT_BATCH_SIZE):
+        write_requests = [{'PutRequest': {'Item': item}}
+                          for item in audit_records[batch_start:batch_start + AUDIT_BATCH_SIZE]]
+        attempt = 0
+        while write_requests and attempt < AUDIT_MAX_ATTEMPTS:
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(2, 0.05 * 2 ** attempt)))
+                if run_metrics is not None:
+                    run_metrics['api_retries'] += 1
+            attempt += 1
+            try:
+                response = call_aws_api(run_metrics, dynamodb.batch_write_item,
+                                        RequestItems={ddb_table_name: write_requests})
+                audit_status['num_of_audit_batches'] += 1
+                write_requests = response.get('UnprocessedItems', {}).get(ddb_table_name, [])
+            except botocore.exceptions.ClientError as error:
+                if error.response['Error']['Code'] == 'ResourceNotFoundException':
+                    logger.warning('The requested DynamoDB table was not found')
+                    break
+                print('Error Message: {}'.format(error.response['Error']['Message']))
+        audit_status['num_of_audit_records_not_written'] += len(write_requests)
+    if audit_status['num_of_audit_records_not_written'] > 0:
+        logger.warning('{0} audit item(s) could not be written'.format(
+            audit_status['num_of_audit_records_not_written']))
+    else:
+        logger.info('{0} audit item(s) written successfully'.format(len(audit_records)))
+    return audit_status
+
+
+def build_snapshot_manager_status_items(primary_partition_key, primary_sort_key, response_body, new_snapshot,
+                                        snapshot_deletion_status):
+    """
+    This function builds the audit items of a Snapshot Manager run from its response body, for every outcome. The
+    new snapshot is None unless it has been completed. Deleted and not deleted snapshots are stored as DynamoDB lists
+    of compact maps (see encode_snapshot_summaries). When a run has more than AUDIT_MAX_SNAPSHOTS_PER_ITEM of them,
+    the rest goes to overflow items, so that no item reaches the 400 KB item size limit. Overflow items share the
+    partition key and use the sort key <run id>.<part>, e.g. 1650000000000.001, so they sort right after their main
+    item. The main item comes first in the returned list. Only main items have the run_date attribute, so only they
+    are in the run time index.
+    :param primary_partition_key:
+    :param primary_sort_key:
+    :param response_body:
+    :param new_snapshot:
+    :param snapshot_deletion_status:
+    :return:
+    """
+    app_name = response_body['app_name']
+    snapshot_manager_run_id = response_body['snapshot_manager_run_id']
+    item = {
+        primary_partition_key: {'S': app_name},
+        primary_sort_key: {'N': str(snapshot_manager_run_id)},
+        'run_outcome': {'S': response_body['run_outcome']},
+        'run_date': {'S': get_run_date(snapshot_manager_run_id)},
+        'new_snapshot_name': {'S': str(response_body['new_snapshot_name'])},
+        'flink_app_version_id': {'S': str(response_body['app_version'])},
+        'num_of_snapshots_deleted': {'N': str(len(snapshot_deletion_status['deleted_snapshots']))},
+        'num_of_snapshots_failed_to_be_deleted': {'N': str(len(snapshot_deletion_status['not_deleted_snapshots']))}
+    }
+    if response_body.get('num_of_snapshots_queued_for_deletion'):
+        # the deletion workers add their counts to num_of_snapshots_deleted and num_of_snapshots_failed_to_be_deleted
+        item['num_of_snapshots_queued_for_deletion'] = {'N': str(response_body['num_of_snapshots_queued_for_deletion'])}
+    if response_body.get('ttr_history', {}).get('num_of_samples'):
+        item['ttr_p50_seconds'] = {'N': str(response_body['ttr_history']['p50_seconds'])}
+        item['ttr_p95_seconds'] = {'N': str(response_body['ttr_history']['p95_seconds'])}
+    if response_body.get('ttr_history', {}).get('recommended_interval_seconds') is not None:
+        item['recommended_interval_seconds'] = {
+            'N': str(response_body['ttr_history']['recommended_interval_seconds'])}
+    if new_snapshot is not None:
+        item['new_snapshot_create_time'] = {'S': str(new_snapshot['SnapshotCreationTimestamp'])}
+        item['flink_app_version_id'] = {'S': str(new_snapshot['ApplicationVersionId'])}
+    items = [item]
+    attribute_snapshots = [('snapshots_deleted', snapshot)
+                           for snapshot in snapshot_deletion_status['deleted_snapshots']]
+    attribute_snapshots += [('snapshots_failed_to_be_deleted', snapshot)
+                            for snapshot in snapshot_deletion_status['not_deleted_snapshots']]
+    for part, chunk_start in enumerate(range(0, len(attribute_snapshots), AUDIT_MAX_SNAPSHOTS_PER_ITEM)):
+        if part == 0:
+            chunk_item = item
+        else:
+            chunk_item = {
+                primary_partition_key: {'S': app_name},
+                primary_sort_key: {'N': '{0}.{1:03d}'.format(snapshot_manager_run_id, part)},
+                'overflow_of_run_id': {'N': str(snapshot_manager_run_id)}
+            }
+            items.append(chunk_item)
+        chunk = attribute_snapshots[chunk_start:chunk_start + AUDIT_MAX_SNAPSHOTS_PER_ITEM]
+        for attribute_name in ('snapshots_deleted', 'snapshots_failed_to_be_deleted'):
+            snapshots = [snapshot for name, snapshot in chunk if name == attribute_name]
+            if snapshots:
+                chunk_item[attribute_name] = encode_snapshot_summaries(snapshots)
+    if len(items) > 1:
+        item['num_of_overflow_items'] = {'N': str(len(items) - 1)}
+    return items
+
+
+def update_latest_snapshot_record(dynamodb, ddb_table_name, primary_partition_key, primary_sort_key, flink_app_name,
+                                  snapshot_manager_run_id, new_snapshot, time_to_ready_seconds, run_metrics=None):
     """
-    This function tracks the status of Snapshot Manager
+    This function records a READY snapshot as the latest restorable snapshot of an application, in the control
+    record with sort key LATEST_SNAPSHOT_SORT_KEY. The conditional update only moves the record forward, so a late or
+    concurrent run cannot replace it with an older snapshot. A time_to_ready_seconds of None, when the snapshot was
+    not seen turning READY, removes the time to ready of the previous snapshot from the record. It returns True if
+    the record has been updated.
     :param dynamodb:
     :param ddb_table_name:
     :param primary_partition_key:
     :param primary_sort_key:
-    :param app_name:
+    :param flink_app_name:
     :param snapshot_manager_run_id:
     :param new_snapshot:
+    :param time_to_ready_seconds:
+    :param run_metrics:
+    :return:
+    """
+    creation_time = new_snapshot['SnapshotCreationTimestamp']
+    if isinstance(creation_time, datetime.datetime):
+        creation_time = int(creation_time.timestamp() * 1000)
+    update_expression = ('SET snapshot_name = :name, snapshot_create_time = :time, flink_app_version_id = :version, '
+                         'snapshot_manager_run_id_of_snapshot = :run_id')
+    expression_attribute_values = {
+        ':name': {'S': str(new_snapshot['SnapshotName'])},
+        ':time': {'N': str(creation_time)},
+        ':version': {'N': str(new_snapshot['ApplicationVersionId'])},
+        ':run_id': {'N': str(snapshot_manager_run_id)}
+    }
+    if time_to_ready_seconds is not None:
+        update_expression += ', time_to_ready_seconds = :time_to_ready'
+        expression_attribute_values[':time_to_ready'] = {'N': str(round(time_to_ready_seconds, 3))}
+    else:
+        update_expression += ' REMOVE time_to_ready_seconds'
+    try:
+        call_aws_api(run_metrics, dynamodb.update_item,
+                     TableName=ddb_table_name,
+                     Key={primary_partition_key: {'S': flink_app_name},
+                          primary_sort_key: {'N': str(LATEST_SNAPSHOT_SORT_KEY)}},
+                     UpdateExpression=update_expression,
+                     ConditionExpression='attribute_not_exists(snapshot_create_time) OR snapshot_create_time < :time',
+                     ExpressionAttributeValues=expression_attribute_values)
+        return True
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.info('The latest snapshot record of {0} already has a newer snapshot'.format(flink_app_name))
+        else:
+            print('Error Message: {}'.format(error.response['Error']['Message']))
+    return False
+
+
+def get_latest_snapshot_record(dynamodb, ddb_table_name, primary_partition_key, primary_sort_key, flink_app_name):
+    """
+    This function reads the latest restorable snapshot of an application with a single key lookup, whatever the
+    number of snapshots the application has. It returns None if the application has no READY snapshot recorded yet.
+    :param dynamodb:
+    :param ddb_table_name:
+    :param primary_partition_key:
+    :param primary_sort_key:
+    :param flink_app_name:
+    :return:
+    """
+    res = dynamodb.get_item(TableName=ddb_table_name,
+                            Key={primary_partition_key: {'S': flink_app_name},
+                                 primary_sort_key: {'N': str(LATEST_SNAPSHOT_SORT_KEY)}},
+                            ConsistentRead=True)
+    if 'Item' not in res:
+        return None
+    item = res['Item']
+    return {
+        'app_name': flink_app_name,
+        'snapshot_name': item['snapshot_name']['S'],
+        'snapshot_create_time': datetime.datetime.fromtimestamp(int(item['snapshot_create_time']['N']) / 1000,
+                                                                datetime.timezone.utc),
+        'flink_app_version_id': int(item['flink_app_version_id']['N']),
+        'time_to_ready_seconds': float(item['time_to_ready_seconds']['N']) if 'time_to_ready_seconds' in item else None,
+        'snapshot_manager_run_id': int(item['snapshot_manager_run_id_of_snapshot']['N'])
+    }
+
+
+def save_run_checkpoint(dynamodb, config, response_body, phase, snapshot_deletion_status=None, run_metrics=None):
+    """
+    This function saves the progress of a run of an application in its checkpoint record, the control record with
+    sort key RUN_CHECKPOINT_SORT_KEY. The phase is snapshot_initiated once the new snapshot has been requested, and
+    deleting once some expired snapshots have been deleted, with the snapshots deleted and not deleted so far. The
+    record is removed by clear_run_checkpoints once the audit record of the run is written, so a record left over
+    means the run did not finish. A run holding the run lock writes its fencing token along, and cannot overwrite the
+    checkpoint of a run with a later token: it has lost the lock, which is flagged in run_lock_lost. It returns True
+    if the checkpoint has been saved.
+    :param dynamodb:
+    :param config:
+    :param response_body:
+    :param phase:
     :param snapshot_deletion_status:
+    :param run_metrics:
+    :return:
+    """
+    item = {
+        config['primary_partition_key_name']: {'S': response_body['app_name']},
+        config['primary_sort_key_name']: {'N': str(RUN_CHECKPOINT_SORT_KEY)},
+        'phase': {'S': phase},
+        'checkpoint_run_id': {'N': str(response_body['snapshot_manager_run_id'])},
+        'checkpoint_time': {'N': str(int(time.time() * 1000))},
+        'snapshot_name': {'S': response_body['new_snapshot_name']},
+        'flink_app_version_id': {'N': str(response_body['app_version'])},
+        'snapshot_initiated_at': {'N': str(response_body['new_snapshot_initiated_at'])}
+    }
+    if response_body.get('new_snapshot_wait_seconds') is not None:
+        item['time_to_ready_seconds'] = {'N': str(response_body['new_snapshot_wait_seconds'])}
+    if snapshot_deletion_status is not None:
+        item['snapshots_deleted'] = encode_snapshot_summaries(
+            snapshot_deletion_status['deleted_snapshots'][:RUN_CHECKPOINT_MAX_SNAPSHOTS])
+        item['snapshots_failed_to_be_deleted'] = encode_snapshot_summaries(
+            snapshot_deletion_status['not_deleted_snapshots'][:RUN_CHECKPOINT_MAX_SNAPSHOTS])
+    condition = {}
+    if response_body.get('run_lock_fencing_token') is not None:
+        item['fencing_token'] = {'N': str(response_body['run_lock_fencing_token'])}
+        condition = {
+            'ConditionExpression': 'attribute_not_exists(fencing_token) OR fencing_token <= :token',
+            'ExpressionAttributeValues': {':token': item['fencing_token']}
+        }
+    try:
+        call_aws_api(run_metrics, dynamodb.put_item, TableName=config['ddb_table_name'], Item=item, **condition)
+        return True
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning('The run lock of {0} has been taken over by a later run'.format(response_body['app_name']))
+            response_body['run_lock_lost'] = True
+        else:
+            print('Error Message: {}'.format(error.response['Error']['Message']))
+    return False
+
+
+def get_run_checkpoint(dynamodb, config, flink_app_name, run_metrics=None):
+    """
+    This function reads the checkpoint of the last unfinished run of an application. It returns None if there is
+    none, or if it could not be read.
+    :param dynamodb:
+    :param config:
+    :param flink_app_name:
+    :param run_metrics:
+    :return:
+    """
+    try:
+        res = call_aws_api(run_metrics, dynamodb.get_item,
+                           TableName=config['ddb_table_name'],
+                           Key={config['primary_partition_key_name']: {'S': flink_app_name},
+                                config['primary_sort_key_name']: {'N': str(RUN_CHECKPOINT_SORT_KEY)}},
+                           ConsistentRead=True)
+    except botocore.exceptions.ClientError as error:
+        print('Error Message: {}'.format(error.response['Error']['Message']))
+        return None
+    if 'Item' not in res:
+        return None
+    item = res['Item']
+    return {
+        'app_name': flink_app_name,
+        'phase': item['phase']['S'],
+        'snapshot_manager_run_id': int(item['checkpoint_run_id']['N']),
+        'checkpoint_time': int(item['checkpoint_time']['N']),
+        'snapshot_name': item['snapshot_name']['S'],
+        'app_version': int(item['flink_app_version_id']['N']),
+        'snapshot_initiated_at': int(item['snapshot_initiated_at']['N']),
+        'new_snapshot_wait_seconds': float(item['time_to_ready_seconds']['N']) if 'time_to_ready_seconds' in item
+        else None,
+        'snapshots_deleted': decode_snapshot_summaries(item.get('snapshots_deleted', {})),
+        'snapshots_failed_to_be_deleted': decode_snapshot_summaries(item.get('snapshots_failed_to_be_deleted', {}))
+    }
+
+
+def clear_run_checkpoints(dynamodb, config, app_response_bodies, run_metrics=None):
+    """
+    This function removes the checkpoints of the runs which have finished, once their audit records are written. The
+    checkpoint of a suspended run is kept for the next run. The delete is conditional on the run id, so the
+    checkpoint of a later run is kept too.
+    :param dynamodb:
+    :param config:
+    :param app_response_bodies:
+    :param run_metrics:
+    :return:
+    """
+    for app_response_body in app_response_bodies:
+        if not app_response_body.get('run_checkpointed') or app_response_body.get('run_suspended'):
+            continue
+        try:
+            call_aws_api(run_metrics, dynamodb.delete_item,
+                         TableName=config['ddb_table_name'],
+                         Key={config['primary_partition_key_name']: {'S': app_response_body['app_name']},
+                              config['primary_sort_key_name']: {'N': str(RUN_CHECKPOINT_SORT_KEY)}},
+                         ConditionExpression='checkpoint_run_id = :run_id',
+                         ExpressionAttributeValues={
+                             ':run_id': {'N': str(app_response_body['snapshot_manager_run_id'])}})
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.info('The checkpoint of {0} belongs to another run'.format(app_response_body['app_name']))
+            else:
+                print('Error Message: {}'.format(error.response['Error']['Message']))
+
+
+def get_ttr_history(dynamodb, config, flink_app_name, run_metrics=None):
+    """
+    This function reads the time to ready history of an application, the control record with sort key
+    TTR_HISTORY_SORT_KEY, see record_ttr_sample. It returns its samples, oldest first, or an empty list if there is
+    none or it could not be read.
+    :param dynamodb:
+    :param config:
+    :param flink_app_name:
+    :param run_metrics:
+    :return:
+    """
+    try:
+        res = call_aws_api(run_metrics, dynamodb.get_item,
+                           TableName=config['ddb_table_name'],
+                           Key={config['primary_partition_key_name']: {'S': flink_app_name},
+                                config['primary_sort_key_name']: {'N': str(TTR_HISTORY_SORT_KEY)}},
+                           ConsistentRead=True)
+    except botocore.exceptions.ClientError as error:
+        print('Error Message: {}'.format(error.response['Error']['Message']))
+        return []
+    return [{
+        "time_to_ready_seconds": float(sample['M']['s']['N']),
+        "delayed": sample['M']['d']['BOOL'],
+        "initiated_at": int(sample['M']['t']['N'])
+    } for sample in res.get('Item', {}).get('ttr_samples', {}).get('L', [])]
+
+
+def record_ttr_sample(dynamodb, config, response_body, ttr_samples=None, run_metrics=None):
+    """
+    This function adds the new snapshot of a run to the time to ready history of its application and keeps the last
+    TTR_HISTORY_MAX_SAMPLES of them. A sample is a compact map of the time to ready in seconds (s), whether the
+    snapshot was delayed (d), in which case s is the time waited, and its initiation time in epoch milliseconds (t).
+    The run lock keeps two runs of the application from updating the history at the same time. It returns True if
+    the history has been saved.
+    :param dynamodb:
+    :param config:
+    :param response_body:
+    :param ttr_samples:
+    :param run_metrics:
     :return:
     """
-    item_inserted = False
+    if ttr_samples is None:
+        ttr_samples = get_ttr_history(dynamodb, config, response_body['app_name'], run_metrics)
+    ttr_samples = ttr_samples + [{
+        "time_to_ready_seconds": response_body['new_snapshot_wait_seconds'],
+        "delayed": response_body['new_snapshot_creation_delayed'],
+        "initiated_at": response_body['new_snapshot_initiated_at']
+    }]
+    item = {
+        config['primary_partition_key_name']: {'S': response_body['app_name']},
+        config['primary_sort_key_name']: {'N': str(TTR_HISTORY_SORT_KEY)},
+        'ttr_samples': {'L': [{'M': {'s': {'N': str(sample['time_to_ready_seconds'])},
+                                     'd': {'BOOL': sample['delayed']},
+                                     't': {'N': str(sample['initiated_at'])}}}
+                              for sample in ttr_samples[-TTR_HISTORY_MAX_SAMPLES:]]}
+    }
     try:
-        # Prepare an item
-        item = {
-            primary_partition_key: {'S': app_name},
-            primary_sort_key: {'N': str(snapshot_manager_run_id)},
-            'new_snapshot_name': {'S': str(new_snapshot['SnapshotName'])},
-            'new_snapshot_create_time': {'S': str(new_snapshot['SnapshotCreationTimestamp'])},
-            'flink_app_version_id': {'S': str(new_snapshot['ApplicationVersionId'])}
+        call_aws_api(run_metrics, dynamodb.put_item, TableName=config['ddb_table_name'], Item=item)
+        return True
+    except botocore.exceptions.ClientError as error:
+        print('Error Message: {}'.format(error.response['Error']['Message']))
+    return False
+
+
+def summarize_ttr_history(ttr_samples, config):
+    """
+    This function derives from the time to ready history of an application its p50 and p95 times to ready, the
+    share of delayed snapshots and the recommended interval between snapshots. With at least TTR_HISTORY_MIN_SAMPLES
+    samples the history is adaptive, and poll_settings holds the settings that override the static ones for the
+    next run: the first check, and the first deferred check, at half the p50 time to ready, and checks no further
+    apart than the spread between p50 and p95. The configured snapshot_completion_deadline_seconds is kept, so a
+    snapshot which is slower than its history is still waited for. A time to ready is only seen at the check that
+    finds the snapshot ready, so checking before p50 lets the history learn shorter times. Delayed snapshots count
+    with the time waited, i.e. a lower bound. The recommended interval only comes from the snapshots which were not
+    delayed, and runs are only skipped for it, is_cadence_adaptive, with at least CADENCE_MIN_SAMPLES of them.
+    :param ttr_samples:
+    :param config:
+    :return:
+    """
+    ttr_summary = {
+        "num_of_samples": len(ttr_samples),
+        "is_adaptive": len(ttr_samples) >= TTR_HISTORY_MIN_SAMPLES,
+        "is_cadence_adaptive": False,
+        "p50_seconds": None,
+        "p95_seconds": None,
+        "delayed_ratio": None,
+        "recommended_interval_seconds": None,
+        "poll_settings": {}
+    }
+    if not ttr_samples:
+        return ttr_summary
+    sorted_ttr_seconds = sorted(sample['time_to_ready_seconds'] for sample in ttr_samples)
+    # nearest-rank percentiles
+    p50_seconds = sorted_ttr_seconds[max(0, math.ceil(len(sorted_ttr_seconds) * 0.50) - 1)]
+    p95_seconds = sorted_ttr_seconds[max(0, math.ceil(len(sorted_ttr_seconds) * 0.95) - 1)]
+    ttr_summary['p50_seconds'] = round(p50_seconds, 3)
+    ttr_summary['p95_seconds'] = round(p95_seconds, 3)
+    ttr_summary['delayed_ratio'] = round(sum(1 for sample in ttr_samples if sample['delayed']) / len(ttr_samples), 3)
+    completed_ttr_seconds = sorted(sample['time_to_ready_seconds'] for sample in ttr_samples if not sample['delayed'])
+    if completed_ttr_seconds:
+        completed_p95_seconds = completed_ttr_seconds[max(0, math.ceil(len(completed_ttr_seconds) * 0.95) - 1)]
+        ttr_summary['recommended_interval_seconds'] = max(MIN_RECOMMENDED_INTERVAL_SECONDS,
+                                                          math.ceil(completed_p95_seconds * CADENCE_TTR_FACTOR))
+        ttr_summary['is_cadence_adaptive'] = len(completed_ttr_seconds) >= CADENCE_MIN_SAMPLES
+    if ttr_summary['is_adaptive']:
+        first_probe_seconds = min(max(p50_seconds / 2, MIN_FIRST_PROBE_SECONDS),
+                                  config['snapshot_completion_deadline_seconds'])
+        ttr_summary['poll_settings'] = {
+            "snapshot_first_probe_seconds": round(first_probe_seconds, 3),
+            "snapshot_creation_wait_time_seconds": round(max(first_probe_seconds, p95_seconds - p50_seconds), 3),
+            "snapshot_completion_delay_seconds": int(min(MAX_SQS_DELAY_SECONDS, max(1, round(first_probe_seconds))))
         }
-        if len(snapshot_deletion_status['deleted_snapshots']) > 0:
-            item['snapshots_deleted'] = {'S': str(snapshot_deletion_status['deleted_snapshots'])}
-        if len(snapshot_deletion_status['not_deleted_snapshots']) > 0:
-            item['snapshots_failed_to_be_deleted'] = {'S': str(snapshot_deletion_status['not_deleted_snapshots'])}
-        # Insert the item
-        put_item_response = dynamodb.put_item(TableName=ddb_table_name, Item=item)
-        if put_item_response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            item_inserted = True
-            logger.info('An item inserted successfully')
+    return ttr_summary
+
+
+def acquire_run_lock(dynamodb, config, flink_app_name, snapshot_manager_run_id, run_metrics=None):
+    """
+    This function takes the run lock of an application, the control record with sort key RUN_LOCK_SORT_KEY, for a
+    run. The lock is a lease: a conditional update takes it if it is free, expired or already held by the same run,
+    and it expires at the function timeout, or after run_lock_lease_seconds outside of AWS Lambda, so that a run
+    which dies never blocks the next ones. Each acquisition increments the fencing token of the record, which the
+    run then attaches to its checkpoint writes. If the lock record cannot be read or written for another reason,
+    the run goes on without the lock. It returns the lock status.
+    :param dynamodb:
+    :param config:
+    :param flink_app_name:
+    :param snapshot_manager_run_id:
+    :param run_metrics:
+    :return:
+    """
+    run_lock = {
+        "is_held_by_another_run": False,
+        "fencing_token": None,
+        "lease_expires_at": None
+    }
+    now = int(time.time() * 1000)
+    lease_seconds = get_remaining_budget_seconds(config['run_budget'], True)
+    if lease_seconds is None:
+        lease_seconds = config['run_lock_lease_seconds']
+    lease_expires_at = now + int(lease_seconds * 1000)
+    try:
+        res = call_aws_api(run_metrics, dynamodb.update_item,
+                           TableName=config['ddb_table_name'],
+                           Key={config['primary_partition_key_name']: {'S': flink_app_name},
+                                config['primary_sort_key_name']: {'N': str(RUN_LOCK_SORT_KEY)}},
+                           UpdateExpression='SET lock_owner_run_id = :run_id, lease_expires_at = :expires_at '
+                                            'ADD fencing_token :one',
+                           ConditionExpression='attribute_not_exists(lease_expires_at) OR lease_expires_at < :now OR '
+                                               'lock_owner_run_id = :run_id',
+                           ExpressionAttributeValues={
+                               ':run_id': {'N': str(snapshot_manager_run_id)},
+                               ':expires_at': {'N': str(lease_expires_at)},
+                               ':now': {'N': str(now)},
+                               ':one': {'N': '1'}
+                           },
+                           ReturnValues='ALL_NEW')
+        run_lock['fencing_token'] = int(res['Attributes']['fencing_token']['N'])
+        run_lock['lease_expires_at'] = lease_expires_at
     except botocore.exceptions.ClientError as error:
-        if error.response['Error']['Code'] == 'ResourceNotFoundException':
-            logger.warning('The requested DynamoDB table was not found')
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            run_lock['is_held_by_another_run'] = True
+        else:
+            print('Error Message: {}'.format(error.response['Error']['Message']))
+    return run_lock
+
+
+def renew_run_lock(dynamodb, config, response_body, run_metrics=None):
+    """
+    This function extends the lease of the run lock held by a run, as long as its fencing token is still the one of
+    the lock. Otherwise the lock has been taken over, which is flagged in run_lock_lost. It returns True if the lease
+    has been extended.
+    :param dynamodb:
+    :param config:
+    :param response_body:
+    :param run_metrics:
+    :return:
+    """
+    lease_seconds = get_remaining_budget_seconds(config['run_budget'], True)
+    if lease_seconds is None:
+        lease_seconds = config['run_lock_lease_seconds']
+    lease_expires_at = int(time.time() * 1000) + int(lease_seconds * 1000)
+    try:
+        call_aws_api(run_metrics, dynamodb.update_item,
+                     TableName=config['ddb_table_name'],
+                     Key={config['primary_partition_key_name']: {'S': response_body['app_name']},
+                          config['primary_sort_key_name']: {'N': str(RUN_LOCK_SORT_KEY)}},
+                     UpdateExpression='SET lease_expires_at = :expires_at',
+                     ConditionExpression='fencing_token = :token',
+                     ExpressionAttributeValues={
+                         ':expires_at': {'N': str(lease_expires_at)},
+                         ':token': {'N': str(response_body['run_lock_fencing_token'])}
+                     })
+        response_body['run_lock_expires_at'] = lease_expires_at
+        return True
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning('The run lock of {0} has been taken over by a later run'.format(response_body['app_name']))
+            response_body['run_lock_lost'] = True
         else:
             print('Error Message: {}'.format(error.response['Error']['Message']))
-    return item_inserted
+    return False
+
+
+def release_run_locks(dynamodb, config, app_response_bodies, run_metrics=None):
+    """
+    This function releases the run locks held by runs once they are done. The release is conditional on the fencing
+    token, so a lock taken over by a later run is left alone. The fencing token stays in the record, so that it
+    keeps increasing.
+    :param dynamodb:
+    :param config:
+    :param app_response_bodies:
+    :param run_metrics:
+    :return:
+    """
+    for app_response_body in app_response_bodies:
+        if app_response_body.get('run_lock_fencing_token') is None:
+            continue
+        try:
+            call_aws_api(run_metrics, dynamodb.update_item,
+                         TableName=config['ddb_table_name'],
+                         Key={config['primary_partition_key_name']: {'S': app_response_body['app_name']},
+                              config['primary_sort_key_name']: {'N': str(RUN_LOCK_SORT_KEY)}},
+                         UpdateExpression='REMOVE lock_owner_run_id, lease_expires_at',
+                         ConditionExpression='fencing_token = :token',
+                         ExpressionAttributeValues={
+                             ':token': {'N': str(app_response_body['run_lock_fencing_token'])}})
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                logger.info('The run lock of {0} is held by another run'.format(app_response_body['app_name']))
+            else:
+                print('Error Message: {}'.format(error.response['Error']['Message']))
+
+
+def get_run_date(snapshot_manager_run_id):
+    """
+    This function returns the UTC date (YYYY-MM-DD) of a run id, i.e. the partition key of the run time index
+    :param snapshot_manager_run_id:
+    :return:
+    """
+    run_time = datetime.datetime.fromtimestamp(snapshot_manager_run_id / 1000, datetime.timezone.utc)
+    return run_time.strftime('%Y-%m-%d')
+
+
+def encode_snapshot_summaries(snapshots):
+    """
+    This function encodes snapshot summaries as a DynamoDB list of maps holding only the snapshot name (n), the
+    creation time in epoch milliseconds (t) and the application version id (v)
+    :param snapshots:
+    :return:
+    """
+    encoded_snapshots = []
+    for snapshot in snapshots:
+        creation_time = snapshot['SnapshotCreationTimestamp']
+        if isinstance(creation_time, datetime.datetime):
+            creation_time = int(creation_time.timestamp() * 1000)
+        encoded_snapshots.append({'M': {
+            'n': {'S': str(snapshot['SnapshotName'])},
+            't': {'N': str(creation_time)},
+            'v': {'N': str(snapshot['ApplicationVersionId'])}
+        }})
+    return {'L': encoded_snapshots}
+
+
+def decode_snapshot_summaries(attribute):
+    """
+    This function decodes a list of snapshot summaries encoded by encode_snapshot_summaries. Creation times are
+    returned as timezone aware datetimes, like boto3 returns them.
+    :param attribute:
+    :return:
+    """
+    snapshots = []
+    for encoded_snapshot in attribute.get('L', []):
+        encoded_snapshot = encoded_snapshot['M']
+        snapshots.append({
+            'SnapshotName': encoded_snapshot['n']['S'],
+            'SnapshotCreationTimestamp': datetime.datetime.fromtimestamp(int(encoded_snapshot['t']['N']) / 1000,
+                                                                         datetime.timezone.utc),
+            'ApplicationVersionId': int(encoded_snapshot['v']['N'])
+        })
+    return snapshots
+
+
+def decode_snapshot_manager_status(items, primary_partition_key, primary_sort_key):
+    """
+    This function decodes the audit items of one Snapshot Manager run, i.e. its main item and its overflow items in
+    any order, into a plain dictionary
+    :param items:
+    :param primary_partition_key:
+    :param primary_sort_key:
+    :return:
+    """
+    main_items = [item for item in items if 'overflow_of_run_id' not in item]
+    if not main_items:
+        return None
+    status = {}
+    for attribute_name, attribute in main_items[0].items():
+        if attribute_name in ('snapshots_deleted', 'snapshots_failed_to_be_deleted'):
+            continue
+        attribute_type, value = next(iter(attribute.items()))
+        if attribute_type == 'N':
+            value = int(value) if value.lstrip('-').isdigit() else float(value)
+        status[attribute_name] = value
+    status['snapshots_deleted'] = []
+    status['snapshots_failed_to_be_deleted'] = []
+    # the main item holds the first chunk, the overflow items the next ones in sort key order
+    for item in sorted(items, key=lambda k: float(k[primary_sort_key]['N'])):
+        for attribute_name in ('snapshots_deleted', 'snapshots_failed_to_be_deleted'):
+            if attribute_name in item:
+                status[attribute_name].extend(decode_snapshot_summaries(item[attribute_name]))
+    return status
@@ -0,0 +1,126 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Cold-start benchmark of the Snapshot Manager. Each measurement runs in a fresh Python process, like a new Lambda
+execution environment, and is repeated to report the median. It measures:
+
+    import                module import time
+    client_setup          first creation of the Kinesis Data Analytics, SNS and DynamoDB clients, including the
+                          import of boto3 (real clients, no AWS call is made)
+    first_invocation      first and second (warm) handler invocations against the in-process stand-ins
+    app_not_found         same for an application that does not exist
+
+together with the peak resident memory of the process. Run it with the Python version of the Lambda runtime.
+
+Usage: python benchmarks/bench_cold_start.py [--repeat 5]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCENARIOS = ('import', 'client_setup', 'first_invocation', 'app_not_found')
+
+BENCHMARK_ENVIRONMENT = {
+    'aws_region': 'us-east-1',
+    'app_name': 'cold-start-app',
+    'snapshot_manager_ddb_table_name': 'snapshot_manager_status',
+    'primary_partition_key_name': 'app_name',
+    'primary_sort_key_name': 'snapshot_manager_run_id',
+    'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789012:snapshot-manager',
+    'number_of_older_snapshots_to_retain': '5',
+    'snapshot_creation_wait_time_seconds': '1',
+    'snapshot_first_probe_seconds': '0.01'
+}
+
+
+def measure(scenario):
+    """
+    This function runs one scenario in the current process and returns its measurements. It is called in a fresh
+    process for every sample.
+    :param scenario:
+    :return:
+    """
+    import time
+    import resource
+    import contextlib
+
+    start = time.perf_counter()
+    import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+    result = {'import_ms': (time.perf_counter() - start) * 1000}
+
+    if scenario == 'client_setup':
+        for service_name in ('kinesisanalyticsv2', 'sns', 'dynamodb'):
+            snapshot_manager.get_client(service_name, BENCHMARK_ENVIRONMENT['aws_region'])
+        result.update({'{0}_ms'.format(service_name): setup_ms
+                       for service_name, setup_ms in snapshot_manager._client_setup_ms.items()})
+    elif scenario in ('first_invocation', 'app_not_found'):
+        import snapshot_manager_fakes as fakes
+        kinesis_analytics = fakes.FakeKinesisAnalytics(snapshot_completion_seconds=0.02)
+        if scenario == 'first_invocation':
+            kinesis_analytics.add_application(BENCHMARK_ENVIRONMENT['app_name'], num_of_snapshots=10)
+        clients = fakes.install_fakes(BENCHMARK_ENVIRONMENT['aws_region'], kinesis_analytics=kinesis_analytics)
+        for invocation in ('first', 'second'):
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                try:
+                    snapshot_manager.lambda_handler({}, None)
+                except Exception:
+                    pass
+            result['{0}_invocation_ms'.format(invocation)] = (time.perf_counter() - start) * 1000
+        result['services_called'] = sorted(service_name for service_name, client in clients.items()
+                                           if client.call_counts)
+        result['boto3_imported'] = 'boto3' in sys.modules
+
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def run_sample(scenario):
+    """
+    This function runs one scenario in a fresh Python process and returns its measurements
+    :param scenario:
+    :return:
+    """
+    environment = dict(os.environ, **BENCHMARK_ENVIRONMENT)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIR, os.environ.get('PYTHONPATH')]))
+    environment.pop('app_names', None)
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario], env=environment,
+                            cwd=ROOT_DIR, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot Manager cold-start benchmark')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, help='scenarios to run, all by default')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes per scenario')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+
+    for scenario in SCENARIOS:
+        if args.scenarios and scenario not in args.scenarios:
+            continue
+        samples = [run_sample(scenario) for _ in range(args.repeat)]
+        medians = {name: statistics.median(sample[name] for sample in samples)
+                   for name, value in samples[0].items() if isinstance(value, (int, float))
+                   and not isinstance(value, bool)}
+        details = {name: value for name, value in samples[0].items() if name not in medians}
+        print('{0:<17} {1}{2}'.format(scenario, '  '.join('{0}={1:.1f}'.format(name, value)
+                                                          for name, value in medians.items()),
+                                      '  ' + json.dumps(details) if details else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+End-to-end benchmark of the Snapshot Manager handler against the in-process stand-ins of Kinesis Data Analytics, SNS
+and DynamoDB (see snapshot_manager_fakes.py). No AWS account is needed. For each scenario it reports the wall-clock
+time, the time spent in the handler (i.e. the billed duration), the API calls received by the stand-ins, the peak
+memory allocated during the run and the run outcomes. With --completion-mode deferred, the snapshots are checked by
+further handler invocations fed by the SQS stand-in, and with --deletion-mode queued, the expired snapshots are
+deleted by them.
+
+Usage: python benchmarks/bench_end_to_end.py [--scenarios fleet_100 inventory_50k ...] [--latency 0.005]
+                                            [--service-rate-limit 20] [--completion-mode deferred]
+                                            [--deletion-mode queued]
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager  # noqa: E402
+import snapshot_manager_fakes as fakes  # noqa: E402
+
+REGION = 'us-east-1'
+
+# name, number of applications, snapshots per application, snapshot completion seconds, failing snapshots
+SCENARIOS = [
+    ('fleet_1', 1, 10, 0.1, False),
+    ('fleet_100', 100, 10, 0.1, False),
+    ('fleet_1000', 1000, 10, 0.1, False),
+    ('inventory_10', 1, 10, 0.1, False),
+    ('inventory_1k', 1, 1000, 0.1, False),
+    ('inventory_50k', 1, 50000, 0.1, False),
+    ('slow_snapshots', 10, 10, 5.0, False),
+    ('failing_snapshots', 10, 10, 0.1, True)
+]
+
+BENCHMARK_ENVIRONMENT = {
+    'aws_region': REGION,
+    'snapshot_manager_ddb_table_name': 'snapshot_manager_status',
+    'primary_partition_key_name': 'app_name',
+    'primary_sort_key_name': 'snapshot_manager_run_id',
+    'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789012:snapshot-manager',
+    'number_of_older_snapshots_to_retain': '5',
+    'snapshot_creation_wait_time_seconds': '1',
+    'snapshot_first_probe_seconds': '0.05',
+    'snapshot_completion_deadline_seconds': '2',
+    'fleet_max_workers': '50',
+    # the stand-ins only throttle with --service-rate-limit, so the client side limit is set out of the way
+    'kda_api_requests_per_second': '100000',
+    'snapshot_completion_queue_url': 'benchmark-queue',
+    'snapshot_deletion_queue_url': 'benchmark-deletion-queue'
+}
+
+
+def run_scenario(name, num_of_apps, num_of_snapshots, completion_seconds, failing_snapshots, latency_seconds,
+                 service_rate_limit=None, completion_mode='inline', deletion_mode='inline'):
+    """
+    This function runs the handler once for a scenario and returns its measurements
+    :param name:
+    :param num_of_apps:
+    :param num_of_snapshots:
+    :param completion_seconds:
+    :param failing_snapshots:
+    :param latency_seconds:
+    :param service_rate_limit:
+    :param completion_mode:
+    :param deletion_mode:
+    :return:
+    """
+    os.environ['completion_mode'] = completion_mode
+    os.environ['deletion_mode'] = deletion_mode
+    kinesis_analytics = fakes.FakeKinesisAnalytics(latency_seconds=latency_seconds,
+                                                   snapshot_completion_seconds=completion_seconds,
+                                                   requests_per_second=service_rate_limit)
+    app_names = ['{0}-app-{1}'.format(name, index) for index in range(num_of_apps)]
+    for app_name in app_names:
+        kinesis_analytics.add_application(app_name, num_of_snapshots=num_of_snapshots,
+                                          failing_snapshots=failing_snapshots)
+    clients = fakes.install_fakes(REGION, kinesis_analytics=kinesis_analytics,
+                                  sns=fakes.FakeSNS(latency_seconds=latency_seconds),
+                                  dynamodb=fakes.FakeDynamoDB(latency_seconds=latency_seconds))
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        response = snapshot_manager.lambda_handler({'app_names': app_names}, None)
+        handler_seconds = time.perf_counter() - start
+        app_bodies = list(snapshot_manager.json.loads(response['body'])['apps'].values())
+        deletion_jobs = []
+        if completion_mode == 'deferred':
+            app_bodies = []
+        # each queue triggers its own invocations, like with one event source per queue
+        while clients['sqs'].queued_messages:
+            invocation_start = time.perf_counter()
+            for queue_url in (BENCHMARK_ENVIRONMENT['snapshot_completion_queue_url'],
+                              BENCHMARK_ENVIRONMENT['snapshot_deletion_queue_url']):
+                response = clients['sqs'].deliver(snapshot_manager.lambda_handler, queue_url=queue_url)
+                if response is not None:
+                    break
+            if response is None:
+                time.sleep(0.05)
+                continue
+            handler_seconds += time.perf_counter() - invocation_start
+            response_body = snapshot_manager.json.loads(response['body'])
+            app_bodies += response_body.get('apps', [])
+            deletion_jobs += response_body.get('jobs', [])
+    wall_seconds = time.perf_counter() - start
+    peak_mib = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'apps': num_of_apps,
+        'snapshots': num_of_snapshots,
+        'wall_seconds': wall_seconds,
+        'handler_seconds': handler_seconds,
+        'kda_calls': sum(clients['kinesisanalyticsv2'].call_counts.values()),
+        'kda_throttles': sum(clients['kinesisanalyticsv2'].throttle_counts.values()),
+        'sns_calls': sum(clients['sns'].call_counts.values()),
+        'ddb_calls': sum(clients['dynamodb'].call_counts.values()),
+        'peak_mib': peak_mib,
+        'completed': sum(1 for app_body in app_bodies if app_body.get('new_snapshot_completed')),
+        'delayed': sum(1 for app_body in app_bodies if app_body.get('new_snapshot_creation_delayed')),
+        'failed': sum(1 for app_body in app_bodies if app_body.get('new_snapshot_failed')),
+        'deleted': sum(app_body.get('num_of_snapshot_deleted', 0) for app_body in app_bodies) +
+        sum(deletion_job['num_of_snapshots_deleted'] for deletion_job in deletion_jobs if not deletion_job['retry'])
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot Manager end-to-end benchmark')
+    parser.add_argument('--scenarios', nargs='+', choices=[scenario[0] for scenario in SCENARIOS],
+                        help='scenarios to run, all by default')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated latency of every API call in seconds')
+    parser.add_argument('--service-rate-limit', type=float,
+                        help='simulated requests per second accepted by each Kinesis Data Analytics API')
+    parser.add_argument('--completion-mode', choices=('inline', 'deferred'), default='inline')
+    parser.add_argument('--deletion-mode', choices=('inline', 'queued'), default='inline')
+    args = parser.parse_args()
+
+    os.environ.update(BENCHMARK_ENVIRONMENT)
+    os.environ.pop('app_names', None)
+    header = '{0:<18} {1:>5} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>6} {8:>6} {9:>9} {10:>9} {11:>7} {12:>6} {13:>8}'
+    print(header.format('scenario', 'apps', 'snapshots', 'wall s', 'handler s', 'kda', 'throttled', 'sns', 'ddb',
+                        'peak MiB', 'completed', 'delayed', 'failed', 'deleted'))
+    for scenario in SCENARIOS:
+        if args.scenarios and scenario[0] not in args.scenarios:
+            continue
+        result = run_scenario(*scenario, latency_seconds=args.latency, service_rate_limit=args.service_rate_limit,
+                              completion_mode=args.completion_mode, deletion_mode=args.deletion_mode)
+        print('{scenario:<18} {apps:>5} {snapshots:>9} {wall_seconds:>9.2f} {handler_seconds:>9.2f} {kda_calls:>9} '
+              '{kda_throttles:>9} {sns_calls:>6} {ddb_calls:>6} {peak_mib:>9.1f} {completed:>9} {delayed:>7} '
+              '{failed:>6} {deleted:>8}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Microbenchmark of the retention selection. It compares the previous approach, i.e. loading every snapshot summary
+into a list, sorting it and slicing off the most recent ones, with the streaming bounded-heap selector of the
+Snapshot Manager, and times the tiered retention planner on a pre-sorted inventory. It reports the wall-clock time
+and the peak memory allocated while selecting.
+
+Usage: python benchmarks/bench_retention_selection.py [--sizes 10000 50000 100000] [--retain 30] [--repeat 3]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager  # noqa: E402
+
+
+def synthetic_snapshot_summaries(num_of_snapshots, seed=42):
+    """
+    This function streams synthetic snapshot summaries with random creation times, without holding them in memory
+    :param num_of_snapshots:
+    :param seed:
+    :return:
+    """
+    rnd = random.Random(seed)
+    start_time = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    for position in range(num_of_snapshots):
+        yield {
+            'SnapshotName': 'custom_{0}'.format(position),
+            'SnapshotStatus': 'READY',
+            'ApplicationVersionId': 1,
+            'SnapshotCreationTimestamp': start_time + datetime.timedelta(seconds=rnd.randrange(10 ** 9))
+        }
+
+
+def list_and_sort(snapshots, num_of_snapshots_to_retain):
+    """
+    This function selects the snapshots to be deleted the way the Snapshot Manager did before streaming selection
+    :param snapshots:
+    :param num_of_snapshots_to_retain:
+    :return:
+    """
+    snapshot_list = list(snapshots)
+    sorted_snapshots = sorted(snapshot_list, key=lambda k: k['SnapshotCreationTimestamp'], reverse=True)
+    return sorted_snapshots[num_of_snapshots_to_retain:None]
+
+
+def streaming_heap(snapshots, num_of_snapshots_to_retain):
+    """
+    This function selects the snapshots to be deleted with the streaming selector. Candidates are consumed one by
+    one, as the deletion workers do, instead of being collected.
+    :param snapshots:
+    :param num_of_snapshots_to_retain:
+    :return:
+    """
+    num_of_snapshots_to_delete = 0
+    for _ in snapshot_manager.select_snapshots_to_delete(snapshots, num_of_snapshots_to_retain):
+        num_of_snapshots_to_delete += 1
+    return num_of_snapshots_to_delete
+
+
+def tiered_plan(snapshots, num_of_snapshots_to_retain):
+    """
+    This function plans the retention with hourly, daily and weekly tiers. Only the planning is timed, the inventory
+    is sorted beforehand, as the planner expects.
+    :param snapshots:
+    :param num_of_snapshots_to_retain:
+    :return:
+    """
+    retention_policy = {
+        "num_of_recent_snapshots": num_of_snapshots_to_retain,
+        "num_of_hourly_snapshots": 24,
+        "num_of_daily_snapshots": 7,
+        "num_of_weekly_snapshots": 4,
+        "pinned_snapshot_names": frozenset()
+    }
+    start = time.perf_counter()
+    snapshot_manager.plan_snapshot_retention(snapshots, retention_policy)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure(selector, num_of_snapshots, num_of_snapshots_to_retain, repeat):
+    """
+    This function returns the best wall-clock time in milliseconds and the peak traced memory in KiB of a selector
+    :param selector:
+    :param num_of_snapshots:
+    :param num_of_snapshots_to_retain:
+    :param repeat:
+    :return:
+    """
+    best_ms = None
+    for _ in range(repeat):
+        snapshots = synthetic_snapshot_summaries(num_of_snapshots)
+        if selector is tiered_plan:
+            snapshots = sorted(snapshots, key=lambda k: k['SnapshotCreationTimestamp'], reverse=True)
+            elapsed_ms = tiered_plan(snapshots, num_of_snapshots_to_retain)
+        else:
+            start = time.perf_counter()
+            selector(snapshots, num_of_snapshots_to_retain)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+        best_ms = elapsed_ms if best_ms is None else min(best_ms, elapsed_ms)
+    peak_kib = None
+    if selector is not tiered_plan:
+        tracemalloc.start()
+        selector(synthetic_snapshot_summaries(num_of_snapshots), num_of_snapshots_to_retain)
+        peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return best_ms, peak_kib
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Retention selection microbenchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 100000])
+    parser.add_argument('--retain', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{0:>10} {1:>16} {2:>12} {3:>14}'.format('snapshots', 'selector', 'best ms', 'peak KiB'))
+    for num_of_snapshots in args.sizes:
+        for selector_name, selector in (('list_and_sort', list_and_sort), ('streaming_heap', streaming_heap),
+                                        ('tiered_plan', tiered_plan)):
+            best_ms, peak_kib = measure(selector, num_of_snapshots, args.retain, args.repeat)
+            peak = '-' if peak_kib is None else '{0:.1f}'.format(peak_kib)
+            print('{0:>10} {1:>16} {2:>12.1f} {3:>14}'.format(num_of_snapshots, selector_name, best_ms, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Sharding benchmark of the fleet orchestrator. It runs the same fleet through the orchestrator with a growing number
+of shards, each shard being handled by a worker invocation of the in-process Lambda stand-in (see
+snapshot_manager_fakes.py), and reports the wall-clock time, the throughput in applications per second, the
+concurrent worker invocations, the sizes of the shards and the run outcomes. No AWS account is needed. Within one
+process the shard workers share the client side rate limiters, which is why they are set out of the way.
+
+Usage: python benchmarks/bench_sharding.py [--apps 1000] [--shards 1 2 4 8 16] [--latency 0.005]
+                                           [--fleet-max-workers 10] [--service-rate-limit 200]
+"""
+
+import os
+import sys
+import time
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager  # noqa: E402
+import snapshot_manager_fakes as fakes  # noqa: E402
+
+REGION = 'us-east-1'
+
+BENCHMARK_ENVIRONMENT = {
+    'aws_region': REGION,
+    'snapshot_manager_ddb_table_name': 'snapshot_manager_status',
+    'primary_partition_key_name': 'app_name',
+    'primary_sort_key_name': 'snapshot_manager_run_id',
+    'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789012:snapshot-manager',
+    'number_of_older_snapshots_to_retain': '5',
+    'snapshot_creation_wait_time_seconds': '1',
+    'snapshot_first_probe_seconds': '0.05',
+    'snapshot_completion_deadline_seconds': '2',
+    'kda_api_requests_per_second': '100000',
+    'fleet_shard_function_name': 'snapshot-manager'
+}
+
+
+def run_sharded_fleet(num_of_apps, num_of_shards, latency_seconds, fleet_max_workers, service_rate_limit=None):
+    """
+    This function runs the orchestrator once on a fleet split into num_of_shards shards and returns its measurements
+    :param num_of_apps:
+    :param num_of_shards:
+    :param latency_seconds:
+    :param fleet_max_workers:
+    :param service_rate_limit:
+    :return:
+    """
+    os.environ['fleet_num_of_shards'] = str(num_of_shards)
+    os.environ['fleet_max_workers'] = str(fleet_max_workers)
+    kinesis_analytics = fakes.FakeKinesisAnalytics(latency_seconds=latency_seconds, snapshot_completion_seconds=0.1,
+                                                   requests_per_second=service_rate_limit)
+    app_names = ['sharded-app-{0}'.format(index) for index in range(num_of_apps)]
+    for app_name in app_names:
+        kinesis_analytics.add_application(app_name, num_of_snapshots=10)
+    aws_lambda = fakes.FakeLambda(latency_seconds=latency_seconds)
+    fakes.install_fakes(REGION, kinesis_analytics=kinesis_analytics,
+                        sns=fakes.FakeSNS(latency_seconds=latency_seconds),
+                        dynamodb=fakes.FakeDynamoDB(latency_seconds=latency_seconds), aws_lambda=aws_lambda)
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        response = snapshot_manager.lambda_handler({'app_names': app_names}, None)
+    wall_seconds = time.perf_counter() - start
+    response_body = snapshot_manager.json.loads(response['body'])
+    shard_sizes = [shard['num_of_apps'] for shard in response_body.get('shards', [])] or [num_of_apps]
+
+    return {
+        'shards': num_of_shards,
+        'apps': num_of_apps,
+        'wall_seconds': wall_seconds,
+        'apps_per_second': num_of_apps / wall_seconds,
+        'workers': aws_lambda.max_running_invocations or 1,
+        'min_shard': min(shard_sizes),
+        'max_shard': max(shard_sizes),
+        'kda_throttles': sum(kinesis_analytics.throttle_counts.values()),
+        'completed': response_body.get('run_outcomes', {}).get('snapshot_completed', sum(
+            1 for app_body in response_body['apps'].values()
+            if isinstance(app_body, dict) and app_body.get('new_snapshot_completed')))
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot Manager sharding benchmark')
+    parser.add_argument('--apps', type=int, default=1000, help='applications in the fleet')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='shard counts to run')
+    parser.add_argument('--latency', type=float, default=0.005, help='simulated latency of every API call in seconds')
+    parser.add_argument('--fleet-max-workers', type=int, default=10, help='concurrent applications per worker')
+    parser.add_argument('--service-rate-limit', type=float,
+                        help='simulated requests per second accepted by each Kinesis Data Analytics API')
+    args = parser.parse_args()
+
+    os.environ.update(BENCHMARK_ENVIRONMENT)
+    os.environ.pop('app_names', None)
+    print('{0:>6} {1:>6} {2:>9} {3:>9} {4:>7} {5:>9} {6:>9} {7:>9} {8:>9}'.format(
+        'shards', 'apps', 'wall s', 'apps/s', 'workers', 'min shard', 'max shard', 'throttled', 'completed'))
+    for num_of_shards in args.shards:
+        result = run_sharded_fleet(args.apps, num_of_shards, args.latency, args.fleet_max_workers,
+                                   args.service_rate_limit)
+        print('{shards:>6} {apps:>6} {wall_seconds:>9.2f} {apps_per_second:>9.1f} {workers:>7} {min_shard:>9} '
+              '{max_shard:>9} {kda_throttles:>9} {completed:>9}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Schedule simulator of the Snapshot Manager. It lays out the Kinesis Data Analytics control-plane calls of one
+schedule interval for a fleet, without running anything, and prints the resulting per-second call rate for each way
+of starting the runs:
+
+    aligned       all applications start at the same moment, like with one rate(15 minutes) rule
+    fleet         one invocation for the fleet, each application delayed by its offset within --window seconds
+    per_app       one rule per minute of the application offsets, the function waiting for the seconds of them
+
+--jitter adds a random delay of up to that many seconds to the fleet and per_app starts. Each run describes the
+application and requests a snapshot, polls it with the backoff of wait_for_snapshot_completion until it is ready,
+lists the snapshots and deletes the expired ones at the client side rate limit.
+
+Usage: python benchmarks/simulate_schedule.py [--apps 1000] [--interval 900] [--window 600] [--jitter 10]
+                                              [--snapshot-seconds 15] [--limit 50] [--timeline]
+"""
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager  # noqa: E402
+
+MODES = ('aligned', 'fleet', 'per_app')
+
+
+def get_run_call_times(snapshot_seconds, first_probe_seconds, max_wait_seconds, deletions_per_run,
+                       requests_per_second):
+    """
+    This function returns the times of the control-plane calls of one run, in seconds from its start. The polls use
+    the middle of the jitter range of wait_for_snapshot_completion.
+    :param snapshot_seconds:
+    :param first_probe_seconds:
+    :param max_wait_seconds:
+    :param deletions_per_run:
+    :param requests_per_second:
+    :return:
+    """
+    call_times = [0.0, 0.0]
+    elapsed_seconds = 0.0
+    wait_seconds = first_probe_seconds
+    num_of_checks = 0
+    while True:
+        elapsed_seconds += wait_seconds
+        num_of_checks += 1
+        call_times.append(elapsed_seconds)
+        if elapsed_seconds >= snapshot_seconds:
+            break
+        backoff_seconds = min(max(max_wait_seconds, first_probe_seconds), first_probe_seconds * 2 ** num_of_checks)
+        wait_seconds = (first_probe_seconds + backoff_seconds) / 2
+    call_times.append(elapsed_seconds)
+    call_times.extend(elapsed_seconds + (index + 1) / requests_per_second for index in range(deletions_per_run))
+    return call_times
+
+
+def get_start_times(mode, app_names, interval_seconds, window_seconds, jitter_seconds, rng):
+    """
+    This function returns the start time of the run of each application within the interval for a mode
+    :param mode:
+    :param app_names:
+    :param interval_seconds:
+    :param window_seconds:
+    :param jitter_seconds:
+    :param rng:
+    :return:
+    """
+    if mode == 'aligned':
+        return [0.0] * len(app_names)
+    # per_app: the minute of the rule plus the seconds waited by the function, i.e. the offset within the interval
+    offset_window_seconds = window_seconds if mode == 'fleet' else interval_seconds
+    return [snapshot_manager.get_app_schedule_offset(app_name, offset_window_seconds) +
+            (rng.uniform(0, jitter_seconds) if jitter_seconds > 0 else 0.0) for app_name in app_names]
+
+
+def simulate(mode, args):
+    """
+    This function returns the number of control-plane calls in each second of the interval for a mode
+    :param mode:
+    :param args:
+    :return:
+    """
+    app_names = ['{0}-{1}'.format(args.app_prefix, index) for index in range(args.apps)]
+    run_call_times = get_run_call_times(args.snapshot_seconds, args.first_probe_seconds, args.max_wait_seconds,
+                                        args.deletions_per_run, args.requests_per_second)
+    calls_per_second = [0] * args.interval
+    for start_time in get_start_times(mode, app_names, args.interval, args.window, args.jitter,
+                                      random.Random(args.seed)):
+        for call_time in run_call_times:
+            # calls past the end of the interval overlap the next one
+            calls_per_second[int(start_time + call_time) % args.interval] += 1
+    return calls_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Snapshot Manager schedule simulator')
+    parser.add_argument('--apps', type=int, default=1000, help='applications in the fleet')
+    parser.add_argument('--app-prefix', default='app', help='application names are <prefix>-<index>')
+    parser.add_argument('--interval', type=int, default=900, help='schedule interval in seconds')
+    parser.add_argument('--window', type=float, default=600, help='stagger_window_seconds of the fleet mode')
+    parser.add_argument('--jitter', type=float, default=0.0, help='stagger_jitter_seconds')
+    parser.add_argument('--snapshot-seconds', type=float, default=15, help='time a snapshot takes to be ready')
+    parser.add_argument('--first-probe-seconds', type=float, default=1, help='snapshot_first_probe_seconds')
+    parser.add_argument('--max-wait-seconds', type=float, default=15, help='snapshot_creation_wait_time_seconds')
+    parser.add_argument('--deletions-per-run', type=int, default=1, help='expired snapshots deleted by each run')
+    parser.add_argument('--requests-per-second', type=float, default=10, help='kda_api_requests_per_second')
+    parser.add_argument('--limit', type=float, help='control-plane calls per second above which calls throttle')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--timeline', action='store_true', help='print the peak rate of each minute')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    timelines = {}
+    print('{0:<8} {1:>6} {2:>7} {3:>7} {4:>7} {5:>7} {6:>11}'.format(
+        'mode', 'apps', 'calls', 'peak/s', 'p99/s', 'mean/s', 'seconds>lim'))
+    for mode in args.modes:
+        calls_per_second = simulate(mode, args)
+        sorted_rates = sorted(calls_per_second)
+        timelines[mode] = [max(calls_per_second[minute_start:minute_start + 60])
+                           for minute_start in range(0, args.interval, 60)]
+        print('{0:<8} {1:>6} {2:>7} {3:>7} {4:>7} {5:>7.2f} {6:>11}'.format(
+            mode, args.apps, sum(calls_per_second), sorted_rates[-1],
+            sorted_rates[min(len(sorted_rates) - 1, int(len(sorted_rates) * 0.99))],
+            sum(calls_per_second) / args.interval,
+            sum(1 for rate in calls_per_second if rate > args.limit) if args.limit else '-'))
+    if args.timeline:
+        print()
+        print('{0:<8} '.format('minute') + ' '.join('{0:>7}'.format(mode) for mode in args.modes))
+        for minute, _ in enumerate(timelines[args.modes[0]]):
+            print('{0:<8} '.format(minute) + ' '.join('{0:>7}'.format(timelines[mode][minute])
+                                                      for mode in args.modes))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import hashlib
 
 from pstats import SortKey
 from aws_cdk import (
@@ -8,6 +9,7 @@ from aws_cdk import (
     Stack,
     RemovalPolicy,
     Duration,
+    ArnFormat,
     CfnOutput,
     CfnParameter,
     RemovalPolicy,
@@ -17,8 +19,10 @@ from aws_cdk import (
     aws_dynamodb as _dyn,
     aws_logs as logs,
     aws_events as events,
-    aws_events_targets as events_target
-    # aws_sqs as sqs,
+    aws_events_targets as events_target,
+    aws_sqs as sqs,
+    aws_iam as iam,
+    aws_lambda_event_sources as lambda_event_sources
 )
 from constructs import Construct
 # For consistency with other languages, `cdk` is the preferred import name for
@@ -28,6 +32,12 @@ from constructs import Construct
 # from aws_cdk import core
 
 
+def get_schedule_offset_seconds(app_name, interval_seconds):
+    # same as get_app_schedule_offset in the function, so that the function finds the seconds of the offset of an
+    # application within the minute of its rule
+    return int(hashlib.md5(app_name.encode('utf-8')).hexdigest()[:16], 16) % (interval_seconds * 1000) / 1000
+
+
 class CdkPythonStack(Stack):
 
     def __init__(self, app: App, id: str) -> None:
@@ -36,8 +46,14 @@ class CdkPythonStack(Stack):
         #SNS Topic
         # Read runtime context values
         kda_app_name = self.node.try_get_context("app_name")
+        kda_app_names = self.node.try_get_context("app_names")
         snapshots_to_retain = self.node.try_get_context("snapshots_to_retain")
         snapshot_wait_time_seconds = self.node.try_get_context("snapshot_wait_time_seconds")
+        completion_mode = self.node.try_get_context("completion_mode") or "inline"
+        deletion_mode = self.node.try_get_context("deletion_mode") or "inline"
+        fleet_num_of_shards = int(self.node.try_get_context("fleet_num_of_shards") or 1)
+        schedule_offsets = str(self.node.try_get_context("schedule_offsets") or "false").lower() == "true"
+        schedule_jitter_seconds = self.node.try_get_context("schedule_jitter_seconds") or "0"
         # email_address = self.node.try_get_context("email_address")
 
         #SNS Topic
@@ -62,6 +78,21 @@ class CdkPythonStack(Stack):
             billing_mode=_dyn.BillingMode.PAY_PER_REQUEST,
             removal_policy = RemovalPolicy.DESTROY
         )
+        # Index of the runs of all applications by UTC date and run id, read by snapshot_manager_audit_query.py
+        dynamo_table.add_global_secondary_index(
+            index_name="runs_by_time",
+            partition_key=_dyn.Attribute(
+                name="run_date",
+                type=_dyn.AttributeType.STRING
+            ),
+            sort_key=_dyn.Attribute(
+                name="snapshot_manager_run_id",
+                type=_dyn.AttributeType.NUMBER
+            ),
+            projection_type=_dyn.ProjectionType.INCLUDE,
+            non_key_attributes=["run_outcome", "new_snapshot_name", "flink_app_version_id",
+                                "num_of_snapshots_deleted", "num_of_snapshots_failed_to_be_deleted"]
+        )
         
         
         # Create the AWS Lambda function to subscribe to Amazon SQS queue
@@ -71,6 +102,9 @@ class CdkPythonStack(Stack):
             runtime=_lambda.Runtime.PYTHON_3_9,
             handler="kda_flink_snapshot_manager.lambda_handler",
             code=_lambda.Code.from_asset("lambda"),
+            # the default of 3 seconds is shorter than the safety margin of the time budget, see the Time budget
+            # section of the README. The timeout stays below the visibility timeout of the queues.
+            timeout=Duration.minutes(3),
             environment = {
             'aws_region':	"us-east-1"	,
             'app_name' :	kda_app_name,
@@ -83,6 +117,61 @@ class CdkPythonStack(Stack):
           }
         )
 
+        # Fleet mode: manage a comma separated list of applications from one function
+        if kda_app_names:
+            lambda_function.add_environment('app_names', kda_app_names)
+
+        # Sharded fleet mode: the scheduled invocation splits the fleet into shards and invokes the function itself
+        # once per shard. The permission is granted on the function name pattern of the stack, since a grant on the
+        # function's own ARN would make its role depend on it.
+        if fleet_num_of_shards > 1:
+            lambda_function.add_environment('fleet_num_of_shards', str(fleet_num_of_shards))
+            lambda_function.add_to_role_policy(iam.PolicyStatement(
+                actions=["lambda:InvokeFunction"],
+                resources=[self.format_arn(service="lambda", resource="function",
+                                           resource_name=f"{self.stack_name}-*",
+                                           arn_format=ArnFormat.COLON_RESOURCE_NAME)]
+            ))
+
+        # Deferred completion mode: the scheduled invocation only initiates the snapshots, a delayed message on this
+        # queue triggers the function again to check them and apply the retention policy
+        if completion_mode == "deferred":
+            snapshot_completion_queue = sqs.Queue(
+                self, "SnapshotCompletionQueue",
+                visibility_timeout=Duration.minutes(5),
+                retention_period=Duration.days(1)
+            )
+            lambda_function.add_environment('completion_mode', completion_mode)
+            lambda_function.add_environment('snapshot_completion_queue_url', snapshot_completion_queue.queue_url)
+            lambda_function.add_event_source(lambda_event_sources.SqsEventSource(
+                snapshot_completion_queue,
+                batch_size=10,
+                report_batch_item_failures=True
+            ))
+            snapshot_completion_queue.grant_send_messages(lambda_function)
+
+        # Queued deletion mode: expired snapshots are sent as deletion jobs to this queue, which triggers the function
+        # to delete them off the snapshot critical path. Jobs failing 5 times go to the dead-letter queue.
+        if deletion_mode == "queued":
+            snapshot_deletion_dead_letter_queue = sqs.Queue(
+                self, "SnapshotDeletionDeadLetterQueue",
+                retention_period=Duration.days(14)
+            )
+            snapshot_deletion_queue = sqs.Queue(
+                self, "SnapshotDeletionQueue",
+                visibility_timeout=Duration.minutes(5),
+                retention_period=Duration.days(4),
+                dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=snapshot_deletion_dead_letter_queue)
+            )
+            lambda_function.add_environment('deletion_mode', deletion_mode)
+            lambda_function.add_environment('snapshot_deletion_queue_url', snapshot_deletion_queue.queue_url)
+            lambda_function.add_event_source(lambda_event_sources.SqsEventSource(
+                snapshot_deletion_queue,
+                batch_size=10,
+                report_batch_item_failures=True
+            ))
+            snapshot_deletion_queue.grant_send_messages(lambda_function)
+
         # Set Lambda Logs Retention and Removal Policy
         logs.LogGroup(
             self,
@@ -94,14 +183,36 @@ class CdkPythonStack(Stack):
 
         #Event Bridge rule
         #Change the rate according to your needs
-        rule = events.Rule(self, 'Rule',
-           description = "Trigger Lambda function every 15 minutes",
-           schedule = events.Schedule.expression('rate(15 minutes)')
-        )
-
-        rule.add_target(events_target.LambdaFunction(lambda_function))
-
-        dynamo_table.grant_write_data(lambda_function)
+        if not schedule_offsets:
+            rule = events.Rule(self, 'Rule',
+               description = "Trigger Lambda function every 15 minutes",
+               schedule = events.Schedule.expression('rate(15 minutes)')
+            )
+
+            rule.add_target(events_target.LambdaFunction(lambda_function))
+        else:
+            # Staggered schedule: the applications are grouped by the minute of their offset into at most 15 rules,
+            # each every 15 minutes from its minute, and the function waits for the seconds of the offset of each
+            # application plus a random jitter, so that the runs of a fleet spread over the 15 minutes instead of all
+            # hitting the control plane at once. The wait is billed, up to a minute per run.
+            lambda_function.add_environment('stagger_window_seconds', '60')
+            lambda_function.add_environment('stagger_jitter_seconds', str(schedule_jitter_seconds))
+            app_names_by_minute = {}
+            for app_name in (kda_app_names.split(',') if kda_app_names else [kda_app_name]):
+                offset_minute = int(get_schedule_offset_seconds(app_name.strip(), 15 * 60) // 60)
+                app_names_by_minute.setdefault(offset_minute, []).append(app_name.strip())
+            for offset_minute, app_names in sorted(app_names_by_minute.items()):
+                rule = events.Rule(self, f'Rule-{offset_minute}',
+                   description = f"Trigger Lambda function for {len(app_names)} application(s) every 15 minutes",
+                   schedule = events.Schedule.cron(minute=f"{offset_minute}/15")
+                )
+                rule.add_target(events_target.LambdaFunction(
+                    lambda_function,
+                    event=events.RuleTargetInput.from_object({"app_names": app_names})
+                ))
+
+        # read access is needed for the run checkpoints
+        dynamo_table.grant_read_write_data(lambda_function)
         # Grant publish to lambda function
         sns_topic.grant_publish(lambda_function)
 
@@ -0,0 +1,241 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Reads the Snapshot Manager audit table back. It fetches the latest restorable snapshot of an application, the last N
+runs of an application, all runs of the fleet in a time window through the run time index, or the full details of one
+run. Reads are paginated and use projection expressions, so only the attributes that are shown are read.
+
+Usage:
+    python snapshot_manager_audit_query.py latest my-kda-app
+    python snapshot_manager_audit_query.py app-runs my-kda-app --limit 10
+    python snapshot_manager_audit_query.py fleet-runs --since 1h
+    python snapshot_manager_audit_query.py fleet-runs --start 2022-03-01T00:00:00 --end 2022-03-02T00:00:00
+    python snapshot_manager_audit_query.py run my-kda-app 1646092800000
+"""
+
+import os
+import json
+import argparse
+import datetime
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+
+# attributes read by the run listings, the table keys are added to them
+RUN_SUMMARY_ATTRIBUTES = snapshot_manager.RUN_TIME_INDEX_ATTRIBUTES
+
+
+def decode_item(item):
+    """
+    This function decodes a DynamoDB item with scalar attributes into a plain dictionary
+    :param item:
+    :return:
+    """
+    decoded_item = {}
+    for attribute_name, attribute in item.items():
+        attribute_type, value = next(iter(attribute.items()))
+        if attribute_type == 'N':
+            value = int(value) if value.lstrip('-').isdigit() else float(value)
+        decoded_item[attribute_name] = value
+    return decoded_item
+
+
+def projection(attribute_names):
+    """
+    This function builds a projection expression and its attribute name placeholders
+    :param attribute_names:
+    :return:
+    """
+    expression_attribute_names = {'#a{0}'.format(index): name for index, name in enumerate(attribute_names)}
+    return ', '.join(expression_attribute_names), expression_attribute_names
+
+
+def paginate_query(dynamodb, **query_kwargs):
+    """
+    This function streams the items of a DynamoDB query, following LastEvaluatedKey page by page
+    :param dynamodb:
+    :param query_kwargs:
+    :return:
+    """
+    while True:
+        response = dynamodb.query(**query_kwargs)
+        for item in response.get('Items', []):
+            yield item
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_app_runs(dynamodb, table_name, app_name, limit=10, partition_key='app_name',
+                   sort_key='snapshot_manager_run_id', attribute_names=RUN_SUMMARY_ATTRIBUTES):
+    """
+    This function returns the last runs of an application, most recent first. Overflow items are filtered out, so
+    every run counts once.
+    :param dynamodb:
+    :param table_name:
+    :param app_name:
+    :param limit:
+    :param partition_key:
+    :param sort_key:
+    :param attribute_names:
+    :return:
+    """
+    projection_expression, expression_attribute_names = projection(
+        [partition_key, sort_key] + list(attribute_names))
+    expression_attribute_names.update({'#pk': partition_key, '#sk': sort_key, '#overflow': 'overflow_of_run_id'})
+    items = paginate_query(
+        dynamodb,
+        TableName=table_name,
+        KeyConditionExpression='#pk = :app_name AND #sk > :zero',
+        FilterExpression='attribute_not_exists(#overflow)',
+        ProjectionExpression=projection_expression,
+        ExpressionAttributeNames=expression_attribute_names,
+        ExpressionAttributeValues={':app_name': {'S': app_name}, ':zero': {'N': '0'}},
+        ScanIndexForward=False,
+        # overflow items are filtered after the limit is applied, so read a few more per page
+        Limit=limit + 5
+    )
+    runs = []
+    for item in items:
+        runs.append(decode_item(item))
+        if len(runs) >= limit:
+            break
+    return runs
+
+
+def iter_fleet_runs(dynamodb, table_name, start_time, end_time, sort_key='snapshot_manager_run_id',
+                    index_name=snapshot_manager.RUN_TIME_INDEX_NAME, attribute_names=RUN_SUMMARY_ATTRIBUTES,
+                    partition_key='app_name'):
+    """
+    This function streams the runs of all applications between start_time and end_time (UTC datetimes) through the
+    run time index, oldest first. A window within one UTC day is a single index query, a longer one takes one query
+    per day.
+    :param dynamodb:
+    :param table_name:
+    :param start_time:
+    :param end_time:
+    :param sort_key:
+    :param index_name:
+    :param attribute_names:
+    :param partition_key:
+    :return:
+    """
+    start_run_id = int(start_time.timestamp() * 1000)
+    end_run_id = int(end_time.timestamp() * 1000)
+    projection_expression, expression_attribute_names = projection(
+        [partition_key, sort_key] + list(attribute_names))
+    expression_attribute_names.update({'#run_date': 'run_date', '#sk': sort_key})
+    run_date = start_time.astimezone(datetime.timezone.utc).date()
+    while run_date <= end_time.astimezone(datetime.timezone.utc).date():
+        items = paginate_query(
+            dynamodb,
+            TableName=table_name,
+            IndexName=index_name,
+            KeyConditionExpression='#run_date = :run_date AND #sk BETWEEN :start AND :end',
+            ProjectionExpression=projection_expression,
+            ExpressionAttributeNames=expression_attribute_names,
+            ExpressionAttributeValues={':run_date': {'S': run_date.strftime('%Y-%m-%d')},
+                                       ':start': {'N': str(start_run_id)}, ':end': {'N': str(end_run_id)}}
+        )
+        for item in items:
+            yield decode_item(item)
+        run_date += datetime.timedelta(days=1)
+
+
+def get_run(dynamodb, table_name, app_name, snapshot_manager_run_id, partition_key='app_name',
+            sort_key='snapshot_manager_run_id'):
+    """
+    This function returns the full details of one run, including its deleted snapshots spread over overflow items
+    :param dynamodb:
+    :param table_name:
+    :param app_name:
+    :param snapshot_manager_run_id:
+    :param partition_key:
+    :param sort_key:
+    :return:
+    """
+    items = paginate_query(
+        dynamodb,
+        TableName=table_name,
+        KeyConditionExpression='#pk = :app_name AND #sk BETWEEN :run_id AND :next_run_id',
+        ExpressionAttributeNames={'#pk': partition_key, '#sk': sort_key},
+        ExpressionAttributeValues={':app_name': {'S': app_name},
+                                   ':run_id': {'N': str(snapshot_manager_run_id)},
+                                   ':next_run_id': {'N': '{0}.999'.format(snapshot_manager_run_id)}}
+    )
+    return snapshot_manager.decode_snapshot_manager_status(list(items), partition_key, sort_key)
+
+
+def parse_duration(duration):
+    """
+    This function parses a duration such as 30m, 1h or 7d
+    :param duration:
+    :return:
+    """
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+    if not duration or duration[-1] not in units:
+        raise argparse.ArgumentTypeError('Invalid duration {0}, expected e.g. 30m, 1h or 7d'.format(duration))
+    return datetime.timedelta(**{units[duration[-1]]: float(duration[:-1])})
+
+
+def parse_time(value):
+    """
+    This function parses an ISO 8601 time, UTC unless it has an offset
+    :param value:
+    :return:
+    """
+    parsed_time = datetime.datetime.fromisoformat(value)
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=datetime.timezone.utc)
+    return parsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the Snapshot Manager audit table')
+    parser.add_argument('--table', default=os.environ.get('snapshot_manager_ddb_table_name', 'snapshot_manager_status'))
+    parser.add_argument('--region', default=os.environ.get('aws_region', os.environ.get('AWS_REGION', 'us-east-1')))
+    parser.add_argument('--partition-key', default=os.environ.get('primary_partition_key_name', 'app_name'))
+    parser.add_argument('--sort-key', default=os.environ.get('primary_sort_key_name', 'snapshot_manager_run_id'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    latest_parser = subparsers.add_parser('latest', help='latest restorable snapshot of an application')
+    latest_parser.add_argument('app_name')
+
+    app_runs_parser = subparsers.add_parser('app-runs', help='last runs of an application, most recent first')
+    app_runs_parser.add_argument('app_name')
+    app_runs_parser.add_argument('--limit', type=int, default=10)
+
+    fleet_runs_parser = subparsers.add_parser('fleet-runs', help='runs of all applications in a time window')
+    fleet_runs_parser.add_argument('--since', type=parse_duration, help='e.g. 1h, window ending now')
+    fleet_runs_parser.add_argument('--start', type=parse_time, help='ISO 8601, UTC unless it has an offset')
+    fleet_runs_parser.add_argument('--end', type=parse_time, help='ISO 8601, defaults to now')
+    fleet_runs_parser.add_argument('--index', default=snapshot_manager.RUN_TIME_INDEX_NAME)
+
+    run_parser = subparsers.add_parser('run', help='full details of one run')
+    run_parser.add_argument('app_name')
+    run_parser.add_argument('run_id', type=int)
+
+    args = parser.parse_args()
+    dynamodb = snapshot_manager.get_client('dynamodb', args.region)
+
+    if args.command == 'latest':
+        print(json.dumps(snapshot_manager.get_latest_snapshot_record(
+            dynamodb, args.table, args.partition_key, args.sort_key, args.app_name), default=str, indent=4))
+    elif args.command == 'app-runs':
+        for run in query_app_runs(dynamodb, args.table, args.app_name, args.limit, args.partition_key, args.sort_key):
+            print(json.dumps(run, default=str))
+    elif args.command == 'fleet-runs':
+        end_time = args.end or datetime.datetime.now(datetime.timezone.utc)
+        if args.start is None and args.since is None:
+            parser.error('fleet-runs needs --since or --start')
+        start_time = args.start or end_time - args.since
+        for run in iter_fleet_runs(dynamodb, args.table, start_time, end_time, args.sort_key, args.index,
+                                   partition_key=args.partition_key):
+            print(json.dumps(run, default=str))
+    else:
+        print(json.dumps(get_run(dynamodb, args.table, args.app_name, args.run_id, args.partition_key,
+                                 args.sort_key), default=str, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,579 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+In-process stand-ins for the Kinesis Data Analytics (kinesisanalyticsv2), SNS, DynamoDB, SQS and Lambda clients used
+by the Snapshot Manager. They implement only the calls the Snapshot Manager makes, raise botocore ClientError like the
+real clients do, and count every call. Use install_fakes to inject them into the Snapshot Manager, e.g.
+
+    kinesis_analytics = FakeKinesisAnalytics(snapshot_completion_seconds=0.1)
+    kinesis_analytics.add_application('my-kda-app', num_of_snapshots=100)
+    install_fakes('us-east-1', kinesis_analytics=kinesis_analytics)
+    snapshot_manager.lambda_handler({}, None)
+"""
+
+import io
+import re
+import json
+import time
+import random
+import datetime
+import threading
+import botocore.exceptions
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+
+
+def client_error(code, message, operation_name):
+    """
+    This function builds a ClientError the way botocore raises it
+    :param code:
+    :param message:
+    :param operation_name:
+    :return:
+    """
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message},
+                                            'ResponseMetadata': {'HTTPStatusCode': 400}}, operation_name)
+
+
+def ok_response(**kwargs):
+    """
+    This function builds a successful response with response metadata
+    :param kwargs:
+    :return:
+    """
+    kwargs['ResponseMetadata'] = {'HTTPStatusCode': 200}
+    return kwargs
+
+
+class FakeClient:
+    """
+    Base class of the fake clients. It counts calls, simulates latency and throttles a share of the calls at random,
+    or the calls of each API above requests_per_second, like a service-side rate limit with one second of burst.
+    """
+
+    def __init__(self, latency_seconds=0.0, throttle_rate=0.0, throttle_error_code='ThrottlingException', seed=None,
+                 requests_per_second=None):
+        self.latency_seconds = latency_seconds
+        self.throttle_rate = throttle_rate
+        self.throttle_error_code = throttle_error_code
+        self.requests_per_second = requests_per_second
+        self.call_counts = {}
+        self.throttle_counts = {}
+        self.api_tokens = {}
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+
+    def _call(self, api_name, operation_name):
+        with self.lock:
+            self.call_counts[api_name] = self.call_counts.get(api_name, 0) + 1
+            throttled = self.throttle_rate > 0 and self.random.random() < self.throttle_rate
+            if self.requests_per_second:
+                now = time.monotonic()
+                capacity = max(1.0, self.requests_per_second)
+                tokens, updated = self.api_tokens.get(api_name, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * self.requests_per_second)
+                throttled = throttled or tokens < 1
+                self.api_tokens[api_name] = (tokens if tokens < 1 else tokens - 1, now)
+            if throttled:
+                self.throttle_counts[api_name] = self.throttle_counts.get(api_name, 0) + 1
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+        if throttled:
+            raise client_error(self.throttle_error_code, 'Rate exceeded', operation_name)
+
+    def reset_call_counts(self):
+        with self.lock:
+            self.call_counts = {}
+            self.throttle_counts = {}
+
+
+class FakeKinesisAnalytics(FakeClient):
+    """
+    Stand-in for the kinesisanalyticsv2 client. New snapshots are CREATING for snapshot_completion_seconds and then
+    READY, or FAILED for applications added with failing_snapshots=True. list_application_snapshots returns at most
+    max_page_size snapshots per page, like the real API. Deleted snapshots leave a tombstone, so that page tokens stay
+    valid while snapshots are deleted and lookups stay O(1) with large inventories.
+    """
+
+    def __init__(self, latency_seconds=0.0, snapshot_completion_seconds=0.0, max_page_size=50, throttle_rate=0.0,
+                 throttle_error_code='LimitExceededException', seed=None, requests_per_second=None):
+        super().__init__(latency_seconds, throttle_rate, throttle_error_code, seed, requests_per_second)
+        self.snapshot_completion_seconds = snapshot_completion_seconds
+        self.max_page_size = max_page_size
+        self.applications = {}
+
+    def add_application(self, application_name, application_status='RUNNING', application_version_id=1,
+                        num_of_snapshots=0, failing_snapshots=False, snapshot_completion_seconds=None):
+        """
+        Adds an application with num_of_snapshots READY snapshots taken every 15 minutes up to now
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshots = [
+            {
+                'SnapshotName': 'custom_seed_{0}'.format(index),
+                'SnapshotStatus': 'READY',
+                'ApplicationVersionId': application_version_id,
+                'SnapshotCreationTimestamp': now - datetime.timedelta(minutes=15 * (num_of_snapshots - index))
+            }
+            for index in range(num_of_snapshots)
+        ]
+        with self.lock:
+            self.applications[application_name] = {
+                'ApplicationStatus': application_status,
+                'ApplicationVersionId': application_version_id,
+                'failing_snapshots': failing_snapshots,
+                'snapshot_completion_seconds': snapshot_completion_seconds,
+                'snapshots': snapshots,
+                'snapshot_positions': {snapshot['SnapshotName']: index for index, snapshot in enumerate(snapshots)},
+                'snapshot_ready_at': {}
+            }
+
+    def snapshot_names(self, application_name):
+        """
+        Returns the names of the snapshots of an application, oldest first
+        """
+        with self.lock:
+            return [snapshot['SnapshotName'] for snapshot in self.applications[application_name]['snapshots']
+                    if snapshot is not None]
+
+    def _application(self, application_name, operation_name):
+        application = self.applications.get(application_name)
+        if application is None:
+            raise client_error('ResourceNotFoundException',
+                               'Application {0} not found'.format(application_name), operation_name)
+        return application
+
+    def _snapshot_summary(self, application, snapshot):
+        ready_at = application['snapshot_ready_at'].get(snapshot['SnapshotName'])
+        if ready_at is not None and time.monotonic() >= ready_at:
+            snapshot['SnapshotStatus'] = 'FAILED' if application['failing_snapshots'] else 'READY'
+            del application['snapshot_ready_at'][snapshot['SnapshotName']]
+        return dict(snapshot)
+
+    def describe_application(self, ApplicationName, IncludeAdditionalDetails=False):
+        self._call('describe_application', 'DescribeApplication')
+        with self.lock:
+            application = self._application(ApplicationName, 'DescribeApplication')
+            return ok_response(ApplicationDetail={
+                'ApplicationName': ApplicationName,
+                'ApplicationStatus': application['ApplicationStatus'],
+                'ApplicationVersionId': application['ApplicationVersionId']
+            })
+
+    def create_application_snapshot(self, ApplicationName, SnapshotName):
+        self._call('create_application_snapshot', 'CreateApplicationSnapshot')
+        with self.lock:
+            application = self._application(ApplicationName, 'CreateApplicationSnapshot')
+            if application['ApplicationStatus'] != 'RUNNING':
+                raise client_error('InvalidRequestException', 'Application is not running',
+                                   'CreateApplicationSnapshot')
+            if SnapshotName in application['snapshot_positions']:
+                raise client_error('ResourceInUseException', 'Snapshot already exists', 'CreateApplicationSnapshot')
+            completion_seconds = application['snapshot_completion_seconds']
+            if completion_seconds is None:
+                completion_seconds = self.snapshot_completion_seconds
+            application['snapshot_positions'][SnapshotName] = len(application['snapshots'])
+            application['snapshots'].append({
+                'SnapshotName': SnapshotName,
+                'SnapshotStatus': 'CREATING',
+                'ApplicationVersionId': application['ApplicationVersionId'],
+                'SnapshotCreationTimestamp': datetime.datetime.now(datetime.timezone.utc)
+            })
+            application['snapshot_ready_at'][SnapshotName] = time.monotonic() + completion_seconds
+        return ok_response()
+
+    def describe_application_snapshot(self, ApplicationName, SnapshotName):
+        self._call('describe_application_snapshot', 'DescribeApplicationSnapshot')
+        with self.lock:
+            application = self._application(ApplicationName, 'DescribeApplicationSnapshot')
+            position = application['snapshot_positions'].get(SnapshotName)
+            if position is not None:
+                snapshot = application['snapshots'][position]
+                return ok_response(SnapshotDetails=self._snapshot_summary(application, snapshot))
+        raise client_error('ResourceNotFoundException', 'Snapshot {0} not found'.format(SnapshotName),
+                           'DescribeApplicationSnapshot')
+
+    def list_application_snapshots(self, ApplicationName, Limit=50, NextToken=None):
+        self._call('list_application_snapshots', 'ListApplicationSnapshots')
+        with self.lock:
+            application = self._application(ApplicationName, 'ListApplicationSnapshots')
+            snapshots = application['snapshots']
+            position = int(NextToken) if NextToken else 0
+            page_size = min(Limit, self.max_page_size)
+            page = []
+            while position < len(snapshots) and len(page) < page_size:
+                if snapshots[position] is not None:
+                    page.append(self._snapshot_summary(application, snapshots[position]))
+                position += 1
+            response = ok_response(SnapshotSummaries=page)
+            if position < len(snapshots):
+                response['NextToken'] = str(position)
+            return response
+
+    def delete_application_snapshot(self, ApplicationName, SnapshotName, SnapshotCreationTimestamp):
+        self._call('delete_application_snapshot', 'DeleteApplicationSnapshot')
+        with self.lock:
+            application = self._application(ApplicationName, 'DeleteApplicationSnapshot')
+            position = application['snapshot_positions'].pop(SnapshotName, None)
+            if position is not None:
+                application['snapshots'][position] = None
+                application['snapshot_ready_at'].pop(SnapshotName, None)
+                return ok_response()
+        raise client_error('ResourceNotFoundException', 'Snapshot {0} not found'.format(SnapshotName),
+                           'DeleteApplicationSnapshot')
+
+
+class FakeSNS(FakeClient):
+    """
+    Stand-in for the SNS client. Published messages are kept in messages.
+    """
+
+    def __init__(self, latency_seconds=0.0, throttle_rate=0.0, seed=None):
+        super().__init__(latency_seconds, throttle_rate, 'Throttling', seed)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, Subject=None):
+        self._call('publish', 'Publish')
+        with self.lock:
+            self.messages.append({'TopicArn': TopicArn, 'Message': Message, 'Subject': Subject})
+            return ok_response(MessageId=str(len(self.messages)))
+
+
+class FakeSQS(FakeClient):
+    """
+    Stand-in for the SQS client. Sent messages stay invisible for their DelaySeconds. receive_event hands visible
+    messages over as a Lambda SQS event, and deliver runs a handler on them the way the SQS event source does,
+    putting back the messages reported as batch item failures. With max_receive_count, a message received that many
+    times moves to dead_letter_messages instead, like with a redrive policy.
+    """
+
+    def __init__(self, latency_seconds=0.0, throttle_rate=0.0, seed=None, max_receive_count=None):
+        super().__init__(latency_seconds, throttle_rate, 'ThrottlingException', seed)
+        self.max_receive_count = max_receive_count
+        self.queued_messages = []
+        self.dead_letter_messages = []
+        self.num_of_messages_sent = 0
+
+    def _queue_message(self, QueueUrl, MessageBody, DelaySeconds):
+        self.num_of_messages_sent += 1
+        message_id = 'message-{0}'.format(self.num_of_messages_sent)
+        self.queued_messages.append({"messageId": message_id, "body": MessageBody, "queueUrl": QueueUrl,
+                                     "visible_at": time.monotonic() + DelaySeconds, "receive_count": 0})
+        return message_id
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        self._call('send_message', 'SendMessage')
+        with self.lock:
+            message_id = self._queue_message(QueueUrl, MessageBody, DelaySeconds)
+        return ok_response(MessageId=message_id)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call('send_message_batch', 'SendMessageBatch')
+        with self.lock:
+            successful = [{'Id': entry['Id'], 'MessageId': self._queue_message(
+                QueueUrl, entry['MessageBody'], entry.get('DelaySeconds', 0))} for entry in Entries]
+        return ok_response(Successful=successful, Failed=[])
+
+    def receive_event(self, max_messages=10, ignore_delays=False, queue_url=None):
+        """
+        Removes up to max_messages visible messages from the queue, or any messages with ignore_delays=True, and
+        returns them as a Lambda SQS event. Only messages sent to queue_url are received, if given. Returns None when
+        there is none.
+        """
+        with self.lock:
+            now = time.monotonic()
+            messages = [message for message in self.queued_messages
+                        if (ignore_delays or message['visible_at'] <= now) and
+                        queue_url in (None, message['queueUrl'])][:max_messages]
+            for message in messages:
+                self.queued_messages.remove(message)
+                message['receive_count'] += 1
+        if not messages:
+            return None
+        return {'Records': [{'messageId': message['messageId'], 'body': message['body'], 'eventSource': 'aws:sqs',
+                             'eventSourceARN': message['queueUrl'],
+                             'attributes': {'ApproximateReceiveCount': str(message['receive_count'])}}
+                            for message in messages]}
+
+    def deliver(self, handler, max_messages=10, ignore_delays=False, queue_url=None, context=None):
+        """
+        Runs handler on the next batch of messages, with context as its Lambda context, and puts back the ones
+        reported as batch item failures. Returns the handler response, or None when no message is visible.
+        """
+        event = self.receive_event(max_messages, ignore_delays, queue_url)
+        if event is None:
+            return None
+        response = handler(event, context)
+        failed_message_ids = {failure['itemIdentifier'] for failure in response.get('batchItemFailures', [])}
+        with self.lock:
+            for record in event['Records']:
+                if record['messageId'] not in failed_message_ids:
+                    continue
+                message = {"messageId": record['messageId'], "body": record['body'],
+                           "queueUrl": record['eventSourceARN'], "visible_at": time.monotonic(),
+                           "receive_count": int(record['attributes']['ApproximateReceiveCount'])}
+                if self.max_receive_count and message['receive_count'] >= self.max_receive_count:
+                    self.dead_letter_messages.append(message)
+                else:
+                    self.queued_messages.append(message)
+        return response
+
+
+class FakeDynamoDB(FakeClient):
+    """
+    Stand-in for the DynamoDB client. Items are kept per table, keyed by the partition and sort key values.
+    batch_write_item leaves a share of unprocessed_rate of the items unprocessed, like DynamoDB does under load.
+    """
+
+    def __init__(self, partition_key_name='app_name', sort_key_name='snapshot_manager_run_id', latency_seconds=0.0,
+                 throttle_rate=0.0, unprocessed_rate=0.0, seed=None):
+        super().__init__(latency_seconds, throttle_rate, 'ProvisionedThroughputExceededException', seed)
+        self.partition_key_name = partition_key_name
+        self.sort_key_name = sort_key_name
+        self.unprocessed_rate = unprocessed_rate
+        self.tables = {}
+
+    def _key(self, item):
+        return (tuple(item[self.partition_key_name].items()), tuple(item[self.sort_key_name].items()))
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None):
+        self._call('put_item', 'PutItem')
+        with self.lock:
+            table = self.tables.setdefault(TableName, {})
+            if ConditionExpression and not self._condition_holds(table.get(self._key(Item), {}), ConditionExpression,
+                                                                 ExpressionAttributeNames or {},
+                                                                 ExpressionAttributeValues or {}):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed', 'PutItem')
+            table[self._key(Item)] = Item
+        return ok_response()
+
+    def batch_write_item(self, RequestItems):
+        self._call('batch_write_item', 'BatchWriteItem')
+        if sum(len(write_requests) for write_requests in RequestItems.values()) > 25:
+            raise client_error('ValidationException', 'Too many items requested for the BatchWriteItem call',
+                               'BatchWriteItem')
+        unprocessed_items = {}
+        with self.lock:
+            for table_name, write_requests in RequestItems.items():
+                for write_request in write_requests:
+                    if self.unprocessed_rate > 0 and self.random.random() < self.unprocessed_rate:
+                        unprocessed_items.setdefault(table_name, []).append(write_request)
+                    elif 'PutRequest' in write_request:
+                        item = write_request['PutRequest']['Item']
+                        self.tables.setdefault(table_name, {})[self._key(item)] = item
+                    else:
+                        self.tables.get(table_name, {}).pop(self._key(write_request['DeleteRequest']['Key']), None)
+        return ok_response(UnprocessedItems=unprocessed_items)
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, ConsistentRead=False,
+                 ExpressionAttributeNames=None):
+        self._call('get_item', 'GetItem')
+        with self.lock:
+            item = self.tables.get(TableName, {}).get(self._key(Key))
+        return ok_response(Item=item) if item is not None else ok_response()
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None):
+        self._call('delete_item', 'DeleteItem')
+        with self.lock:
+            table = self.tables.setdefault(TableName, {})
+            item = table.get(self._key(Key), {})
+            if ConditionExpression and not self._condition_holds(item, ConditionExpression,
+                                                                 ExpressionAttributeNames or {},
+                                                                 ExpressionAttributeValues or {}):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed',
+                                   'DeleteItem')
+            table.pop(self._key(Key), None)
+        return ok_response()
+
+    def _condition_holds(self, item, condition, names, values):
+        """
+        Evaluates conditions made of attribute_exists(a), attribute_not_exists(a), [NOT] contains(a, :v) and
+        'a <op> :v' terms joined by AND or OR, without parentheses. AND binds tighter than OR.
+        """
+        def value_of(attribute):
+            attribute_type, value = next(iter(attribute.items()))
+            return float(value) if attribute_type == 'N' else value
+
+        def term_holds(term):
+            term = term.strip()
+            for function_name, expected in (('attribute_not_exists(', False), ('attribute_exists(', True)):
+                if term.startswith(function_name):
+                    return (names.get(term[len(function_name):-1], term[len(function_name):-1]) in item) == expected
+            for function_name, expected in (('NOT contains(', False), ('contains(', True)):
+                if term.startswith(function_name):
+                    name, placeholder = [part.strip() for part in term[len(function_name):-1].split(',')]
+                    members = next(iter(item.get(names.get(name, name), {'SS': []}).values()))
+                    return (value_of(values[placeholder]) in members) == expected
+            name, operator, placeholder = term.split()
+            name = names.get(name, name)
+            if name not in item:
+                return False
+            left, right = value_of(item[name]), value_of(values[placeholder])
+            return {'=': left == right, '<>': left != right, '<': left < right, '<=': left <= right,
+                    '>': left > right, '>=': left >= right}[operator]
+
+        return any(all(term_holds(term) for term in alternative.split(' AND '))
+                   for alternative in condition.split(' OR '))
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ConditionExpression=None, ReturnValues='NONE'):
+        """
+        Supports 'SET a = :v, b = :v', 'ADD a :n, b :n' and 'REMOVE a, b' clauses, in any order
+        """
+        self._call('update_item', 'UpdateItem')
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        with self.lock:
+            table = self.tables.setdefault(TableName, {})
+            item = dict(table.get(self._key(Key), Key))
+            if ConditionExpression and not self._condition_holds(item, ConditionExpression, names, values):
+                raise client_error('ConditionalCheckFailedException', 'The conditional request failed',
+                                   'UpdateItem')
+            clauses = dict(zip(*[iter(re.split(r'\b(SET|ADD|REMOVE)\s', UpdateExpression)[1:])] * 2))
+            for assignment in clauses['SET'].split(',') if 'SET' in clauses else []:
+                name, placeholder = [part.strip() for part in assignment.split('=')]
+                item[names.get(name, name)] = values[placeholder]
+            for addition in clauses['ADD'].split(',') if 'ADD' in clauses else []:
+                name, placeholder = addition.split()
+                name = names.get(name, name)
+                if 'SS' in values[placeholder]:
+                    members = item.get(name, {'SS': []})['SS']
+                    item[name] = {'SS': members + [member for member in values[placeholder]['SS']
+                                                   if member not in members]}
+                    continue
+                total = float(item.get(name, {'N': '0'})['N']) + float(values[placeholder]['N'])
+                item[name] = {'N': str(int(total) if total.is_integer() else total)}
+            for name in clauses['REMOVE'].split(',') if 'REMOVE' in clauses else []:
+                item.pop(names.get(name.strip(), name.strip()), None)
+            table[self._key(Key)] = item
+        if ReturnValues == 'ALL_NEW':
+            return ok_response(Attributes=item)
+        return ok_response()
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+              IndexName=None, FilterExpression=None, ProjectionExpression=None, ScanIndexForward=True, Limit=None,
+              ExclusiveStartKey=None):
+        """
+        Supports the key conditions 'pk = :v AND sk > :v' and 'pk = :v AND sk BETWEEN :v AND :v' and the filter
+        'attribute_not_exists(a)'. An index is keyed by the attribute in the partition key condition.
+        """
+        self._call('query', 'Query')
+        names = ExpressionAttributeNames or {}
+        tokens = [names.get(token, token) for token in KeyConditionExpression.split()]
+        partition_key_name, sort_key_name = tokens[0], tokens[4]
+        partition_key_value = ExpressionAttributeValues[tokens[2]]
+        bounds = [float(ExpressionAttributeValues[token]['N']) for token in tokens[6::2]]
+        lower, upper = (bounds[0], float('inf')) if tokens[5] == '>' else (bounds[0], bounds[1])
+        missing_attribute = names.get(FilterExpression[len('attribute_not_exists('):-1]) if FilterExpression else None
+        with self.lock:
+            items = [item for item in self.tables.get(TableName, {}).values()
+                     if item.get(partition_key_name) == partition_key_value and sort_key_name in item
+                     and (lower < float(item[sort_key_name]['N']) <= upper if tokens[5] == '>'
+                          else lower <= float(item[sort_key_name]['N']) <= upper)]
+        items.sort(key=lambda item: float(item[sort_key_name]['N']), reverse=not ScanIndexForward)
+        if ExclusiveStartKey is not None:
+            start_value = float(ExclusiveStartKey[sort_key_name]['N'])
+            items = [item for item in items if (float(item[sort_key_name]['N']) > start_value) == ScanIndexForward
+                     and float(item[sort_key_name]['N']) != start_value]
+        page, last_evaluated_key = items, None
+        if Limit is not None and len(items) > Limit:
+            page = items[:Limit]
+            last_evaluated_key = {name: page[-1][name] for name in {partition_key_name, sort_key_name,
+                                                                    self.partition_key_name, self.sort_key_name}}
+        if missing_attribute:
+            page = [item for item in page if missing_attribute not in item]
+        if ProjectionExpression:
+            projected_names = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            page = [{name: item[name] for name in projected_names if name in item} for item in page]
+        if last_evaluated_key is not None:
+            return ok_response(Items=page, LastEvaluatedKey=last_evaluated_key)
+        return ok_response(Items=page)
+
+    def items(self, table_name):
+        """
+        Returns all items of a table
+        """
+        with self.lock:
+            return list(self.tables.get(table_name, {}).values())
+
+
+class FakeLambdaContext:
+    """
+    Stand-in for the Lambda context of an invocation with a timeout of timeout_seconds
+    """
+
+    def __init__(self, timeout_seconds):
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class FakeLambda(FakeClient):
+    """
+    Stand-in for the Lambda client, used by the fleet orchestrator to invoke its shard workers. A synchronous
+    invocation runs handler in the calling thread, with a FakeLambdaContext when timeout_seconds is set. Invocations
+    above max_concurrency concurrent ones are throttled like with a reserved concurrency. The events handled are
+    kept in events.
+    """
+
+    def __init__(self, handler=None, latency_seconds=0.0, max_concurrency=None, timeout_seconds=None):
+        super().__init__(latency_seconds)
+        self.handler = handler if handler is not None else snapshot_manager.lambda_handler
+        self.max_concurrency = max_concurrency
+        self.timeout_seconds = timeout_seconds
+        self.num_of_running_invocations = 0
+        self.max_running_invocations = 0
+        self.events = []
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b''):
+        self._call('invoke', 'Invoke')
+        with self.lock:
+            if self.max_concurrency and self.num_of_running_invocations >= self.max_concurrency:
+                self.throttle_counts['invoke'] = self.throttle_counts.get('invoke', 0) + 1
+                raise client_error('TooManyRequestsException', 'Rate Exceeded.', 'Invoke')
+            self.num_of_running_invocations += 1
+            self.max_running_invocations = max(self.max_running_invocations, self.num_of_running_invocations)
+            event = json.loads(Payload)
+            self.events.append(event)
+        context = FakeLambdaContext(self.timeout_seconds) if self.timeout_seconds else None
+        try:
+            payload = self.handler(event, context)
+            function_error = None
+        except Exception as error:
+            payload = {'errorMessage': str(error), 'errorType': type(error).__name__}
+            function_error = 'Unhandled'
+        finally:
+            with self.lock:
+                self.num_of_running_invocations -= 1
+        response = ok_response(StatusCode=200, Payload=io.BytesIO(json.dumps(payload).encode('utf-8')))
+        if function_error:
+            response['FunctionError'] = function_error
+        return response
+
+
+def install_fakes(region, kinesis_analytics=None, sns=None, dynamodb=None, sqs=None, aws_lambda=None):
+    """
+    This function injects fake clients into the Snapshot Manager client registry. Clients that are not passed are
+    created with default settings. It returns the installed clients.
+    :param region:
+    :param kinesis_analytics:
+    :param sns:
+    :param dynamodb:
+    :param sqs:
+    :param aws_lambda:
+    :return:
+    """
+    fakes = {
+        'kinesisanalyticsv2': kinesis_analytics if kinesis_analytics is not None else FakeKinesisAnalytics(),
+        'sns': sns if sns is not None else FakeSNS(),
+        'dynamodb': dynamodb if dynamodb is not None else FakeDynamoDB(),
+        'sqs': sqs if sqs is not None else FakeSQS(),
+        'lambda': aws_lambda if aws_lambda is not None else FakeLambda()
+    }
+    for service_name, client in fakes.items():
+        snapshot_manager.register_client(service_name, region, client)
+    return fakes
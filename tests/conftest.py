@@ -0,0 +1,105 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Fixtures of the Snapshot Manager tests. They run the handlers against the in-process stand-ins of the AWS clients
+(see snapshot_manager_fakes.py), so no AWS account is needed.
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager  # noqa: E402
+import snapshot_manager_fakes as fakes  # noqa: E402
+
+REGION = 'us-east-1'
+APP_NAME = 'test-app'
+TABLE_NAME = 'snapshot_manager_status'
+DELETION_QUEUE_URL = 'test-deletion-queue'
+
+TEST_ENVIRONMENT = {
+    'aws_region': REGION,
+    'app_name': APP_NAME,
+    'snapshot_manager_ddb_table_name': TABLE_NAME,
+    'primary_partition_key_name': 'app_name',
+    'primary_sort_key_name': 'snapshot_manager_run_id',
+    'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789012:snapshot-manager',
+    'number_of_older_snapshots_to_retain': '3',
+    'snapshot_creation_wait_time_seconds': '1',
+    'snapshot_first_probe_seconds': '0.02',
+    'snapshot_completion_deadline_seconds': '5',
+    'deadline_safety_margin_seconds': '0',
+    # the stand-ins do not throttle unless told to, so the client side limit is set out of the way
+    'kda_api_requests_per_second': '100000'
+}
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    """
+    Sets the environment variables of the function, without any optional setting left over from the caller
+    """
+    for name in list(os.environ):
+        if name not in ('PATH', 'HOME', 'PYTHONPATH') and name.islower():
+            monkeypatch.delenv(name)
+    for name, value in TEST_ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    return monkeypatch
+
+
+@pytest.fixture
+def kinesis_analytics():
+    """
+    Kinesis Data Analytics stand-in with the application APP_NAME, whose snapshots are ready before the first check
+    """
+    kinesis_analytics = fakes.FakeKinesisAnalytics(snapshot_completion_seconds=0.01)
+    kinesis_analytics.add_application(APP_NAME, num_of_snapshots=10)
+    return kinesis_analytics
+
+
+@pytest.fixture
+def clients(environment, kinesis_analytics):
+    """
+    Installs the stand-ins of all AWS clients, with a deletion queue moving a message to its dead-letter queue at
+    its third receipt, and returns them by service name
+    """
+    return fakes.install_fakes(REGION, kinesis_analytics=kinesis_analytics, sqs=fakes.FakeSQS(max_receive_count=3))
+
+
+def invoke(handler, event=None, context=None):
+    """
+    Invokes a handler and returns its decoded response body
+    """
+    return json.loads(handler(event if event is not None else {}, context)['body'])
+
+
+def control_item(dynamodb, sort_key):
+    """
+    Returns the control record of APP_NAME with the given sort key, or None
+    """
+    return next((item for item in dynamodb.items(TABLE_NAME)
+                 if item['app_name']['S'] == APP_NAME and item['snapshot_manager_run_id']['N'] == str(sort_key)), None)
+
+
+def run_items(dynamodb):
+    """
+    Returns the main audit items of the runs of APP_NAME, oldest first
+    """
+    return sorted((item for item in dynamodb.items(TABLE_NAME)
+                   if item['app_name']['S'] == APP_NAME and 'run_outcome' in item),
+                  key=lambda item: float(item['snapshot_manager_run_id']['N']))
+
+
+@pytest.fixture
+def config(environment):
+    """
+    Settings read from the test environment, without a time budget
+    """
+    config = snapshot_manager.read_config()
+    config['run_budget'] = snapshot_manager.new_run_budget(None, config['deadline_safety_margin_seconds'])
+    return config
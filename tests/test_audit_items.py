@@ -0,0 +1,66 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import random
+import datetime
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+import snapshot_manager_audit_query as audit_query
+from conftest import APP_NAME, TABLE_NAME
+
+RUN_ID = 1704888000000
+
+
+def build_snapshots(prefix, num_of_snapshots):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [{'SnapshotName': '{0}-{1}'.format(prefix, index), 'ApplicationVersionId': 3,
+             'SnapshotCreationTimestamp': start + datetime.timedelta(minutes=15 * index)}
+            for index in range(num_of_snapshots)]
+
+
+def build_items(deleted_snapshots, not_deleted_snapshots):
+    response_body = {"app_name": APP_NAME, "snapshot_manager_run_id": RUN_ID, "run_outcome": 'snapshot_completed',
+                     "new_snapshot_name": 'custom_{0}'.format(RUN_ID), "app_version": 3}
+    return snapshot_manager.build_snapshot_manager_status_items(
+        'app_name', 'snapshot_manager_run_id', response_body, None,
+        {"deleted_snapshots": deleted_snapshots, "not_deleted_snapshots": not_deleted_snapshots})
+
+
+def test_snapshot_summaries_round_trip():
+    snapshots = build_snapshots('snapshot', 3)
+
+    encoded_snapshots = snapshot_manager.encode_snapshot_summaries(snapshots)
+
+    assert snapshot_manager.decode_snapshot_summaries(encoded_snapshots) == snapshots
+
+
+def test_audit_items_overflow_round_trip():
+    deleted_snapshots = build_snapshots('deleted', 2 * snapshot_manager.AUDIT_MAX_SNAPSHOTS_PER_ITEM + 500)
+    not_deleted_snapshots = build_snapshots('not-deleted', 10)
+
+    items = build_items(deleted_snapshots, not_deleted_snapshots)
+
+    assert [item['snapshot_manager_run_id']['N'] for item in items] == [
+        str(RUN_ID), '{0}.001'.format(RUN_ID), '{0}.002'.format(RUN_ID)]
+    assert items[0]['num_of_overflow_items'] == {'N': '2'}
+    assert [('run_date' in item, 'overflow_of_run_id' in item) for item in items] == [
+        (True, False), (False, True), (False, True)]
+    # the items of a run are decoded in any order
+    random.Random(0).shuffle(items)
+    status = snapshot_manager.decode_snapshot_manager_status(items, 'app_name', 'snapshot_manager_run_id')
+    assert status['snapshots_deleted'] == deleted_snapshots
+    assert status['snapshots_failed_to_be_deleted'] == not_deleted_snapshots
+    assert status['num_of_snapshots_deleted'] == len(deleted_snapshots)
+
+
+def test_audit_items_are_read_back_from_the_table(clients):
+    deleted_snapshots = build_snapshots('deleted', snapshot_manager.AUDIT_MAX_SNAPSHOTS_PER_ITEM + 1)
+    audit_status = snapshot_manager.flush_audit_records(clients['dynamodb'], TABLE_NAME,
+                                                        build_items(deleted_snapshots, []))
+    assert audit_status['num_of_audit_records_not_written'] == 0
+
+    run = audit_query.get_run(clients['dynamodb'], TABLE_NAME, APP_NAME, RUN_ID)
+    assert run['snapshots_deleted'] == deleted_snapshots
+
+    runs = audit_query.query_app_runs(clients['dynamodb'], TABLE_NAME, APP_NAME)
+    assert [app_run['snapshot_manager_run_id'] for app_run in runs] == [RUN_ID]
@@ -0,0 +1,22 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import invoke
+
+
+def test_warm_invocation_does_not_report_the_setup_of_reused_clients(clients, monkeypatch):
+    # a client created by a previous invocation of the execution environment
+    monkeypatch.setitem(snapshot_manager._client_setup_ms, 'dynamodb', 12.5)
+
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['client_setup_ms'] == {}
+
+
+def test_client_setup_is_reported_by_the_invocation_which_created_the_client(monkeypatch):
+    monkeypatch.setattr(snapshot_manager, '_client_setup_ms', {'dynamodb': 12.5})
+    known_client_setup_ms = dict(snapshot_manager._client_setup_ms)
+    snapshot_manager._client_setup_ms['sns'] = 8.25
+
+    assert snapshot_manager.get_client_setup_ms(known_client_setup_ms) == {'sns': 8.25}
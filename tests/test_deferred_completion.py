@@ -0,0 +1,61 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import APP_NAME, invoke, run_items
+
+COMPLETION_QUEUE_URL = 'test-completion-queue'
+
+
+def deliver_checks(sqs, max_num_of_deliveries=50):
+    """
+    Delivers the completion queue to the completion handler until it is empty, and returns the responses
+    """
+    responses = []
+    while sqs.queued_messages and len(responses) < max_num_of_deliveries:
+        time.sleep(0.05)
+        response = sqs.deliver(snapshot_manager.lambda_handler, queue_url=COMPLETION_QUEUE_URL)
+        if response is not None:
+            responses.append(response)
+    assert not sqs.queued_messages
+    return responses
+
+
+def test_snapshot_is_checked_from_delayed_messages_until_it_is_ready(environment, clients, kinesis_analytics):
+    environment.setenv('completion_mode', 'deferred')
+    environment.setenv('snapshot_completion_queue_url', COMPLETION_QUEUE_URL)
+    environment.setenv('snapshot_completion_delay_seconds', '0')
+    kinesis_analytics.snapshot_completion_seconds = 0.3
+
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['run_outcome'] == 'snapshot_pending'
+    assert kinesis_analytics.call_counts.get('delete_application_snapshot', 0) == 0
+    responses = deliver_checks(clients['sqs'])
+
+    # the snapshot was still in progress at the first checks, which deferred the next one
+    assert len(responses) > 1
+    assert all(response['batchItemFailures'] == [] for response in responses)
+    assert kinesis_analytics.call_counts['create_application_snapshot'] == 1
+    assert len(kinesis_analytics.snapshot_names(APP_NAME)) == 3
+    assert [item['run_outcome']['S'] for item in run_items(clients['dynamodb'])] == ['snapshot_completed']
+    assert run_items(clients['dynamodb'])[0]['snapshot_manager_run_id']['N'] == str(
+        response_body['snapshot_manager_run_id'])
+
+
+def test_snapshot_not_ready_by_the_deadline_is_reported_as_delayed(environment, clients, kinesis_analytics):
+    environment.setenv('completion_mode', 'deferred')
+    environment.setenv('snapshot_completion_queue_url', COMPLETION_QUEUE_URL)
+    environment.setenv('snapshot_completion_delay_seconds', '0')
+    environment.setenv('snapshot_completion_deadline_seconds', '0.2')
+    kinesis_analytics.snapshot_completion_seconds = 60
+
+    invoke(snapshot_manager.lambda_handler)
+    deliver_checks(clients['sqs'])
+
+    assert [item['run_outcome']['S'] for item in run_items(clients['dynamodb'])] == ['snapshot_delayed']
+    assert len(clients['sns'].messages) == 1
+    # the snapshots are only deleted once a new one is READY
+    assert len(kinesis_analytics.snapshot_names(APP_NAME)) == 11
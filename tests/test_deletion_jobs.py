@@ -0,0 +1,89 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+import snapshot_manager_fakes as fakes
+from conftest import APP_NAME, DELETION_QUEUE_URL, invoke, run_items
+
+
+@pytest.fixture
+def queued_deletion(environment, clients, kinesis_analytics):
+    """
+    Runs the handler once in queued deletion mode, for an application with 30 snapshots, so that 28 of them are sent
+    to the deletion queue in jobs of 10
+    """
+    environment.setenv('deletion_mode', 'queued')
+    environment.setenv('snapshot_deletion_queue_url', DELETION_QUEUE_URL)
+    environment.setenv('snapshot_deletion_job_size', '10')
+    kinesis_analytics.add_application(APP_NAME, num_of_snapshots=30)
+    response_body = invoke(snapshot_manager.lambda_handler)
+    assert response_body['num_of_snapshots_queued_for_deletion'] == 28
+    assert len(clients['sqs'].queued_messages) == 3
+    return clients
+
+
+def num_of_snapshots_deleted(dynamodb):
+    return int(run_items(dynamodb)[-1]['num_of_snapshots_deleted']['N'])
+
+
+def test_deletion_job_delivered_twice_is_counted_once(queued_deletion):
+    event = queued_deletion['sqs'].receive_event()
+
+    first_response_body = invoke(snapshot_manager.snapshot_deletion_handler, event)
+    second_response_body = invoke(snapshot_manager.snapshot_deletion_handler, event)
+
+    assert first_response_body['batchItemFailures'] == second_response_body['batchItemFailures'] == []
+    assert all(job_status['audit_record_updated'] for job_status in first_response_body['jobs'])
+    assert not any(job_status['audit_record_updated'] for job_status in second_response_body['jobs'])
+    assert num_of_snapshots_deleted(queued_deletion['dynamodb']) == 28
+    assert len(queued_deletion['kinesisanalyticsv2'].snapshot_names(APP_NAME)) == 3
+
+
+def deliver_all(sqs, context_seconds=None):
+    """
+    Delivers the deletion queue to the deletion handler one message at a time until it is empty, each invocation
+    with a timeout of context_seconds if given, and returns the number of deliveries
+    """
+    num_of_deliveries = 0
+    while sqs.queued_messages:
+        context = fakes.FakeLambdaContext(context_seconds) if context_seconds is not None else None
+        sqs.deliver(snapshot_manager.snapshot_deletion_handler, max_messages=1, queue_url=DELETION_QUEUE_URL,
+                    context=context)
+        num_of_deliveries += 1
+    return num_of_deliveries
+
+
+def test_throttled_deletion_job_goes_to_the_dead_letter_queue(queued_deletion, environment, monkeypatch):
+    environment.setenv('kda_api_max_attempts', '1')
+
+    def throttled(**kwargs):
+        raise fakes.client_error('LimitExceededException', 'Rate exceeded', 'DeleteApplicationSnapshot')
+
+    monkeypatch.setattr(queued_deletion['kinesisanalyticsv2'], 'delete_application_snapshot', throttled)
+    deliver_all(queued_deletion['sqs'])
+
+    assert len(queued_deletion['sqs'].dead_letter_messages) == 3
+    assert num_of_snapshots_deleted(queued_deletion['dynamodb']) == 0
+
+
+def test_deletion_job_larger_than_the_time_budget_is_split(queued_deletion, environment):
+    # about 9 deletions of the jobs of 10 fit in the time left before the function timeout
+    environment.setenv('kda_api_requests_per_second', '100')
+
+    deliver_all(queued_deletion['sqs'], context_seconds=0.1)
+
+    assert queued_deletion['sqs'].num_of_messages_sent > 3
+    assert queued_deletion['sqs'].dead_letter_messages == []
+    assert num_of_snapshots_deleted(queued_deletion['dynamodb']) == 28
+    assert len(queued_deletion['kinesisanalyticsv2'].snapshot_names(APP_NAME)) == 3
+
+
+def test_deletion_job_without_time_budget_goes_to_the_dead_letter_queue(queued_deletion):
+    num_of_deliveries = deliver_all(queued_deletion['sqs'], context_seconds=0)
+
+    # each job is received max_receive_count times
+    assert num_of_deliveries == 3 * 3
+    assert len(queued_deletion['sqs'].dead_letter_messages) == 3
+    assert num_of_snapshots_deleted(queued_deletion['dynamodb']) == 0
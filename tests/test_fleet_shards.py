@@ -0,0 +1,55 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+
+import botocore.exceptions
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+import snapshot_manager_fakes as fakes
+
+APP_NAMES = ['fleet-app-{0:03d}'.format(index) for index in range(200)]
+
+
+def test_consistent_hashing_only_moves_applications_to_the_new_shard():
+    shards = snapshot_manager.assign_fleet_shards(APP_NAMES, 8)
+    grown_shards = snapshot_manager.assign_fleet_shards(APP_NAMES, 9)
+
+    assert sorted(name for shard in shards for name in shard) == APP_NAMES
+    moved_app_names = [name for shard_id, shard in enumerate(shards) for name in shard
+                       if name not in grown_shards[shard_id]]
+    assert set(moved_app_names) == set(grown_shards[8])
+    assert len(moved_app_names) < len(APP_NAMES) / 4
+    assert snapshot_manager.assign_fleet_shards(APP_NAMES, 8) == shards
+
+
+def test_failing_shards_do_not_lose_the_fleet_summary(clients, config, kinesis_analytics, monkeypatch):
+    app_names = APP_NAMES[:20]
+    for app_name in app_names:
+        kinesis_analytics.add_application(app_name, num_of_snapshots=1)
+    config['fleet_num_of_shards'] = 4
+    shards = snapshot_manager.assign_fleet_shards(app_names, 4)
+    aws_lambda = clients['lambda']
+    invoke = aws_lambda.invoke
+
+    def invoke_with_failures(FunctionName, InvocationType='RequestResponse', Payload=b''):
+        if shards[0][0] in Payload.decode('utf-8'):
+            raise botocore.exceptions.ReadTimeoutError(endpoint_url='https://lambda.us-east-1.amazonaws.com')
+        if shards[1][0] in Payload.decode('utf-8'):
+            return fakes.ok_response(StatusCode=200, Payload=io.BytesIO(b'<html>Bad Gateway</html>'))
+        if shards[2][0] in Payload.decode('utf-8'):
+            raise RuntimeError('Unexpected failure')
+        return invoke(FunctionName=FunctionName, InvocationType=InvocationType, Payload=Payload)
+
+    monkeypatch.setattr(aws_lambda, 'invoke', invoke_with_failures)
+    fleet_response_body = snapshot_manager.orchestrate_fleet(aws_lambda, config, app_names, 1)
+
+    assert fleet_response_body['num_of_shards_failed'] == 3
+    shard_errors = {shard['shard_id']: shard['error_message'] for shard in fleet_response_body['shards']}
+    assert shard_errors[0].startswith('ReadTimeoutError')
+    assert shard_errors[1].startswith('JSONDecodeError')
+    assert shard_errors[2] == 'Unexpected failure'
+    num_of_apps_failed = len(shards[0]) + len(shards[1]) + len(shards[2])
+    assert fleet_response_body['num_of_apps_failed'] == num_of_apps_failed
+    assert fleet_response_body['run_outcomes'] == {'shard_failed': num_of_apps_failed,
+                                                   'snapshot_completed': len(shards[3])}
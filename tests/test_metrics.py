@@ -0,0 +1,28 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import APP_NAME
+
+
+def emitted_dimensions(capsys, per_app_api_metrics):
+    run_metrics = snapshot_manager.new_run_metrics()
+    run_metrics['api_calls']['DescribeApplication'] = 1
+    snapshot_manager.record_phase(run_metrics, 'poll', 1.0, 0.5)
+    capsys.readouterr()
+
+    snapshot_manager.emit_metrics('SnapshotManager', APP_NAME, run_metrics, per_app_api_metrics)
+
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert all(document['app_name'] == APP_NAME for document in documents)
+    return sorted(document['_aws']['CloudWatchMetrics'][0]['Dimensions'][0] for document in documents)
+
+
+def test_only_run_metrics_have_the_app_name_dimension(capsys):
+    assert emitted_dimensions(capsys, False) == [['api_name'], ['app_name'], ['phase']]
+
+
+def test_per_app_api_metrics_add_the_app_name_dimension(capsys):
+    assert emitted_dimensions(capsys, True) == [['app_name'], ['app_name', 'api_name'], ['app_name', 'phase']]
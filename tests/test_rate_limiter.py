@@ -0,0 +1,84 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import types
+
+import pytest
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+
+API_NAME = 'DeleteApplicationSnapshot'
+
+
+class FakeClock:
+    """
+    Stand-in for the time module of the rate limiter. Sleeping moves the clock forward at once, and fails once more
+    than max_seconds have passed, so that a limiter which never hands out a token fails the test instead of hanging.
+    """
+
+    def __init__(self, max_seconds=60):
+        self.now = 0.0
+        self.max_seconds = max_seconds
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        if self.now > self.max_seconds:
+            raise AssertionError('No token after {0} seconds'.format(self.now))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Empty token buckets driven by a FakeClock
+    """
+    clock = FakeClock()
+    monkeypatch.setattr(snapshot_manager, 'time', types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    monkeypatch.setattr(snapshot_manager, '_rate_limiters', {})
+    monkeypatch.setattr(snapshot_manager, '_rate_limit_settings', dict(snapshot_manager._rate_limit_settings))
+    return clock
+
+
+def acquire_tokens(num_of_tokens):
+    return [round(snapshot_manager.acquire_api_token(API_NAME), 3) for _ in range(num_of_tokens)]
+
+
+def test_rate_below_one_request_per_second_still_hands_out_tokens(clock):
+    snapshot_manager.configure_api_rate_limits(0.5, 3)
+
+    assert acquire_tokens(3) == [0.0, 2.0, 2.0]
+    assert clock.now == pytest.approx(4.0)
+
+
+def test_bucket_holds_one_second_of_tokens(clock):
+    snapshot_manager.configure_api_rate_limits(10, 3)
+
+    waited_seconds = acquire_tokens(11)
+
+    assert waited_seconds[:10] == [0.0] * 10
+    assert waited_seconds[10] == pytest.approx(0.1)
+
+
+def test_throttle_cuts_the_rate_and_success_grows_it_back(clock):
+    snapshot_manager.configure_api_rate_limits(10, 3)
+    acquire_tokens(1)
+
+    snapshot_manager.record_api_outcome(API_NAME, True)
+
+    assert snapshot_manager._rate_limiters[API_NAME]['rate'] == pytest.approx(7.0)
+    # the bucket has been emptied, so the next call waits for a token at the cut rate
+    assert acquire_tokens(1) == [pytest.approx(1 / 7, abs=0.001)]
+    snapshot_manager.record_api_outcome(API_NAME, False)
+    assert snapshot_manager._rate_limiters[API_NAME]['rate'] == pytest.approx(7.5)
+
+
+def test_throttled_rate_never_falls_below_the_minimum(clock):
+    snapshot_manager.configure_api_rate_limits(1, 3)
+    acquire_tokens(1)
+    for _ in range(20):
+        snapshot_manager.record_api_outcome(API_NAME, True)
+
+    assert snapshot_manager._rate_limiters[API_NAME]['rate'] == snapshot_manager.MIN_API_REQUESTS_PER_SECOND
+    assert acquire_tokens(2) == [2.0, 2.0]
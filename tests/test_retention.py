@@ -0,0 +1,79 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import datetime
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+
+
+def snapshot(name, *creation_time):
+    return {'SnapshotName': name, 'ApplicationVersionId': 1,
+            'SnapshotCreationTimestamp': datetime.datetime(*creation_time, tzinfo=datetime.timezone.utc)}
+
+
+def retention_policy(**num_of_snapshots):
+    policy = {"num_of_recent_snapshots": 0, "num_of_hourly_snapshots": 0, "num_of_daily_snapshots": 0,
+              "num_of_weekly_snapshots": 0, "pinned_snapshot_names": frozenset()}
+    policy.update(num_of_snapshots)
+    return policy
+
+
+def plan(snapshots, policy, new_snapshot_name=None):
+    retention_plan = snapshot_manager.plan_snapshot_retention(snapshots, policy, new_snapshot_name)
+    return ([kept_snapshot['SnapshotName'] for kept_snapshot in retention_plan['snapshots_to_keep']],
+            retention_plan['num_of_snapshots_retained_by_tier'])
+
+
+def test_hourly_tier_keeps_the_last_snapshot_of_each_hour():
+    snapshots = [snapshot('12:00:00', 2024, 1, 10, 12), snapshot('11:59:59', 2024, 1, 10, 11, 59, 59),
+                 snapshot('11:30', 2024, 1, 10, 11, 30), snapshot('10:59', 2024, 1, 10, 10, 59)]
+
+    kept_snapshot_names, retained_by_tier = plan(snapshots, retention_policy(num_of_hourly_snapshots=2))
+
+    assert kept_snapshot_names == ['12:00:00', '11:59:59']
+    assert retained_by_tier['hourly'] == 2
+
+
+def test_daily_tier_buckets_by_utc_day():
+    snapshots = [snapshot('jan-08 00:00', 2024, 1, 8), snapshot('jan-07 23:59', 2024, 1, 7, 23, 59, 59),
+                 snapshot('jan-07 12:00', 2024, 1, 7, 12), snapshot('jan-06 12:00', 2024, 1, 6, 12)]
+
+    kept_snapshot_names, _ = plan(snapshots, retention_policy(num_of_daily_snapshots=2))
+
+    assert kept_snapshot_names == ['jan-08 00:00', 'jan-07 23:59']
+
+
+def test_weekly_tier_buckets_by_iso_week():
+    # 2024-01-08 and 2024-01-01 are Mondays
+    snapshots = [snapshot('mon jan-08', 2024, 1, 8), snapshot('sun jan-07', 2024, 1, 7, 23, 59, 59),
+                 snapshot('mon jan-01', 2024, 1, 1), snapshot('sun dec-31', 2023, 12, 31, 23)]
+
+    kept_snapshot_names, _ = plan(snapshots, retention_policy(num_of_weekly_snapshots=3))
+
+    assert kept_snapshot_names == ['mon jan-08', 'sun jan-07', 'sun dec-31']
+
+
+def test_recent_pinned_and_new_snapshots_are_kept():
+    snapshots = [snapshot('new', 2024, 1, 10, 12), snapshot('recent', 2024, 1, 10, 11),
+                 snapshot('old', 2024, 1, 10, 10), snapshot('pinned', 2024, 1, 10, 9)]
+    policy = retention_policy(num_of_recent_snapshots=1, pinned_snapshot_names=frozenset(['pinned']))
+
+    kept_snapshot_names, retained_by_tier = plan(snapshots[1:], policy, 'new')
+    assert kept_snapshot_names == ['recent', 'pinned']
+
+    kept_snapshot_names, retained_by_tier = plan(snapshots, retention_policy(), 'new')
+    assert kept_snapshot_names == ['new']
+    assert retained_by_tier['pinned'] == 1
+
+
+def test_streaming_selector_keeps_the_most_recent_and_the_new_snapshot():
+    snapshots = [snapshot('hour-{0}'.format(hour), 2024, 1, 10, hour) for hour in range(6)]
+
+    deleted_snapshot_names = {deleted_snapshot['SnapshotName'] for deleted_snapshot in
+                              snapshot_manager.select_snapshots_to_delete(iter(snapshots), 2)}
+    assert deleted_snapshot_names == {'hour-0', 'hour-1', 'hour-2', 'hour-3'}
+
+    deleted_snapshot_names = {deleted_snapshot['SnapshotName'] for deleted_snapshot in
+                              snapshot_manager.select_snapshots_to_delete(iter(snapshots), 0, 'hour-5')}
+    assert 'hour-5' not in deleted_snapshot_names
+    assert len(deleted_snapshot_names) == 5
@@ -0,0 +1,85 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+import pytest
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+import snapshot_manager_fakes as fakes
+from conftest import APP_NAME, invoke, run_items
+
+
+class FunctionKilled(BaseException):
+    """
+    Raised by a stand-in call to stop a run the way a function timeout does, without any clean-up
+    """
+
+
+def test_run_timed_out_while_polling_resumes_without_a_second_snapshot(clients, config, kinesis_analytics):
+    kinesis_analytics.snapshot_completion_seconds = 0.5
+
+    response_body = invoke(snapshot_manager.lambda_handler, context=fakes.FakeLambdaContext(0.2))
+
+    assert response_body['run_outcome'] == 'snapshot_pending'
+    run_checkpoint = snapshot_manager.get_run_checkpoint(clients['dynamodb'], config, APP_NAME)
+    assert run_checkpoint['phase'] == 'snapshot_initiated'
+
+    time.sleep(0.5)
+    resumed_response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert resumed_response_body['resumed_from_phase'] == 'snapshot_initiated'
+    assert resumed_response_body['run_outcome'] == 'snapshot_completed'
+    assert resumed_response_body['snapshot_manager_run_id'] == response_body['snapshot_manager_run_id']
+    assert kinesis_analytics.call_counts['create_application_snapshot'] == 1
+    assert snapshot_manager.get_run_checkpoint(clients['dynamodb'], config, APP_NAME) is None
+    assert [item['run_outcome']['S'] for item in run_items(clients['dynamodb'])] == ['snapshot_completed']
+
+
+def test_run_killed_while_deleting_resumes_the_deletions(clients, config, kinesis_analytics, monkeypatch):
+    kinesis_analytics.add_application(APP_NAME, num_of_snapshots=250)
+    delete_application_snapshot = kinesis_analytics.delete_application_snapshot
+    num_of_deletions = [0]
+
+    def delete_until_killed(**kwargs):
+        num_of_deletions[0] += 1
+        if num_of_deletions[0] > snapshot_manager.RUN_CHECKPOINT_INTERVAL + 50:
+            raise FunctionKilled()
+        return delete_application_snapshot(**kwargs)
+
+    monkeypatch.setattr(kinesis_analytics, 'delete_application_snapshot', delete_until_killed)
+    with pytest.raises(FunctionKilled):
+        invoke(snapshot_manager.lambda_handler, context=fakes.FakeLambdaContext(0.5))
+    run_checkpoint = snapshot_manager.get_run_checkpoint(clients['dynamodb'], config, APP_NAME)
+    assert run_checkpoint['phase'] == 'deleting'
+    assert len(run_checkpoint['snapshots_deleted']) == snapshot_manager.RUN_CHECKPOINT_INTERVAL
+
+    monkeypatch.setattr(kinesis_analytics, 'delete_application_snapshot', delete_application_snapshot)
+    # the lease of the run lock of the killed run ends at its function timeout
+    time.sleep(0.5)
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['resumed_from_phase'] == 'deleting'
+    assert response_body['snapshot_manager_run_id'] == run_checkpoint['snapshot_manager_run_id']
+    assert kinesis_analytics.call_counts['create_application_snapshot'] == 1
+    # the notification of the new snapshot was sent before the deletions started
+    assert len(clients['sns'].messages) == 1
+    assert len(kinesis_analytics.snapshot_names(APP_NAME)) == 3
+    assert snapshot_manager.get_run_checkpoint(clients['dynamodb'], config, APP_NAME) is None
+
+
+def test_resumed_run_does_not_record_the_time_since_the_snapshot_was_initiated(clients, config, kinesis_analytics):
+    kinesis_analytics.snapshot_completion_seconds = 0.3
+    invoke(snapshot_manager.lambda_handler, context=fakes.FakeLambdaContext(0.2))
+
+    # the snapshot is ready long before the run is resumed, which cannot tell when it turned READY
+    time.sleep(1)
+    resumed_response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert resumed_response_body['run_outcome'] == 'snapshot_completed'
+    assert resumed_response_body['new_snapshot_wait_seconds'] is None
+    latest_snapshot_record = snapshot_manager.get_latest_snapshot_record(
+        clients['dynamodb'], config['ddb_table_name'], 'app_name', 'snapshot_manager_run_id', APP_NAME)
+    assert latest_snapshot_record['snapshot_name'] == resumed_response_body['new_snapshot_name']
+    assert latest_snapshot_record['time_to_ready_seconds'] is None
+    assert snapshot_manager.get_ttr_history(clients['dynamodb'], config, APP_NAME) == []
@@ -0,0 +1,54 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import APP_NAME, control_item, invoke, run_items
+
+
+def test_run_locked_while_another_run_holds_the_lock(clients, config):
+    run_lock = snapshot_manager.acquire_run_lock(clients['dynamodb'], config, APP_NAME, 1)
+    assert run_lock['fencing_token'] == 1
+
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['run_outcome'] == 'run_locked'
+    assert 'create_application_snapshot' not in clients['kinesisanalyticsv2'].call_counts
+    assert run_items(clients['dynamodb']) == []
+    # the lock is still the one of the other run
+    assert control_item(clients['dynamodb'], snapshot_manager.RUN_LOCK_SORT_KEY)['lock_owner_run_id']['N'] == '1'
+
+
+def test_run_takes_and_releases_the_lock(clients):
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['run_outcome'] == 'snapshot_completed'
+    run_lock = control_item(clients['dynamodb'], snapshot_manager.RUN_LOCK_SORT_KEY)
+    assert run_lock['fencing_token']['N'] == '1'
+    assert 'lease_expires_at' not in run_lock
+    assert invoke(snapshot_manager.lambda_handler)['run_outcome'] != 'run_locked'
+
+
+def test_run_lock_is_reentrant_and_expires(clients, config):
+    dynamodb = clients['dynamodb']
+    config['run_lock_lease_seconds'] = 0
+
+    assert snapshot_manager.acquire_run_lock(dynamodb, config, APP_NAME, 1)['fencing_token'] == 1
+    assert snapshot_manager.acquire_run_lock(dynamodb, config, APP_NAME, 1)['fencing_token'] == 2
+    time.sleep(0.01)
+    # the lease of run 1 has expired, so run 2 takes the lock over
+    assert snapshot_manager.acquire_run_lock(dynamodb, config, APP_NAME, 2)['fencing_token'] == 3
+
+
+def test_stale_fencing_token_neither_releases_nor_renews_the_lock(clients, config):
+    dynamodb = clients['dynamodb']
+    run_lock = snapshot_manager.acquire_run_lock(dynamodb, config, APP_NAME, 2)
+    stale_response_body = {"app_name": APP_NAME, "snapshot_manager_run_id": 1,
+                           "run_lock_fencing_token": run_lock['fencing_token'] - 1}
+
+    assert not snapshot_manager.renew_run_lock(dynamodb, config, stale_response_body)
+    assert stale_response_body['run_lock_lost']
+    snapshot_manager.release_run_locks(dynamodb, config, [stale_response_body])
+
+    assert 'lease_expires_at' in control_item(dynamodb, snapshot_manager.RUN_LOCK_SORT_KEY)
@@ -0,0 +1,43 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import APP_NAME
+
+SNAPSHOT_NAME = 'custom_1'
+
+
+def wait(kinesis_analytics, snapshot_completion_seconds, deadline_seconds):
+    kinesis_analytics.snapshot_completion_seconds = snapshot_completion_seconds
+    kinesis_analytics.create_application_snapshot(ApplicationName=APP_NAME, SnapshotName=SNAPSHOT_NAME)
+    return snapshot_manager.wait_for_snapshot_completion(kinesis_analytics, APP_NAME, SNAPSHOT_NAME, 0.02, 0.1,
+                                                         deadline_seconds)
+
+
+def test_waiter_backs_off_and_returns_once_the_snapshot_is_ready(clients, kinesis_analytics):
+    snapshot_completion = wait(kinesis_analytics, 0.3, 5)
+
+    assert snapshot_completion['snapshot_status'] == 'READY'
+    assert snapshot_completion['snapshot']['SnapshotName'] == SNAPSHOT_NAME
+    # a check every 0.02 seconds would take 15, the backoff stays within max_wait_seconds of the time to ready
+    assert snapshot_completion['num_of_checks'] < 10
+    assert 0.3 <= snapshot_completion['wait_time_seconds'] < 0.3 + 0.1 + 0.1
+
+
+def test_waiter_gives_up_at_the_deadline(clients, kinesis_analytics):
+    snapshot_completion = wait(kinesis_analytics, 60, 0.25)
+
+    assert snapshot_completion['snapshot_status'] == 'TIMED_OUT'
+    assert snapshot_completion['snapshot'] is None
+    assert 0.25 <= snapshot_completion['wait_time_seconds'] < 0.25 + 0.1
+
+
+def test_waiter_reports_a_failed_snapshot(clients, kinesis_analytics):
+    kinesis_analytics.add_application('failing-app', failing_snapshots=True)
+    kinesis_analytics.create_application_snapshot(ApplicationName='failing-app', SnapshotName=SNAPSHOT_NAME)
+
+    snapshot_completion = snapshot_manager.wait_for_snapshot_completion(kinesis_analytics, 'failing-app',
+                                                                        SNAPSHOT_NAME, 0.02, 0.1, 5)
+
+    assert snapshot_completion['snapshot_status'] == 'FAILED'
+    assert snapshot_completion['num_of_checks'] < 10
@@ -0,0 +1,38 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+import snapshot_manager_fakes as fakes
+
+APP_NAMES = ['fleet-app-{0:04d}'.format(index) for index in range(1000)]
+
+
+def test_schedule_offsets_are_stable_and_spread_over_the_interval():
+    offsets = [snapshot_manager.get_app_schedule_offset(app_name, 60) for app_name in APP_NAMES]
+
+    assert offsets == [snapshot_manager.get_app_schedule_offset(app_name, 60) for app_name in APP_NAMES]
+    assert all(0 <= offset < 60 for offset in offsets)
+    num_of_offsets_per_10_seconds = [sum(1 for offset in offsets if start <= offset < start + 10)
+                                     for start in range(0, 60, 10)]
+    assert min(num_of_offsets_per_10_seconds) > 120
+    assert max(num_of_offsets_per_10_seconds) < 220
+    # the offset within a minute is the remainder of the offset within an hour
+    assert all(round(snapshot_manager.get_app_schedule_offset(app_name, 3600) % 60, 3) == offset
+               for app_name, offset in zip(APP_NAMES, offsets))
+
+
+def test_start_delay_adds_jitter_and_keeps_half_of_the_budget(config):
+    config['stagger_window_seconds'] = 60
+    config['stagger_jitter_seconds'] = 5
+    offset = snapshot_manager.get_app_schedule_offset(APP_NAMES[0], 60)
+
+    start_delays = [snapshot_manager.get_start_delay_seconds(config, APP_NAMES[0]) for _ in range(20)]
+    assert all(offset <= start_delay <= offset + 5 for start_delay in start_delays)
+    assert len(set(start_delays)) > 1
+
+    config['run_budget'] = snapshot_manager.new_run_budget(fakes.FakeLambdaContext(4), 0)
+    assert snapshot_manager.get_start_delay_seconds(config, APP_NAMES[0]) <= 2
+
+
+def test_no_stagger_window_starts_at_once(config):
+    assert snapshot_manager.get_start_delay_seconds(config, APP_NAMES[0]) == 0
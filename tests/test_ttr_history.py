@@ -0,0 +1,64 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+
+import amazon_kinesis_data_analytics_for_apache_flink_snapshot_manager as snapshot_manager
+from conftest import APP_NAME, TABLE_NAME, invoke, run_items
+
+
+def ttr_samples(*times_to_ready, delayed=False):
+    now = int(time.time() * 1000)
+    return [{"time_to_ready_seconds": time_to_ready, "delayed": delayed, "initiated_at": now}
+            for time_to_ready in times_to_ready]
+
+
+def save_ttr_history(dynamodb, samples):
+    dynamodb.put_item(TableName=TABLE_NAME, Item={
+        'app_name': {'S': APP_NAME},
+        'snapshot_manager_run_id': {'N': str(snapshot_manager.TTR_HISTORY_SORT_KEY)},
+        'ttr_samples': {'L': [{'M': {'s': {'N': str(sample['time_to_ready_seconds'])},
+                                     'd': {'BOOL': sample['delayed']},
+                                     't': {'N': str(sample['initiated_at'])}}} for sample in samples]}})
+
+
+def test_single_slow_sample_does_not_set_the_cadence(config):
+    ttr_summary = snapshot_manager.summarize_ttr_history(ttr_samples(*[1.0] * 10, 300.0), config)
+
+    assert ttr_summary['is_adaptive']
+    assert ttr_summary['p95_seconds'] == 300.0
+    assert not ttr_summary['is_cadence_adaptive']
+    # the first check stays within the configured deadline
+    assert ttr_summary['poll_settings']['snapshot_first_probe_seconds'] == 0.5
+
+
+def test_delayed_samples_are_left_out_of_the_recommended_interval(config):
+    samples = ttr_samples(*[40.0] * snapshot_manager.CADENCE_MIN_SAMPLES) + ttr_samples(900.0, delayed=True)
+
+    ttr_summary = snapshot_manager.summarize_ttr_history(samples, config)
+
+    assert ttr_summary['is_cadence_adaptive']
+    assert ttr_summary['recommended_interval_seconds'] == 80
+    assert ttr_summary['delayed_ratio'] == round(1 / len(samples), 3)
+
+
+def test_run_is_skipped_within_the_recommended_interval(clients):
+    save_ttr_history(clients['dynamodb'], ttr_samples(*[0.1] * snapshot_manager.CADENCE_MIN_SAMPLES))
+
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['run_outcome'] == 'cadence_skipped'
+    assert 'create_application_snapshot' not in clients['kinesisanalyticsv2'].call_counts
+    assert [item['run_outcome']['S'] for item in run_items(clients['dynamodb'])] == ['cadence_skipped']
+
+
+def test_run_is_not_skipped_before_the_history_has_enough_samples(clients):
+    save_ttr_history(clients['dynamodb'], ttr_samples(*[0.1] * (snapshot_manager.CADENCE_MIN_SAMPLES - 1)))
+
+    response_body = invoke(snapshot_manager.lambda_handler)
+
+    assert response_body['run_outcome'] == 'snapshot_completed'
+    # the poll timing already follows the history
+    assert response_body['ttr_history']['is_adaptive']
+    assert len(snapshot_manager.get_ttr_history(clients['dynamodb'], snapshot_manager.read_config(), APP_NAME)) == (
+        snapshot_manager.CADENCE_MIN_SAMPLES)